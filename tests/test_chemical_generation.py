@@ -1,20 +1,24 @@
 # test chemical generaion
 import os
+import pickle
 from pathlib import Path
 
+import numpy as np
 import pytest
+from loguru import logger
 from mass_spec_utils.library_matching.gnps import load_mgf
 
-from tests.conftest import HMDB, MGF_FILE, MZML_FILE, OUT_DIR, check_mzML, check_non_empty_MS2
+from tests.conftest import HMDB, MGF_FILE, MZML_FILE, OUT_DIR, BEER_CHEMS, check_mzML, check_non_empty_MS2
 from vimms.ChemicalSamplers import UniformRTAndIntensitySampler, DatabaseFormulaSampler, UniformMZFormulaSampler, \
     CRPMS2Sampler, MGFMS2Sampler, MZMLMS2Sampler, ExactMatchMS2Sampler, MZMLRTandIntensitySampler, MZMLFormulaSampler, \
     MZMLChromatogramSampler, MzMLScanTimeSampler
+from vimms.Chromatograms import ChromatogramBank, FunctionalChromatogram
 from vimms.Chemicals import ChemicalMixtureCreator, MultipleMixtureCreator, ChemicalMixtureFromMZML
-from vimms.Common import ADDUCT_DICT_POS_MH, POSITIVE, set_log_level_warning, DEFAULT_SCAN_TIME_DICT
+from vimms.Common import ADDUCT_DICT_POS_MH, POSITIVE, set_log_level_warning, DEFAULT_SCAN_TIME_DICT, spawn_rngs
 from vimms.Controller import SimpleMs1Controller, TopNController
 from vimms.Environment import Environment
 from vimms.MassSpec import IndependentMassSpectrometer
-from vimms.Noise import NoPeakNoise
+from vimms.Noise import NoPeakNoise, GaussianPeakNoise
 from vimms.Roi import RoiParams
 from vimms.Utils import write_msp, mgf_to_database
 
@@ -70,6 +74,38 @@ class TestDatabaseCreation:
 
         check_chems(d)
 
+    def test_rng_streams(self):
+        ri = UniformRTAndIntensitySampler(min_rt=RT_RANGE[0][0], max_rt=RT_RANGE[0][1])
+        hf = UniformMZFormulaSampler(min_mz=MZ_RANGE[0][0], max_mz=MZ_RANGE[0][1])
+        cc = ChemicalMixtureCreator(hf, rt_and_intensity_sampler=ri)
+
+        def get_rts(d):
+            return [chem.rt for chem in d]
+
+        # the same seed gives the same chemicals, spawned generators give different ones
+        assert get_rts(cc.sample(N_CHEMS, 2, rng=1)) == get_rts(cc.sample(N_CHEMS, 2, rng=1))
+        first, second = spawn_rngs(42, 2)
+        d = cc.sample(N_CHEMS, 2, rng=first)
+        assert get_rts(d) != get_rts(cc.sample(N_CHEMS, 2, rng=second))
+        check_chems(d)
+
+        # without a generator, np.random.seed still controls sampling
+        np.random.seed(0)
+        expected = get_rts(cc.sample(N_CHEMS, 2))
+        np.random.seed(0)
+        assert get_rts(cc.sample(N_CHEMS, 2)) == expected
+
+        # runs with generators from the same seed are identical, regardless of the global random state
+        def run(rng):
+            mass_spec = IndependentMassSpectrometer(POSITIVE, d, intensity_noise=GaussianPeakNoise(100.0), rng=rng)
+            controller = TopNController(POSITIVE, 5, 1, 10, 15, 0)
+            np.random.seed(None)
+            Environment(mass_spec, controller, RT_RANGE[0][0], RT_RANGE[0][0] + 60, progress_bar=False).run()
+            return np.concatenate([scan.intensities for scan in controller.scans[1]])
+
+        assert np.array_equal(run(spawn_rngs(7, 1)[0]), run(spawn_rngs(7, 1)[0]))
+        assert not np.array_equal(run(spawn_rngs(7, 1)[0]), run(spawn_rngs(8, 1)[0]))
+
     def test_ms2_uniform(self):
 
         hf = DatabaseFormulaSampler(HMDB, min_mz=MZ_RANGE[0][0], max_mz=MZ_RANGE[0][1])
@@ -305,3 +341,69 @@ class TestScanTiming():
         env.run()
         filename = 'test_scan_time_mean_from_mzml.mzML'
         check_mzML(env, OUT_DIR, filename)
+
+
+class TestChromatograms():
+    def test_empirical_chromatogram_many(self):
+        for chem in BEER_CHEMS[:50]:
+            chrom = chem.chromatogram
+            query_rts = np.linspace(-1, chrom.max_rt + 1, 101)
+            intensities = chrom.get_relative_intensity_many(query_rts)
+            mzs = chrom.get_relative_mz_many(query_rts)
+            for rt, intensity, mz in zip(query_rts, intensities, mzs):
+                expected_intensity = chrom.get_relative_intensity(rt)
+                if expected_intensity is None:
+                    assert np.isnan(intensity) and np.isnan(mz)
+                else:
+                    assert intensity == expected_intensity
+                    assert mz == chrom.get_relative_mz(rt)
+
+    def test_empirical_chromatogram_pickle(self):
+        # the neighbours of the last query aren't kept when a chromatogram is pickled
+        chrom = BEER_CHEMS[0].chromatogram
+        state = pickle.dumps(chrom)
+        chrom.get_relative_intensity((chrom.min_rt + chrom.max_rt) / 2)
+        assert chrom._neighbours_cache is not None
+        assert pickle.dumps(chrom) == state
+        assert pickle.loads(state)._neighbours_cache is None
+
+    def test_chromatogram_bank(self):
+        chroms = [chem.chromatogram for chem in BEER_CHEMS]
+        bank = ChromatogramBank(chroms)
+        idx = np.repeat(np.arange(len(chroms)), 5)
+        query_rts = np.random.uniform(-1, 60, size=len(idx))
+        intensities, mzs, matched = bank.get_values(idx, query_rts)
+        for i, rt, intensity, mz, is_matched in zip(idx, query_rts, intensities, mzs, matched):
+            assert is_matched == chroms[i]._rt_match(rt)
+            if is_matched:
+                assert intensity == chroms[i].get_relative_intensity(rt)
+                assert mz == chroms[i].get_relative_mz(rt)
+
+    def test_functional_chromatogram_tabulated(self):
+        for distribution, parameters in [('normal', [0, 5]), ('gamma', [2, 0, 3]), ('uniform', [0, 10])]:
+            chrom = FunctionalChromatogram(distribution, parameters)
+            tabulated = FunctionalChromatogram(distribution, parameters, tabulate=True, max_error=1e-4)
+            query_rts = np.linspace(-1, chrom.max_rt + 1, 1001)
+            expected = np.array([np.nan if chrom.get_relative_intensity(rt) is None
+                                 else chrom.get_relative_intensity(rt) for rt in query_rts])
+            assert np.array_equal(chrom.get_relative_intensity_many(query_rts), expected, equal_nan=True)
+            assert np.allclose(tabulated.get_relative_intensity_many(query_rts), expected, atol=1e-4, equal_nan=True)
+
+        # a table that can't reach max_error within max_size points says so
+        chrom = FunctionalChromatogram('normal', [0, 5])
+        messages = []
+        sink_id = logger.add(messages.append, level='WARNING')
+        try:
+            chrom._tabulate(1.0, 1e-12, max_size=100)
+        finally:
+            logger.remove(sink_id)
+        assert len(chrom.table_rts) <= 100 and len(messages) == 1 and 'max_error' in messages[0]
+
+        chroms = [FunctionalChromatogram('normal', [0, sigma]) for sigma in np.random.uniform(1, 10, 100)]
+        bank = ChromatogramBank(chroms)
+        query_rts = np.random.uniform(-1, 60, size=len(chroms))
+        intensities, mzs, matched = bank.get_values(np.arange(len(chroms)), query_rts)
+        for chrom, rt, intensity, is_matched in zip(chroms, query_rts, intensities, matched):
+            assert is_matched == chrom._rt_match(rt)
+            if is_matched:
+                assert np.isclose(intensity, chrom.get_relative_intensity(rt))
@@ -1,5 +1,6 @@
 import os
 
+import numpy as np
 import pymzml
 from loguru import logger
 
@@ -11,7 +12,10 @@ from vimms.Chemicals import ChemicalMixtureCreator
 from vimms.Common import POSITIVE, set_log_level_warning, NEGATIVE, ScanParameters
 from vimms.Controller import TopNController, SimpleMs1Controller, WeightedDEWController, \
     AdvancedParams
+from vimms.Controller.topN import get_top_n
 from vimms.Environment import Environment
+from vimms.Exclusion import BoxHolder, ExclusionIndex, ExclusionItem, TopNExclusion, WeightedDEWExclusion, compute_weight, \
+    compute_weights
 from vimms.MassSpec import IndependentMassSpectrometer
 from vimms.Noise import GaussianPeakNoise
 
@@ -422,6 +426,92 @@ class TestExclusion:
         assert len(all_controllers[1].scans[2]) == 0
         assert len(all_controllers[2].scans[2]) == 0
 
+    def test_exclusion_many(self):
+        # overlapping windows fragmented at different times, checked at the window bounds and in between
+        items = [ExclusionItem(100.0, 100.2, 0, 30, 15), ExclusionItem(100.1, 100.3, 10, 40, 25),
+                 ExclusionItem(200.0, 200.1, 20, 50, 35), ExclusionItem(300.0, 300.1, 0, 10, 5)]
+        mzs = np.array([99.9, 100.0, 100.15, 100.25, 100.3, 100.31, 200.05, 300.05])
+        weighted = WeightedDEWExclusion(15, 5)
+        weighted.exclusion_list = items[:2]
+        weighted.add_items(items[2:])
+        assert weighted.exclusion_list == tuple(items)
+        for exclusion in [TopNExclusion(initial_exclusion_list=items), weighted]:
+            for rt in [5, 12, 22, 29, 35, 45, 60]:
+                excluded, weights = exclusion.is_excluded_many(mzs, rt)
+                expected = [exclusion.is_excluded(mz, rt) for mz in mzs]
+                assert excluded.tolist() == [is_exc for is_exc, _ in expected]
+                assert np.allclose(weights, [weight for _, weight in expected])
+
+        frag_ats = [None, 0, 10, 14, 20, 25]
+        for rt_tol, exclusion_t_0 in [(15, 5), (15, 15)]:
+            excluded, weights = compute_weights(20, np.array(frag_ats, dtype=float), rt_tol, exclusion_t_0)
+            expected = [compute_weight(20, frag_at, rt_tol, exclusion_t_0) for frag_at in frag_ats]
+            assert excluded.tolist() == [is_exc for is_exc, _ in expected]
+            assert np.allclose(weights, [weight for _, weight in expected])
+
+        values = np.array([5.0, 1.0, 4.0, 3.0, 2.0])
+        assert get_top_n(values, np.array([1, 2, 3, 4]), 2).tolist() == [2, 3]
+        assert get_top_n(values, np.array([1, 4]), 3).tolist() == [4, 1]
+        assert len(get_top_n(values, np.arange(5), 0)) == 0
+
+    def test_exclusion_index(self):
+        # random windows of different widths, some with the same from_mz, checked against a linear search
+        rng = np.random.default_rng(42)
+        items = []
+        for i in range(2000):
+            mz = rng.choice([150.0, 250.0]) if i % 10 == 0 else rng.uniform(100, 300)
+            width = rng.choice([0.001, 0.01, 0.5])
+            rt = rng.uniform(0, 100)
+            items.append(ExclusionItem(mz - width, mz + width, rt, rt + rng.uniform(1, 30), rt))
+        index = ExclusionIndex(items[:1000])
+        index.add(items[1000:])
+        mzs = np.concatenate([rng.uniform(100, 300, 100), [149.999, 150.0, 250.0]])
+        for rt in [0.5, 30, 60, 99]:
+            index.remove_expired(rt)
+            active = [x for x in items if x.to_rt > rt]
+            assert index.get_items() == active and len(index) == len(active)
+            # the search only goes as far as the widest live window, and expired windows are compacted away
+            assert index.max_width == max(x.to_mz - x.from_mz for x in active)
+            assert len(index.items) < 2 * len(active) + 1
+            mz_idx, positions = index.find_many(mzs, rt)
+            for i, mz in enumerate(mzs):
+                expected = [x for x in active if x.peak_in(mz, rt)]
+                assert sorted(index.items[index.find(mz, rt)].tolist(), key=id) == sorted(expected, key=id)
+                assert sorted(index.items[positions[mz_idx == i]].tolist(), key=id) == sorted(expected, key=id)
+
+        # one wide window stops widening the search once it expires
+        index = ExclusionIndex([ExclusionItem(199.5, 200.5, 0, 10, 0)] +
+                               [ExclusionItem(mz - 0.001, mz + 0.001, 0, 100, 0) for mz in np.linspace(199, 201, 50)])
+        assert np.isclose(index.max_width, 1.0)
+        index.remove_expired(10)
+        assert np.isclose(index.max_width, 0.002) and len(index) == 50
+
+    def test_box_holder(self):
+        # narrow boxes and a few wide ones, bulk loaded and then added one at a time so some aren't in the grid yet
+        rng = np.random.default_rng(42)
+        boxes = []
+        for i in range(3000):
+            mz, rt = rng.uniform(100, 1000), rng.uniform(0, 1000)
+            width = (50, 300) if i % 100 == 0 else (mz * 1e-5, 30)
+            boxes.append(ExclusionItem(mz - width[0], mz + width[0], rt - width[1], rt + width[1], rt))
+        box_holder = BoxHolder(boxes[:2000], max_pending=500)
+        for box in boxes[2000:]:
+            box_holder.add_box(box)
+        assert 0 < box_holder.num_built < len(box_holder)
+
+        mzs = np.concatenate([rng.uniform(90, 1010, 200), [(x.from_mz + x.to_mz) / 2 for x in boxes[:200]]])
+        rts = np.concatenate([rng.uniform(-10, 1010, 200), [x.frag_at for x in boxes[:200]]])
+        point_idx, box_idx = box_holder.check_points(mzs, rts)
+        found = set(zip(point_idx.tolist(), box_idx.tolist()))
+        expected = set((i, j) for i in range(len(mzs)) for j, x in enumerate(boxes) if x.peak_in(mzs[i], rts[i]))
+        assert found == expected
+        for i in range(0, len(mzs), 20):
+            matches = [x for x in boxes if x.peak_in(mzs[i], rts[i])]
+            assert box_holder.check_point_2(mzs[i], rts[i]) == matches
+            assert box_holder.check_point(mzs[i], rts[i]) == set(matches)
+            assert box_holder.is_in_box(mzs[i], rts[i]) == (len(matches) > 0)
+        assert box_holder.is_in_box_many(mzs, 500).tolist() == [box_holder.is_in_box(mz, 500) for mz in mzs]
+
 
 class TestTopNShiftedController:
     """
@@ -1,3 +1,4 @@
+import numpy as np
 from loguru import logger
 
 from tests.conftest import N_CHEMS, MIN_MS1_INTENSITY, get_rt_bounds, CENTRE_RANGE, run_environment, \
@@ -7,8 +8,10 @@ from vimms.Common import POSITIVE, ROI_EXCLUSION_WEIGHTED_DEW
 from vimms.Controller import TopN_RoiController, TopN_SmartRoiController, NonOverlapController, \
     IntensityNonOverlapController, FlexibleNonOverlapController, RoiBuilder
 from vimms.Environment import Environment
+from vimms.Exclusion import ScoreCandidates, CompositeFilter, MinIntensityFilter, DEWFilter, WeightedDEWFilter, \
+    LengthFilter, SmartROIFilter
 from vimms.GridEstimator import GridEstimator
-from vimms.MassSpec import IndependentMassSpectrometer
+from vimms.MassSpec import IndependentMassSpectrometer, Scan
 
 
 class TestROIController:
@@ -77,6 +80,81 @@ class TestROIController:
         check_mzML(env, OUT_DIR, filename)
 
 
+class TestRoiBuilder:
+    def test_peak_assignment(self):
+        # mz_tol of 10 ppm, ROIs need 2 points to be kept
+        roi_builder = RoiBuilder(10, 15, 100, 2)
+        roi_builder.update_roi(Scan(1, np.array([200.0, 300.0, 400.0]), np.array([1000.0, 1000.0, 50.0]), 1, 1.0))
+        assert [roi.mz_list for roi in roi_builder.live_roi] == [[200.0], [300.0]]
+
+        # two peaks near the 200 ROI both extend it, in scan order, rather than starting a near-duplicate ROI, and
+        # the 300 ROI ends
+        roi_builder.update_roi(Scan(2, np.array([199.999, 200.0005, 500.0]), np.array([10.0, 20.0, 30.0]) * 100, 1,
+                                    2.0))
+        assert [roi.mz_list for roi in roi_builder.live_roi] == [[200.0, 199.999, 200.0005], [500.0]]
+        assert [roi.mz_list for roi in roi_builder.junk_roi] == [[300.0]]
+        assert roi_builder.current_roi_ids.tolist() == [roi.id for roi in roi_builder.live_roi] == [0, 2]
+        assert roi_builder.current_roi_mzs.tolist() == [200.0005, 500.0]
+        assert roi_builder.current_roi_intensities.tolist() == [2000.0, 3000.0]
+        assert roi_builder.current_roi_length.tolist() == [3, 1]
+        assert roi_builder.live_mz_sums.tolist() == [roi.mz_sum for roi in roi_builder.live_roi]
+
+        roi_builder.set_fragmented(10, 0, 0, 2.0, 2000.0)
+        assert roi_builder.live_roi_fragmented.tolist() == [True, False]
+
+        # the fragmented ROI ends and is kept, and its state isn't given to the ROIs that are left
+        roi_builder.update_roi(Scan(3, np.array([300.0, 500.001]), np.array([1000.0, 1000.0]), 1, 3.0))
+        assert [roi.mz_list for roi in roi_builder.dead_roi] == [[200.0, 199.999, 200.0005]]
+        assert roi_builder.live_roi_fragmented.tolist() == [False, False]
+        assert np.isnan(roi_builder.live_roi_last_rt).all()
+        assert roi_builder.current_roi_length.tolist() == [1, 2]
+
+    def test_close_peaks_in_new_roi(self):
+        # close peaks that don't match a live ROI start one ROI between them rather than near-duplicate ROIs
+        roi_builder = RoiBuilder(10, 15, 0, 0)
+        roi_builder.update_roi(Scan(1, np.array([500.0, 500.0015, 600.0]), np.array([20.0, 10.0, 30.0]), 1, 1.0))
+        assert [roi.mz_list for roi in roi_builder.live_roi] == [[500.0, 500.0015], [600.0]]
+        assert roi_builder.current_roi_ids.tolist() == [0, 1]
+        assert roi_builder.current_roi_mzs.tolist() == [500.0015, 600.0]
+        assert roi_builder.current_roi_intensities.tolist() == [10.0, 30.0]
+        assert roi_builder.current_roi_length.tolist() == [2, 1]
+        assert roi_builder.live_mz_sums.tolist() == [roi.mz_sum for roi in roi_builder.live_roi]
+
+        roi_builder.update_roi(Scan(2, np.array([500.0, 500.0015]), np.array([10.0, 20.0]), 1, 2.0))
+        assert [(roi.id, roi.n) for roi in roi_builder.get_rois()] == [(0, 4), (1, 1)]
+        assert np.isclose(roi_builder.get_rois()[0].get_mean_mz(), 500.00075)
+
+
+class TestScoreFilters:
+    def test_filters_on_candidates(self):
+        # the batch interface gives the same results as the per-attribute one, and filters compose by multiplying
+        intensities = [100, 5000, 20000, 1e6, 3000]
+        last_frag_rts = [None, 90, 99, None, 70]
+        roi_lengths = [1, 3, 5, 2, 4]
+        can_fragment = [True, False, True, True, True]
+        candidates = ScoreCandidates(100, intensities=intensities, last_frag_rts=last_frag_rts,
+                                     roi_lengths=roi_lengths, can_fragment=can_fragment)
+        filters = [MinIntensityFilter(1000), DEWFilter(15), WeightedDEWFilter(15, 5), LengthFilter(2),
+                   SmartROIFilter()]
+        expected = [filters[0].filter(intensities), filters[1].filter(100, last_frag_rts),
+                    filters[2].filter(100, last_frag_rts), filters[3].filter(np.array(roi_lengths)),
+                    np.array(can_fragment)]
+        for f, e in zip(filters, expected):
+            assert np.allclose(f.apply(candidates), e)
+
+        mask = CompositeFilter([filters[0], filters[1], filters[3]]).apply(candidates)
+        assert mask.dtype == bool
+        assert mask.tolist() == [False, False, False, True, True]
+        weights = CompositeFilter([filters[0], filters[2], filters[4]]).apply(candidates)
+        assert np.allclose(weights, [0, 0, 0, 1, 1])
+        assert np.allclose(filters[2].apply(candidates), [1, 0.5, 0, 1, 1])
+
+        # normal ROIs have no can_fragment, and the SmartROI filter passes all of them
+        normal = ScoreCandidates(100, intensities=intensities, last_frag_rts=last_frag_rts, roi_lengths=roi_lengths)
+        assert SmartROIFilter().apply(normal).tolist() == [True] * 5
+        assert np.array_equal(CompositeFilter([filters[0], SmartROIFilter()]).apply(normal), filters[0].apply(normal))
+
+
 class TestSMARTROIController:
     """
     Tests the ROI controller that performs fragmentations and dynamic exclusions based on selecting regions of interests
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+
+from tests.conftest import MIN_MS1_INTENSITY, BEER_CHEMS, BEER_MIN_BOUND, BEER_MAX_BOUND
+from vimms.Common import POSITIVE, ScanParameters
+from vimms.Controller import TopNController, SimpleMs1Controller
+from vimms.ExperimentRunner import ExperimentRunner, ExperimentJob, JobTimeoutError
+from vimms.Noise import GaussianPeakNoise
+from vimms.ResultCache import ResultCache, get_digest
+
+
+def summarise_ms2_scans(env):
+    scans = env.controller.scans[2]
+    return {
+        'n_scans': len(scans),
+        'precursor_mzs': np.array([s.scan_params.get(ScanParameters.PRECURSOR_MZ)[0].precursor_mz for s in scans])
+    }
+
+
+class TestExperimentRunner:
+    def test_parallel_jobs(self):
+        jobs = [ExperimentJob('N=%d' % n, 'beer', TopNController(POSITIVE, n, 1, 10, 15, MIN_MS1_INTENSITY),
+                              BEER_MIN_BOUND, BEER_MIN_BOUND + 10) for n in [1, 3]]
+        runner = ExperimentRunner({'beer': BEER_CHEMS}, max_workers=2)
+        results = runner.run_all(jobs)
+        assert [result.job for result in results] == jobs
+        for result in results:
+            assert not result.failed and len(result.result.controller.scans[2]) > 0
+            # chemicals are not copied back from the workers
+            assert result.result.mass_spec.chemicals is BEER_CHEMS
+
+        job = ExperimentJob('slow', 'beer', TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY),
+                            BEER_MIN_BOUND, BEER_MAX_BOUND)
+        result = ExperimentRunner({'beer': BEER_CHEMS}, max_workers=1, timeout=0.01).run_all([job])[0]
+        assert result.failed and isinstance(result.error, JobTimeoutError)
+
+    def test_unseeded_jobs(self):
+        # jobs without a seed are given different random streams, although forked workers inherit the same state
+        jobs = [ExperimentJob('job %d' % i, 'beer', SimpleMs1Controller(), BEER_MIN_BOUND, BEER_MIN_BOUND + 5,
+                              mass_spec_params={'intensity_noise': GaussianPeakNoise(1000)}) for i in range(2)]
+        results = ExperimentRunner({'beer': BEER_CHEMS}, max_workers=2).run_all(jobs)
+        scans = [result.result.controller.scans[1] for result in results]
+        assert len(scans[0]) == len(scans[1]) > 0 and scans[0][0].num_peaks > 0
+        assert not np.array_equal(scans[0][0].intensities, scans[1][0].intensities)
+
+
+class TestResultCache:
+    def test_result_cache(self, tmp_path):
+        def make_jobs():
+            return [ExperimentJob('N=%d' % n, 0, TopNController(POSITIVE, n, 1, 10, 15, MIN_MS1_INTENSITY),
+                                  BEER_MIN_BOUND, BEER_MIN_BOUND + 10, evaluate=summarise_ms2_scans, seed=42)
+                    for n in [1, 3]]
+
+        cache = ResultCache(str(tmp_path / 'cache'), verify_fraction=1.0)
+        runner = ExperimentRunner([BEER_CHEMS], max_workers=1, cache=cache)
+        first = runner.run_all(make_jobs())
+        assert not any(result.cached for result in first) and len(cache) == 2 and cache.misses == 2
+
+        # hits are recomputed in verification mode, and match because the jobs are seeded
+        second = runner.run_all(make_jobs())
+        assert cache.hits == 2 and cache.verified == 2 and cache.mismatches == 0
+        assert get_digest(first[0].result) == get_digest(second[0].result)
+
+        cache.verify_fraction = 0.0
+        third = runner.run_all(make_jobs())
+        assert all(result.cached for result in third)
+        assert np.array_equal(third[1].result['precursor_mzs'], first[1].result['precursor_mzs'])
+
+        # least recently used entries are evicted first
+        cache.max_entries = 1
+        cache.get(third[0].job.get_cache_key(cache, [BEER_CHEMS]))
+        cache.evict()
+        assert len(cache) == 1 and third[0].job.get_cache_key(cache, [BEER_CHEMS]) in cache
+
+        # entries used one right after the other are still evicted in the order they were used
+        lru_cache = ResultCache(str(tmp_path / 'lru'))
+        for key in ['a', 'b', 'c']:
+            lru_cache.put(key, {})
+        lru_cache.get('a')
+        lru_cache.max_entries = 2
+        lru_cache.evict()
+        assert 'a' in lru_cache and 'b' not in lru_cache and 'c' in lru_cache
+
+        # querying chromatograms doesn't change the key of a dataset
+        chems = BEER_CHEMS[:20]
+        digest = get_digest(chems)
+        for chem in chems:
+            chem.chromatogram.get_relative_intensity(chem.chromatogram.max_rt / 2)
+        assert get_digest(chems) == digest
+
+        entry = cache.put('events', {'n_scans': 1}, events={'rt': np.array([1.0, 2.0])}, mzml_path='run.mzML')
+        assert np.array_equal(cache.get('events').load_events()['rt'], [1.0, 2.0])
+        assert entry.mzml_path == os.path.abspath('run.mzML') and len(cache) == 1
@@ -1,6 +1,13 @@
 # some other more general tests
+import os
 
+import pytest
+
+from tests.conftest import BEER_CHEMS, BEER_MIN_BOUND
 from vimms.Chemicals import Formula
+from vimms.Common import POSITIVE
+from vimms.Executors import get_executor, EXECUTORS
+from vimms.InSilicoSimulation import run_WeightedDEW
 
 
 class TestFormula:
@@ -15,3 +22,25 @@ class TestFormula:
         assert f.atoms['C'] == 13
         assert f.atoms['H'] == 2
         assert f.atoms['O'] == 1
+
+
+class TestExecutors:
+    def test_executors(self, tmp_path):
+        items = list(range(-20, 20))
+        for name in ['serial', 'threads', 'processes']:
+            for chunksize in [1, 'auto', 7]:
+                assert get_executor(name, max_workers=2, chunksize=chunksize).map(abs, items) == list(map(abs, items))
+        executor = get_executor('serial')
+        assert get_executor(executor) is executor
+        with pytest.raises(ValueError):
+            get_executor('cluster')
+        assert 'ipyparallel' in EXECUTORS
+
+        params = {'controller_name': 'WeightedDEW', 'ionisation_mode': POSITIVE, 'sample_name': 'beer',
+                  'isolation_width': 1, 'N': 10, 'mz_tol': 10, 'min_ms1_intensity': 5000,
+                  'min_rt': BEER_MIN_BOUND, 'max_rt': BEER_MIN_BOUND + 10, 't0_values': [1, 30],
+                  'rt_tol_values': [15]}
+        run_WeightedDEW(BEER_CHEMS, {1: 0.6, 2: 0.2}, params, str(tmp_path), executor='processes', max_workers=2,
+                        chunksize='auto')
+        # t0 = 30 > rt_tol = 15 is skipped
+        assert sorted(os.listdir(tmp_path)) == ['WeightedDEW_beer_1_15.mzml']
@@ -1,11 +1,26 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pytest
+import scipy.stats
 from loguru import logger
+from mass_spec_utils.data_import.mzml import MZMLFile
 
 from tests.conftest import MIN_MS1_INTENSITY, check_non_empty_MS2, check_mzML, OUT_DIR, BEER_CHEMS, BEER_MIN_BOUND, \
     BEER_MAX_BOUND
-from vimms.Common import POSITIVE
-from vimms.Controller import TopNController
+from vimms.Checkpoint import save_checkpoint, load_checkpoint
+from vimms.Common import POSITIVE, get_default_scan_params, INITIAL_SCAN_ID, get_rng
+from vimms.Controller import TopNController, TopN_SmartRoiController
 from vimms.Environment import Environment
+from vimms.Evaluation import evaluate_simulated_env
+from vimms.FragmentationEvents import ColumnarEventSink, ChunkedDiskEventSink, NullEventSink
+from vimms.IsolationWindows import IsolationWindowSet, gaussian_transition
 from vimms.MassSpec import IndependentMassSpectrometer, TaskManager
+from vimms.MzmlWriter import StreamingMzmlWriter
+from vimms.Noise import GaussianPeakNoise, GaussianPeakNoiseLevelSpecific, NoPeakNoise, UniformSpikeNoise, \
+    get_array_noise
 
 
 class TestSimulatedMassSpec:
@@ -36,4 +51,408 @@ class TestSimulatedMassSpec:
 
         # write simulated output to mzML file
         filename = 'test_mass_spec.mzML'
-        check_mzML(env, OUT_DIR, filename)
\ No newline at end of file
+        check_mzML(env, OUT_DIR, filename)
+
+    def test_streaming_mzml(self):
+        logger.info('Testing writing mzML while the environment runs')
+
+        mzml_files = []
+        for stream_mzml in [False, True]:
+            mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS)
+            controller = TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY)
+            filename = 'test_mass_spec_stream_%s.mzML' % stream_mzml
+            env = Environment(mass_spec, controller, 200, 300, progress_bar=False, out_dir=OUT_DIR,
+                              out_file=filename, stream_mzml=stream_mzml, keep_scans=not stream_mzml)
+            env.run()
+            mzml_files.append(MZMLFile(os.path.join(OUT_DIR, filename)))
+        assert len(controller.scans) == 0
+
+        expected, streamed = mzml_files
+        assert len(streamed.scans) == len(expected.scans) > 0
+        for scan, other in zip(streamed.scans, expected.scans):
+            assert scan.scan_no == other.scan_no and scan.ms_level == other.ms_level
+            assert scan.rt_in_seconds == other.rt_in_seconds and np.array_equal(scan.peaks, other.peaks)
+
+        # the file is left alone if it isn't the one the writer started
+        broken_file = os.path.join(OUT_DIR, 'test_mass_spec_stream_broken.mzML')
+        with open(broken_file, 'w') as f:
+            f.write('<mzML></mzML>')
+        with pytest.raises(ValueError):
+            StreamingMzmlWriter('broken', broken_file)._write_spectrum_count()
+
+    def test_scan_peaks(self):
+        mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS)
+        scan = mass_spec._get_scan(300, get_default_scan_params())
+        assert scan.num_peaks > 0 and np.all(np.diff(scan.mzs) >= 0)
+        assert scan.mzs.dtype == np.float64 and scan.mzs.flags['C_CONTIGUOUS']
+
+        # peaks are only created when asked for, and every peak knows the chemical that produced it
+        assert scan._peaks is None
+        assert [peak.mz for peak in scan.peaks] == scan.mzs.tolist()
+        store = mass_spec.chemical_store
+        for mz, chem_idx in zip(scan.mzs, scan.chem_idx):
+            signal_mzs = store.signal_mzs[store.signal_offsets[chem_idx]:store.signal_offsets[chem_idx + 1]]
+            assert np.min(np.abs(signal_mzs - mz)) < 1
+
+        copy = pickle.loads(pickle.dumps(scan))
+        assert copy._peaks is None and copy.rt == scan.rt
+        assert np.array_equal(copy.mzs, scan.mzs) and np.array_equal(copy.chem_idx, scan.chem_idx)
+
+    def test_stage_timing(self, tmp_path):
+        mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS)
+        controller = TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY)
+        env = Environment(mass_spec, controller, BEER_MIN_BOUND, BEER_MIN_BOUND + 20, progress_bar=False,
+                          timing=True, out_dir=str(tmp_path), out_file='timing.mzML')
+        env.run()
+
+        summary = env.timer.summary()
+        stages = set(summary['stage'])
+        assert {'chemical lookup', 'peak generation', 'controller', 'exclusion update', 'mzml writing'} <= stages
+        n_scans = sum(len(scans) for scans in controller.scans.values())
+        assert summary.set_index('stage').loc['peak generation', 'count'] == n_scans
+
+        trace = env.timer.to_chrome_trace(str(tmp_path / 'trace.json'))
+        assert len(trace['traceEvents']) == len(env.timer)
+        with open(tmp_path / 'trace.json') as f:
+            assert json.load(f)['traceEvents'][0]['ph'] == 'X'
+
+        # timing is off by default
+        assert not Environment(mass_spec, controller, 0, 1, progress_bar=False).timer.enabled
+
+    def test_checkpoint_resume(self, tmp_path):
+        def run(checkpoint_path=None):
+            np.random.seed(42)
+            mass_spec = InterruptedMassSpectrometer(POSITIVE, BEER_CHEMS, intensity_noise=GaussianPeakNoise(1000))
+            controller = TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY)
+            env = Environment(mass_spec, controller, BEER_MIN_BOUND, BEER_MIN_BOUND + 30, progress_bar=False,
+                              checkpoint_path=checkpoint_path, checkpoint_interval=0)
+            env.run()
+            return env
+
+        expected = run()
+        checkpoint_path = str(tmp_path / 'run.ckpt')
+        InterruptedMassSpectrometer.interrupt_scan_id = INITIAL_SCAN_ID + 50
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                run(checkpoint_path)
+        finally:
+            InterruptedMassSpectrometer.interrupt_scan_id = None
+
+        # the resumed run continues from the last checkpoint, with the same random state
+        np.random.seed(0)
+        env = Environment.resume(checkpoint_path, progress_bar=False)
+        for ms_level in [1, 2]:
+            scans, expected_scans = env.controller.scans[ms_level], expected.controller.scans[ms_level]
+            assert [s.scan_id for s in scans] == [s.scan_id for s in expected_scans]
+            assert all(np.array_equal(s.intensities, e.intensities) for s, e in zip(scans, expected_scans))
+
+        with pytest.raises(ValueError):
+            Environment(env.mass_spec, env.controller, 0, 1, stream_mzml=True, checkpoint_path=checkpoint_path)
+
+    def test_checkpoint_in_band(self, tmp_path, monkeypatch):
+        # on Python versions without protocol 5 the arrays are pickled in-band, in the same file format
+        obj = {'mzs': np.arange(10.0), 'name': 'scan'}
+        monkeypatch.setattr(pickle, 'HIGHEST_PROTOCOL', 4)
+        save_checkpoint(obj, str(tmp_path / 'in_band.ckpt'))
+        loaded = load_checkpoint(str(tmp_path / 'in_band.ckpt'))
+        assert np.array_equal(loaded['mzs'], obj['mzs']) and loaded['name'] == 'scan'
+
+    def test_fast_forward(self):
+        late_chems = [chem for chem in BEER_CHEMS if chem.rt + chem.chromatogram.min_rt > 500]
+        first_rt = np.min(IndependentMassSpectrometer(POSITIVE, late_chems).chrom_min_rts)
+        controllers = {
+            'topn': lambda: TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY),
+            'smart_roi': lambda: TopN_SmartRoiController(POSITIVE, 1, 10, MIN_MS1_INTENSITY, 500, 2, 10)
+        }
+        for name, make_controller in controllers.items():
+            envs = []
+            for fast_forward in [False, True]:
+                np.random.seed(0)
+                mass_spec = IndependentMassSpectrometer(POSITIVE, late_chems, intensity_noise=GaussianPeakNoise(1000))
+                env = Environment(mass_spec, make_controller(), 0, first_rt + 30, progress_bar=False,
+                                  fast_forward=fast_forward)
+                env.run()
+                envs.append(env)
+            scans, fast_scans = envs[0].controller.scans, envs[1].controller.scans
+            assert all(scan.num_peaks == 0 for scan in scans[1] if scan.rt < first_rt)
+            if name == 'topn':
+                # the empty scans are skipped, apart from the initial one, but the same chemicals are fragmented
+                assert [scan.rt for scan in fast_scans[1][:2]] == [0, first_rt]
+                assert len(fast_scans[2]) == len(scans[2]) > 0
+            else:  # not stateless, so every scan is made
+                assert [scan.rt for scan in fast_scans[1]] == [scan.rt for scan in scans[1]]
+
+    def test_fast_forward_spike_noise(self):
+        late_chems = [chem for chem in BEER_CHEMS if chem.rt + chem.chromatogram.min_rt > 500]
+        first_rt = np.min(IndependentMassSpectrometer(POSITIVE, late_chems).chrom_min_rts)
+        envs = []
+        for fast_forward in [False, True]:
+            np.random.seed(0)
+            mass_spec = IndependentMassSpectrometer(POSITIVE, late_chems, spike_noise=UniformSpikeNoise(0.01, 1000))
+            controller = TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY)
+            env = Environment(mass_spec, controller, 0, first_rt + 30, progress_bar=False, fast_forward=fast_forward)
+            env.run()
+            envs.append(env)
+        # the noise-only scans before the first chemical elutes are still made
+        scans, fast_scans = envs[0].controller.scans, envs[1].controller.scans
+        assert [scan.rt for scan in fast_scans[1]] == [scan.rt for scan in scans[1]]
+        assert all(scan.num_peaks > 0 for scan in fast_scans[1])
+        assert [scan.num_peaks for scan in fast_scans[2]] == [scan.num_peaks for scan in scans[2]]
+
+
+class InterruptedMassSpectrometer(IndependentMassSpectrometer):
+    # a mass spec that stops the run when a scan is made, as if the run was killed
+    interrupt_scan_id = None
+
+    def _get_scan(self, scan_time, params):
+        if self.idx == self.interrupt_scan_id:
+            raise KeyboardInterrupt()
+        return super()._get_scan(scan_time, params)
+
+
+class TestChemicalStore:
+    """
+    Tests that batched MS1 scan generation from the columnar chemical store matches the per-chemical code path.
+    """
+
+    def test_batched_ms1_peaks(self, fragscan_dataset):
+        params = get_default_scan_params()
+        min_mz, max_mz = params.get('first_mass'), params.get('last_mass')
+        isolation_windows = params.get('isolation_windows')
+        for chems in [fragscan_dataset, BEER_CHEMS]:
+            mass_spec = IndependentMassSpectrometer(POSITIVE, chems)
+            for rt in range(0, 1200, 50):
+                idx = mass_spec._get_chem_indices(rt)
+                batched = mass_spec._get_ms1_peaks(idx, rt, params, 0, isolation_windows, min_mz, max_mz)
+                expected = [(i, peak[0], peak[1]) for i in idx
+                            for peak in mass_spec._get_all_mz_peaks(chems[i], rt, 1, isolation_windows,
+                                                                    add_noise=False) or []
+                            if min_mz <= peak[0] <= max_mz and peak[1] > 0]
+                assert batched[2].tolist() == [e[0] for e in expected]
+                assert np.array_equal(batched[0], [e[1] for e in expected])
+                assert np.array_equal(batched[1], [e[2] for e in expected])
+
+    def test_fragment_tables(self, fragscan_dataset):
+        # MS2 peaks from the compiled fragment tables match the recursive per-chemical code path
+        for chems in [fragscan_dataset, BEER_CHEMS]:
+            for transition, transition_params in [('rectangular', None), ('gaussian', [0.5])]:
+                mass_spec = IndependentMassSpectrometer(POSITIVE, chems, isolation_transition_window=transition,
+                                                        isolation_transition_window_params=transition_params)
+                store = mass_spec.chemical_store
+                for rt in range(0, 1200, 100):
+                    idx = mass_spec._get_chem_indices(rt)
+                    rel_intensities, rel_mzs, matched = store.get_chromatogram_values(idx, rt)
+                    for k, i in enumerate(idx[:20]):
+                        chem = chems[i]
+                        mz = chem.isotopes[0][0]
+                        isolation_windows = [[(mz - 0.5, mz + 2.0)]]
+                        expected = mass_spec._get_all_mz_peaks(chem, rt, 2, isolation_windows, add_noise=False)
+                        peaks = mass_spec._get_fragment_peaks(i, rel_intensities[k], rel_mzs[k], 2,
+                                                              isolation_windows) if matched[k] else None
+                        if expected is None:
+                            assert peaks is None
+                            continue
+                        assert len(peaks) == len(expected)
+                        for peak, expected_peak in zip(peaks, expected):
+                            assert np.allclose(peak[:3], expected_peak[:3], rtol=1e-12)
+                            assert peak[3:] == expected_peak[3:]
+
+    def test_elution_index(self):
+        mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS)
+        index = mass_spec.chemical_store.elution_index
+        # increasing times use the sweep, the later decreasing ones reset it
+        query_rts = list(np.arange(0, 1500, 0.37)) + [900, 900, 10, 600.5, 0]
+        for rt in query_rts:
+            expected = np.nonzero((index.min_rts <= rt) & (rt <= index.max_rts))[0]
+            assert np.array_equal(mass_spec._get_chem_indices(rt), expected)
+
+        # the end of the time when nothing elutes
+        late_chems = [chem for chem in BEER_CHEMS if chem.rt + chem.chromatogram.min_rt > 500]
+        index = IndependentMassSpectrometer(POSITIVE, late_chems).chemical_store.elution_index
+        assert index.get_empty_until(100) == np.min(index.min_rts)
+        assert index.get_empty_until(np.max(index.max_rts) + 1) == np.inf
+        rt = index.min_rts[0]
+        assert index.get_empty_until(rt) == rt
+
+
+class TestIsolationWindows:
+    def test_window_matching(self, fragscan_dataset):
+        # overlapping, touching, empty and unsorted windows, and m/z values on the window bounds
+        windows = [(300, 350), (100, 200), (150, 250), (250, 260), (500, 500), (400, 450.5)]
+        mzs = np.concatenate([np.linspace(0, 600, 1201), [100, 200, 250, 260, 400, 450.5]])
+        expected = np.array([any(w[0] < mz <= w[1] for w in windows) for mz in mzs])
+        window_set = IsolationWindowSet(windows)
+        assert np.array_equal(window_set.contains(mzs), expected)
+        assert np.array_equal(window_set.contains(mzs[:1200].reshape(-1, 3)), expected[:1200].reshape(-1, 3))
+        assert not np.any(IsolationWindowSet([]).contains(mzs))
+
+        weights = window_set.get_transmission(mzs, 'gaussian', [10.0])
+        assert np.allclose(weights[expected], gaussian_transition(mzs[expected] - 325.0, 10.0))
+        assert np.all(weights[~expected] == 0)
+        assert np.isclose(gaussian_transition(3.0, 2.0), scipy.stats.norm(0, 2.0).pdf(3.0) /
+                          scipy.stats.norm(0, 2.0).pdf(0))
+
+        # chemicals with any isotope/adduct in the windows, found for all chemicals at once
+        mass_spec = IndependentMassSpectrometer(POSITIVE, fragscan_dataset)
+        idx = mass_spec._get_chem_indices(500)
+        _, relative_mzs, _ = mass_spec.chemical_store.get_chromatogram_values(idx, 500)
+        isolated = mass_spec.chemical_store.get_isolated(idx, relative_mzs, window_set)
+        for k, i in enumerate(idx):
+            chem = fragscan_dataset[i]
+            expected = any(mass_spec._isolation_match(chem, 500, windows, which_isotope, which_adduct)
+                           for which_isotope in range(len(chem.isotopes))
+                           for which_adduct in range(len(mass_spec._get_adducts(chem))))
+            assert isolated[k] == expected
+
+
+class TestFragmentationEvents:
+    """
+    Tests the different sinks for fragmentation events
+    """
+
+    def _run_top_n(self, chems, event_sink):
+        mass_spec = IndependentMassSpectrometer(POSITIVE, chems, event_sink=event_sink)
+        controller = TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY)
+        env = Environment(mass_spec, controller, 0, 600, progress_bar=False)
+        env.run()
+        return env
+
+    def test_event_sinks(self, fragscan_dataset, tmp_path):
+        env = self._run_top_n(fragscan_dataset, None)
+        events = list(env.mass_spec.fragmentation_events)
+        columns = env.mass_spec.fragmentation_events.get_columns()
+        assert len(events) == len(columns['chem_idx'])
+        assert [fragscan_dataset[i] for i in columns['chem_idx']] == [event.chem for event in events]
+
+        # coverage computed from the columns matches the one computed from the ScanEvent objects
+        expected = {}
+        for event in events:
+            if event.ms_level > 1:
+                chem = event.chem.get_original_parent()
+                expected[chem] = max(event.parents_intensity[0], expected.get(chem, 0))
+        assert len(expected) > 0
+        results = evaluate_simulated_env(env)
+        assert results['fragmented'] == expected
+        assert list(results['fragmented']) == list(expected)
+        assert results['num_frags'] == sum(1 for event in events if event.ms_level > 1)
+
+        for sink in [ColumnarEventSink(initial_capacity=16), ChunkedDiskEventSink(str(tmp_path), chunk_size=100)]:
+            other_env = self._run_top_n(fragscan_dataset, sink)
+            other_columns = sink.get_columns()
+            for name in columns:
+                assert np.array_equal(columns[name], other_columns[name], equal_nan=True)
+            assert evaluate_simulated_env(other_env)['fragmented'] == expected
+        assert len(sink.chunk_files) > 1
+
+        # a sink that made its own temporary directory keeps the events there after the run rather than in memory,
+        # copies of it get their own directory, and cleanup removes it
+        sink = ChunkedDiskEventSink(chunk_size=100)
+        out_dir = sink.out_dir
+        self._run_top_n(fragscan_dataset, sink)
+        assert len(sink) == len(events) and sink.size == 0 and len(os.listdir(out_dir)) == len(sink.chunk_files)
+        assert np.array_equal(sink.get_columns()['scan_id'], columns['scan_id'])
+        sink_copy = pickle.loads(pickle.dumps(sink))
+        assert sink_copy.out_dir != out_dir and len(sink_copy) == len(events) and sink_copy.size == 0
+        assert np.array_equal(sink_copy.get_columns()['scan_id'], columns['scan_id'])
+        sink.cleanup()
+        assert not os.path.exists(out_dir) and len(sink) == 0
+        copy_dir = sink_copy.out_dir
+        del sink_copy
+        assert not os.path.exists(copy_dir)
+
+        sink = NullEventSink()
+        self._run_top_n(fragscan_dataset, sink)
+        assert len(sink) == 0
+
+
+class DoubleIntensityNoise(object):
+    # a custom noise class that only implements get
+    def get(self, original, ms_level):
+        return original * 2
+
+
+class UniformShiftNoise(NoPeakNoise):
+    # a custom noise subclass that only overrides get, drawing from the generator it is given
+    def get(self, original, ms_level, rng=None):
+        return original + get_rng(rng).uniform()
+
+
+class ConstantGaussianNoise(GaussianPeakNoise):
+    # a Gaussian noise subclass that only overrides get
+    def get(self, original, ms_level, rng=None):
+        return original + self.sigma
+
+
+class NegatedLevelNoise(GaussianPeakNoiseLevelSpecific):
+    # a level specific Gaussian noise subclass that only overrides get
+    def get(self, original, ms_level, rng=None):
+        return -original
+
+
+class ArrayOnlyRngNoise(object):
+    # a custom noise class whose apply takes a generator but whose get doesn't
+    def get(self, original, ms_level):
+        return original
+
+    def apply(self, values, ms_level, rng=None):
+        return values + get_rng(rng).uniform(size=len(values))
+
+
+class FixedSpikeNoise(object):
+    # a custom spike noise class written before sample took a generator
+    def sample(self, min_measurement_mz, max_measurement_mz):
+        return [min_measurement_mz + 1.0], [1000.0]
+
+
+class FixedScanTimeSampler(object):
+    # a custom scan time sampler written before sample_time took a generator
+    def sample_time(self, current_level, next_level):
+        return 0.5 if current_level == 1 else 0.2
+
+
+class TestNoise:
+    def test_array_noise(self):
+        values = np.array([0.1, 100.0, 1000.0])
+        assert np.all(GaussianPeakNoise(1.0).apply(values, 1) >= 0)
+        assert np.all(GaussianPeakNoise(0.1, log_space=True).apply(values, 2) > 0)
+        level_noise = GaussianPeakNoiseLevelSpecific({2: 1.0})
+        assert np.array_equal(level_noise.apply(values, 1), values)
+        assert not np.array_equal(level_noise.apply(values, 2), values)
+
+        # get overridden in a subclass uses the generator passed to apply
+        shifts = [UniformShiftNoise().apply(values, 1, rng=np.random.default_rng(0)) for _ in range(2)]
+        assert np.array_equal(shifts[0], shifts[1]) and not np.array_equal(shifts[0], values)
+
+        # get overridden in a subclass of a vectorised noise class is used by apply
+        assert np.array_equal(ConstantGaussianNoise(2.0).apply(values, 1), values + 2.0)
+        assert np.array_equal(NegatedLevelNoise({1: 1.0}).apply(values, 1), -values)
+
+        # the adapter passes the generator on to a wrapped apply that takes one
+        adapted = get_array_noise(ArrayOnlyRngNoise())
+        shifts = [adapted.apply(values, 1, rng=np.random.default_rng(0)) for _ in range(2)]
+        assert np.array_equal(shifts[0], shifts[1]) and not np.array_equal(shifts[0], values)
+
+        # noise classes that only implement get are applied through an adapter, in both scan generation paths
+        params = get_default_scan_params()
+        min_mz, max_mz = params.get('first_mass'), params.get('last_mass')
+        isolation_windows = params.get('isolation_windows')
+        mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS)
+        noisy_mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS, intensity_noise=DoubleIntensityNoise())
+        idx = mass_spec._get_chem_indices(300)
+        for get_peaks in [lambda ms: ms._get_ms1_peaks(idx, 300, params, 0, isolation_windows, min_mz, max_mz),
+                          lambda ms: ms._get_msn_peaks(idx, 300, params, 0, 2, isolation_windows, min_mz, max_mz)]:
+            intensities, noisy_intensities = get_peaks(mass_spec)[1], get_peaks(noisy_mass_spec)[1]
+            assert len(intensities) > 0 and np.array_equal(noisy_intensities, intensities * 2)
+
+    def test_custom_objects_without_rng(self):
+        # spike noise and scan time samplers that don't take a generator are called without one
+        mass_spec = IndependentMassSpectrometer(POSITIVE, BEER_CHEMS, spike_noise=FixedSpikeNoise(),
+                                                scan_duration=FixedScanTimeSampler(), rng=np.random.default_rng(0))
+        controller = TopNController(POSITIVE, 10, 1, 10, 15, MIN_MS1_INTENSITY)
+        env = Environment(mass_spec, controller, BEER_MIN_BOUND, BEER_MIN_BOUND + 10, progress_bar=False)
+        env.run()
+        ms1_scans = controller.scans[1]
+        assert len(ms1_scans) > 1 and all(1000.0 in scan.intensities for scan in ms1_scans)
+        scans = sorted(ms1_scans + controller.scans[2], key=lambda scan: scan.rt)
+        durations = [0.5 if scan.ms_level == 1 else 0.2 for scan in scans[:-1]]
+        assert np.allclose(np.diff([scan.rt for scan in scans]), durations)
@@ -0,0 +1,24 @@
+from vimms.Common import get_default_scan_params
+from vimms.MassSpec import TaskManager
+
+
+class TestTaskManager:
+    def test_task_queues(self):
+        tasks = [get_default_scan_params() for _ in range(10)]
+        task_manager = TaskManager(buffer_size=4)
+        task_manager.add_current(tasks)
+        sent = task_manager.to_send()
+        assert sent == tasks[:4] and task_manager.current_size() == 6
+        task_manager.add_pending(sent)
+
+        # completing a task in the middle leaves the others pending, in order
+        task_manager.remove_pending(tasks[1])
+        task_manager.remove_pending(tasks[0])
+        assert task_manager.pending_size() == 2
+        assert task_manager.peek_pending() is tasks[2]
+        assert task_manager.to_send() == tasks[4:6]
+        assert task_manager.pop_pending() is tasks[2]
+        assert task_manager.pop_pending() is tasks[3]
+        assert task_manager.pending_size() == 0
+        task_manager.remove_pending(tasks[2])  # no longer pending, nothing happens
+        assert task_manager.pending_size() == 0
@@ -13,6 +13,7 @@ from vimms.DsDA import get_schedule, dsda_get_scan_params, create_dsda_schedule
 from vimms.Environment import *
 from vimms.Evaluation import evaluate_multi_peak_roi_aligner
 from vimms.Evaluation import evaluate_multiple_simulated_env
+from vimms.ExperimentRunner import ExperimentRunner, ExperimentJob
 from vimms.GridEstimator import *
 from vimms.Roi import FrequentistRoiAligner
 
@@ -25,11 +26,43 @@ def run_coverage_evaluation(box_file, mzml_file, half_isolation_window):
     return coverage
 
 
+def _run_injections(datasets, controllers, min_rt, max_rt, progress_bar, n_workers):
+    """
+    Runs one injection per dataset, in parallel if n_workers > 1
+    :param datasets: a list of datasets
+    :param controllers: a list of controllers, one for each dataset
+    :param min_rt: start time of the injections
+    :param max_rt: end time of the injections
+    :param progress_bar: whether to show a progress bar, when running serially
+    :param n_workers: the number of worker processes to use
+    :return: a list of environments, in the same order as datasets
+    """
+    if n_workers > 1:
+        jobs = [ExperimentJob('sample_' + str(i), i, controllers[i], min_rt, max_rt) for i in range(len(datasets))]
+        results = ExperimentRunner(datasets, max_workers=n_workers).run_all(jobs)
+        for result in results:
+            if result.failed:
+                raise result.error
+        return [result.result for result in results]
+
+    env_list = []
+    for i in range(len(datasets)):
+        mass_spec = IndependentMassSpectrometer(POSITIVE, datasets[i])
+        env = Environment(mass_spec, controllers[i], min_rt, max_rt, progress_bar=progress_bar)
+        env.run()
+        if progress_bar is False:
+            print('Processed dataset ' + str(i))
+        env_list.append(env)
+    return env_list
+
+
 def run_env(mass_spec, controller, min_rt, max_rt, mzml_file):
     env = Environment(mass_spec, controller, min_rt, max_rt)
     env.run()
     env.write_mzML(None, mzml_file)
-    chems = [event.chem.__repr__() for event in env.mass_spec.fragmentation_events if event.ms_level > 1]
+    events = env.mass_spec.fragmentation_events.get_columns()
+    fragmented_idx = np.unique(events['chem_idx'][events['ms_level'] > 1])
+    chems = [env.mass_spec.chemicals[i].__repr__() for i in fragmented_idx]
     chemical_coverage = len(np.unique(np.array(chems))) / len(env.mass_spec.chemicals)
     return chemical_coverage
 
@@ -117,20 +150,17 @@ def weighted_dew_evaluation(param_dict):
 
 def top_n_experiment_evaluation(datasets, min_rt, max_rt, N, isolation_window, mz_tol, rt_tol, min_ms1_intensity,
                                 base_chemicals=None, mzmine_files=None, rt_tolerance=100, experiment_dir=None,
-                                progress_bar=False):
+                                progress_bar=False, n_workers=1):
     if base_chemicals is not None or mzmine_files is not None:
-        env_list = []
         mzml_files = []
         source_files = ['sample_' + str(i) for i in range(len(datasets))]
+        controllers = []
         for i in range(len(datasets)):
-            mass_spec = IndependentMassSpectrometer(POSITIVE, datasets[i])
             controller = TopNController(POSITIVE, N, isolation_window, mz_tol, rt_tol, min_ms1_intensity, ms1_shift=0,
                                         initial_exclusion_list=None, force_N=False)
-            env = Environment(mass_spec, controller, min_rt, max_rt, progress_bar=progress_bar)
-            env.run()
-            if progress_bar is False:
-                print('Processed dataset ' + str(i))
-            env_list.append(env)
+            controllers.append(controller)
+        env_list = _run_injections(datasets, controllers, min_rt, max_rt, progress_bar, n_workers)
+        for i, env in enumerate(env_list):
             if base_chemicals is None:
                 file_link = os.path.join(experiment_dir, source_files[i] + '.mzml')
                 mzml_files.append(file_link)
@@ -182,20 +212,18 @@ def top_n_exclusion_experiment_evaluation(datasets, min_rt, max_rt, N, isolation
 
 def top_n_roi_experiment_evaluation(datasets, min_rt, max_rt, N, isolation_window, mz_tol, rt_tol,
                                     min_ms1_intensity, min_roi_intensity, min_roi_length, base_chemicals=None,
-                                    mzmine_files=None, rt_tolerance=100, experiment_dir=None, progress_bar=False):
+                                    mzmine_files=None, rt_tolerance=100, experiment_dir=None, progress_bar=False,
+                                    n_workers=1):
     if base_chemicals is not None or mzmine_files is not None:
-        env_list = []
         mzml_files = []
         source_files = ['sample_' + str(i) for i in range(len(datasets))]
+        controllers = []
         for i in range(len(datasets)):
-            mass_spec = IndependentMassSpectrometer(POSITIVE, datasets[i])
             controller = TopN_RoiController(POSITIVE, isolation_window, mz_tol, min_ms1_intensity, min_roi_intensity,
                                             min_roi_length, N=N, rt_tol=rt_tol)
-            env = Environment(mass_spec, controller, min_rt, max_rt, progress_bar=progress_bar)
-            env.run()
-            if progress_bar is False:
-                print('Processed dataset ' + str(i))
-            env_list.append(env)
+            controllers.append(controller)
+        env_list = _run_injections(datasets, controllers, min_rt, max_rt, progress_bar, n_workers)
+        for i, env in enumerate(env_list):
             if base_chemicals is None:
                 file_link = os.path.join(experiment_dir, source_files[i] + '.mzml')
                 mzml_files.append(file_link)
@@ -216,13 +244,12 @@ def smart_roi_experiment_evaluation(datasets, min_rt, max_rt, N, isolation_windo
                                     min_ms1_intensity, min_roi_intensity, min_roi_length,
                                     min_roi_length_for_fragmentation, reset_length_seconds, intensity_increase_factor,
                                     drop_perc, ms1_shift, base_chemicals=None, mzmine_files=None,
-                                    rt_tolerance=100, experiment_dir=None, progress_bar=False):
+                                    rt_tolerance=100, experiment_dir=None, progress_bar=False, n_workers=1):
     if base_chemicals is not None or mzmine_files is not None:
-        env_list = []
         mzml_files = []
         source_files = ['sample_' + str(i) for i in range(len(datasets))]
+        controllers = []
         for i in range(len(datasets)):
-            mass_spec = IndependentMassSpectrometer(POSITIVE, datasets[i])
             controller = TopN_SmartRoiController(POSITIVE, isolation_window, mz_tol, min_ms1_intensity,
                                                  min_roi_intensity,
                                                  min_roi_length, N=N, rt_tol=rt_tol,
@@ -230,11 +257,9 @@ def smart_roi_experiment_evaluation(datasets, min_rt, max_rt, N, isolation_windo
                                                  reset_length_seconds=reset_length_seconds,
                                                  intensity_increase_factor=intensity_increase_factor,
                                                  drop_perc=drop_perc, ms1_shift=ms1_shift)
-            env = Environment(mass_spec, controller, min_rt, max_rt, progress_bar=progress_bar)
-            env.run()
-            if progress_bar is False:
-                print('Processed dataset ' + str(i))
-            env_list.append(env)
+            controllers.append(controller)
+        env_list = _run_injections(datasets, controllers, min_rt, max_rt, progress_bar, n_workers)
+        for i, env in enumerate(env_list):
             if base_chemicals is None:
                 file_link = os.path.join(experiment_dir, source_files[i] + '.mzml')
                 mzml_files.append(file_link)
@@ -253,20 +278,17 @@ def smart_roi_experiment_evaluation(datasets, min_rt, max_rt, N, isolation_windo
 
 def weighted_dew_experiment_evaluation(datasets, min_rt, max_rt, N, isolation_window, mz_tol, r, t0,
                                        min_ms1_intensity, base_chemicals=None, mzmine_files=None, rt_tolerance=100,
-                                       experiment_dir=None, progress_bar=False):
+                                       experiment_dir=None, progress_bar=False, n_workers=1):
     if base_chemicals is not None or mzmine_files is not None:
-        env_list = []
         mzml_files = []
         source_files = ['sample_' + str(i) for i in range(len(datasets))]
+        controllers = []
         for i in range(len(datasets)):
-            mass_spec = IndependentMassSpectrometer(POSITIVE, datasets[i])
             controller = WeightedDEWController(POSITIVE, N, isolation_window, mz_tol, r, min_ms1_intensity,
                                                exclusion_t_0=t0, log_intensity=True)
-            env = Environment(mass_spec, controller, min_rt, max_rt, progress_bar=progress_bar)
-            env.run()
-            if progress_bar is False:
-                print('Processed dataset ' + str(i))
-            env_list.append(env)
+            controllers.append(controller)
+        env_list = _run_injections(datasets, controllers, min_rt, max_rt, progress_bar, n_workers)
+        for i, env in enumerate(env_list):
             if base_chemicals is None:
                 file_link = os.path.join(experiment_dir, source_files[i] + '.mzml')
                 mzml_files.append(file_link)
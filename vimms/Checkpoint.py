@@ -0,0 +1,100 @@
+"""
+Saves and loads checkpoints of long simulated runs, so that a run that is interrupted can be resumed from where it
+was rather than started again, see Environment.resume.
+
+Checkpoints are written as uncompressed pickles (protocol 5), with the data of numpy arrays stored out-of-band after
+the pickle rather than copied into it. This is much faster to write and read than save_obj's gzipped pickles, which
+matters when a checkpoint of a large dataset is taken every few minutes. Python versions before 3.8 don't have
+protocol 5, so there protocol 4 is used and the arrays are stored in the pickle, with no buffers after it. Files are
+written to a temporary file first and then renamed, so an interruption while a checkpoint is being written leaves the
+previous one intact.
+"""
+import os
+import pickle
+import struct
+import uuid
+
+from vimms.Common import create_if_not_exist
+
+CHECKPOINT_MAGIC = b'VIMMSCKP'
+CHECKPOINT_VERSION = 1
+
+# the protocol that can store buffers out-of-band, from Python 3.8
+OUT_OF_BAND_PROTOCOL = 5
+
+# out-of-band buffers start at multiples of this, so that arrays loaded from them are aligned
+BUFFER_ALIGNMENT = 64
+
+# magic, version, number of buffers, length of the pickle
+_HEADER = struct.Struct('<8sIIQ')
+_LENGTH = struct.Struct('<Q')
+
+
+def save_checkpoint(obj, filename):
+    """
+    Saves an object to a checkpoint file
+    :param obj: the object to save
+    :param filename: the checkpoint file, replaced if it exists
+    :return: None
+    """
+    buffers = []
+    if pickle.HIGHEST_PROTOCOL >= OUT_OF_BAND_PROTOCOL:
+        data = pickle.dumps(obj, protocol=OUT_OF_BAND_PROTOCOL, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(obj, protocol=4)
+    raw_buffers = [buffer.raw() for buffer in buffers]
+
+    out_dir = os.path.dirname(filename)
+    create_if_not_exist(out_dir)
+    tmp_filename = '%s.tmp-%s' % (filename, uuid.uuid4().hex)
+    try:
+        with open(tmp_filename, 'wb') as f:
+            f.write(_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, len(raw_buffers), len(data)))
+            for raw in raw_buffers:
+                f.write(_LENGTH.pack(raw.nbytes))
+            f.write(data)
+            for raw in raw_buffers:
+                f.write(b'\0' * (-f.tell() % BUFFER_ALIGNMENT))
+                f.write(raw)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def load_checkpoint(filename):
+    """
+    Loads an object from a checkpoint file. The file is read into memory once, and numpy arrays in the object
+    use that memory directly rather than being copied.
+    :param filename: the checkpoint file
+    :return: the saved object
+    """
+    with open(filename, 'rb') as f:
+        content = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(content)
+    view = memoryview(content)
+
+    magic, version, n_buffers, data_length = _HEADER.unpack_from(view, 0)
+    if magic != CHECKPOINT_MAGIC:
+        raise ValueError('%s is not a checkpoint file' % filename)
+    if version != CHECKPOINT_VERSION:
+        raise ValueError('Checkpoint %s has version %d, but only version %d can be loaded' % (
+            filename, version, CHECKPOINT_VERSION))
+
+    pos = _HEADER.size
+    lengths = []
+    for _ in range(n_buffers):
+        lengths.append(_LENGTH.unpack_from(view, pos)[0])
+        pos += _LENGTH.size
+    data = view[pos:pos + data_length]
+    pos += data_length
+
+    buffers = []
+    for length in lengths:
+        pos += -pos % BUFFER_ALIGNMENT
+        buffers.append(view[pos:pos + length])
+        pos += length
+    if not buffers:
+        # written in-band, and loadable on Python versions that don't take buffers
+        return pickle.loads(data)
+    return pickle.loads(data, buffers=buffers)
@@ -9,7 +9,7 @@ from mass_spec_utils.library_matching.gnps import load_mgf
 
 from vimms.Chromatograms import FunctionalChromatogram, ConstantChromatogram, EmpiricalChromatogram
 from vimms.Common import Formula, DummyFormula, uniform_list, DEFAULT_MS1_SCAN_WINDOW, DEFAULT_MSN_SCAN_WINDOW, \
-    POSITIVE, NEGATIVE, PROTON_MASS, DEFAULT_SCAN_TIME_DICT
+    POSITIVE, NEGATIVE, PROTON_MASS, DEFAULT_SCAN_TIME_DICT, get_rng
 from vimms.Roi import make_roi, RoiParams
 
 MIN_MZ = DEFAULT_MS1_SCAN_WINDOW[0]
@@ -30,7 +30,7 @@ class FormulaSampler(object):
         self.min_mz = min_mz
         self.max_mz = max_mz
 
-    def sample(self, n_formulas):
+    def sample(self, n_formulas, rng=None):
         raise NotImplementedError
 
 
@@ -48,14 +48,16 @@ class DatabaseFormulaSampler(FormulaSampler):
         self.min_mz = min_mz
         self.max_mz = max_mz
 
-    def sample(self, n_formulas):
+    def sample(self, n_formulas, rng=None):
         """
         Samples n_formulas from the specified database
         :param n_formulas: the number of formula to draw
         :param min_mz: minimum m/z of formula
         :param max_mz: maximum m/z of formula
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return: a list of Formula objects
         """
+        rng = get_rng(rng)
         # filter database formulae to be within mz_range
         offset = 20  # to ensure that we have room for at least M+H
         formulas = list(set([(x.chemical_formula, x.name) for x in self.database]))
@@ -63,7 +65,7 @@ class DatabaseFormulaSampler(FormulaSampler):
             filter(lambda x: Formula(x[0]).mass >= self.min_mz and Formula(x[0]).mass <= self.max_mz - offset,
                    formulas))
         logger.debug('{} unique formulas in filtered database'.format(len(sub_formulas)))
-        chosen_formula_positions = np.random.choice(len(sub_formulas), size=n_formulas, replace=False)
+        chosen_formula_positions = rng.choice(len(sub_formulas), size=n_formulas, replace=False)
         logger.debug('Sampled formulas')
         return [(Formula(sub_formulas[f][0]), sub_formulas[f][1]) for f in chosen_formula_positions]
 
@@ -74,15 +76,17 @@ class UniformMZFormulaSampler(FormulaSampler):
     Resulting in UnknownChemical objects instead of known_chemical ones.
     """
 
-    def sample(self, n_formulas):
+    def sample(self, n_formulas, rng=None):
         """
         Samples n_formulas uniformly between min_mz and max_mz
         :param n_formulas: the number of formula to draw
         :param min_mz: minimum m/z of formula
         :param max_mz: maximum m/z of formula
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return: a list of Formula objects
         """
-        mz_list = np.random.rand(n_formulas) * (self.max_mz - self.min_mz) + self.min_mz
+        rng = get_rng(rng)
+        mz_list = rng.random(n_formulas) * (self.max_mz - self.min_mz) + self.min_mz
         return [(DummyFormula(m), None) for m in mz_list]
 
 
@@ -100,10 +104,11 @@ class PickEverythingFormulaSampler(DatabaseFormulaSampler):
         self.min_mz = min_mz
         self.max_mz = max_mz
 
-    def sample(self, n_formulas):
+    def sample(self, n_formulas, rng=None):
         """
         Just return everything from the database
         :param n_formulas: ignored?
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return: all formulae from the database
         """
         formula_list = [(Formula(x.chemical_formula), x.name) for x in self.database]
@@ -120,7 +125,7 @@ class EvenMZFormulaSampler(FormulaSampler):
         self.n_sampled = 0
         self.step = 100
 
-    def sample(self, n_formulas):
+    def sample(self, n_formulas, rng=None):
         mz_list = []
         for i in range(n_formulas):
             new_mz = (self.n_sampled + 1) * self.step
@@ -164,12 +169,13 @@ class MZMLFormulaSampler(FormulaSampler):
         self.mz_bins = [(k, k + 1) for k in mz_bins.keys()]
         self.mz_probs = [v / total_intensity for v in mz_bins.values()]
 
-    def sample(self, n_formulas):
+    def sample(self, n_formulas, rng=None):
+        rng = get_rng(rng)
         mz_list = []
         for i in range(n_formulas):
-            mz_bin_idx = np.random.choice(len(self.mz_bins), p=self.mz_probs)
+            mz_bin_idx = rng.choice(len(self.mz_bins), p=self.mz_probs)
             mz_bin = self.mz_bins[mz_bin_idx]
-            mz = np.random.rand() * (mz_bin[1] - mz_bin[0]) + mz_bin[0]
+            mz = rng.random() * (mz_bin[1] - mz_bin[0]) + mz_bin[0]
             mz_list.append(mz)
         return [(DummyFormula(m), None) for m in mz_list]
 
@@ -184,7 +190,7 @@ class RTAndIntensitySampler(object):
     Base class for RT and intensity sampler. Usually used when initialising a formula object.
     """
 
-    def sample(self, formula):
+    def sample(self, formula, rng=None):
         raise NotImplementedError
 
 
@@ -208,14 +214,16 @@ class UniformRTAndIntensitySampler(RTAndIntensitySampler):
         self.min_log_intensity = min_log_intensity
         self.max_log_intensity = max_log_intensity
 
-    def sample(self, formula):
+    def sample(self, formula, rng=None):
         """
         Samples RT and log intensity uniformly between (min_rt, max_rt) and (min_log_intensity, max_log_intensity)
         :param formula: the formula to condition on (can be ignored)
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return: a tuple of (RT, intensity)
         """
-        rt = np.random.rand() * (self.max_rt - self.min_rt) + self.min_rt
-        log_intensity = np.random.rand() * (self.max_log_intensity - self.min_log_intensity) + self.min_log_intensity
+        rng = get_rng(rng)
+        rt = rng.random() * (self.max_rt - self.min_rt) + self.min_rt
+        log_intensity = rng.random() * (self.max_log_intensity - self.min_log_intensity) + self.min_log_intensity
         return rt, np.exp(log_intensity)
 
 
@@ -270,14 +278,15 @@ class MZMLRTandIntensitySampler(RTAndIntensitySampler):
         self.intensity_bins = [(b, bin_edges[i + 1]) for i, b in enumerate(bin_edges[:-1])]
         self.intensity_probs = [h for h in hist]
 
-    def sample(self, formula):
-        rt_bin_idx = np.random.choice(len(self.rt_bins), p=self.rt_probs)
+    def sample(self, formula, rng=None):
+        rng = get_rng(rng)
+        rt_bin_idx = rng.choice(len(self.rt_bins), p=self.rt_probs)
         rt_bin = self.rt_bins[rt_bin_idx]
-        rt = np.random.rand() * (rt_bin[1] - rt_bin[0]) + rt_bin[0]
+        rt = rng.random() * (rt_bin[1] - rt_bin[0]) + rt_bin[0]
 
-        intensity_bin_idx = np.random.choice(len(self.intensity_bins), p=self.intensity_probs)
+        intensity_bin_idx = rng.choice(len(self.intensity_bins), p=self.intensity_probs)
         intensity_bin = self.intensity_bins[intensity_bin_idx]
-        log_intensity = np.random.rand() * (intensity_bin[1] - intensity_bin[0]) + intensity_bin[0]
+        log_intensity = rng.random() * (intensity_bin[1] - intensity_bin[0]) + intensity_bin[0]
         return rt, np.exp(log_intensity)
 
 
@@ -291,7 +300,7 @@ class ChromatogramSampler(object):
     Base class for chromatogram sampler.
     """
 
-    def sample(self, formula, rt, intensity):
+    def sample(self, formula, rt, intensity, rng=None):
         raise NotImplementedError
 
 
@@ -304,12 +313,13 @@ class GaussianChromatogramSampler(ChromatogramSampler):
         assert sigma > 0
         self.sigma = sigma
 
-    def sample(self, formula, rt, intensity):
+    def sample(self, formula, rt, intensity, rng=None):
         """
         Sample a Gaussian-shaped chromatogram
         :param formula: the formula to condition on (can be ignored)
         :param rt: RT to condition on (can be ignored)
         :param intensity: intensity to condition on (can be ignored)
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return:
         """
         return FunctionalChromatogram('normal', [0, self.sigma])
@@ -320,7 +330,7 @@ class ConstantChromatogramSampler(ChromatogramSampler):
     A sampler to return constant chromatograms -- direct infusion
     """
 
-    def sample(self, formula, rt, intensity):
+    def sample(self, formula, rt, intensity, rng=None):
         return ConstantChromatogram()
 
 
@@ -343,8 +353,9 @@ class MZMLChromatogramSampler(ChromatogramSampler):
         logger.debug("Extracted {} good ROIs from {}".format(len(good), self.mzml_file_name))
         return good
 
-    def sample(self, formula, rt, intensity):
-        roi_idx = np.random.choice(len(self.good_rois))
+    def sample(self, formula, rt, intensity, rng=None):
+        rng = get_rng(rng)
+        roi_idx = rng.choice(len(self.good_rois))
         r = self.good_rois[roi_idx]
         chromatogram = EmpiricalChromatogram(np.array(r.rt_list), np.array(r.mz_list), \
                                              np.array(r.intensity_list), single_point_length=0.9)
@@ -361,7 +372,7 @@ class MS2Sampler(object):
     Base class for MS2 sampler
     """
 
-    def sample(self, formula):
+    def sample(self, formula, rng=None):
         raise NotImplementedError
 
 
@@ -383,22 +394,24 @@ class UniformMS2Sampler(MS2Sampler):
         self.min_proportion = min_proportion  # proportion of parent intensity shared by MS2
         self.max_proportion = max_proportion
 
-    def sample(self, chemical):
+    def sample(self, chemical, rng=None):
         """
         Samples n_peaks of MS2 peaks uniformly between min_mz and the exact mass of the formula.
         The intensity is also randomly sampled between between min_proportion and max_proportion of the parent
         formula intensity
         :param formula: the parent formula
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return: a tuple of (mz_list, intensity_list, parent_proportion)
         """
-        n_peaks = np.random.poisson(self.poiss_peak_mean)
+        rng = get_rng(rng)
+        n_peaks = rng.poisson(self.poiss_peak_mean)
         max_mz = chemical.mass
-        mz_list = uniform_list(n_peaks, self.min_mz, max_mz)
-        intensity_list = uniform_list(n_peaks, 0, 1)
+        mz_list = uniform_list(n_peaks, self.min_mz, max_mz, rng=rng)
+        intensity_list = uniform_list(n_peaks, 0, 1, rng=rng)
 
         s = sum(intensity_list)
         intensity_list = [i / s for i in intensity_list]
-        parent_proportion = np.random.rand() * (self.max_proportion - self.min_proportion) + \
+        parent_proportion = rng.random() * (self.max_proportion - self.min_proportion) + \
                             self.min_proportion
 
         return mz_list, intensity_list, parent_proportion
@@ -412,7 +425,7 @@ class FixedMS2Sampler(MS2Sampler):
     def __init__(self, n_frags=2):
         self.n_frags = n_frags
 
-    def sample(self, chemical):
+    def sample(self, chemical, rng=None):
         initial_mz = chemical.mass
         mz_list = []
         intensity_list = []
@@ -441,18 +454,19 @@ class CRPMS2Sampler(MS2Sampler):
         self.base = base
         assert self.base == 'uniform'
 
-    def sample(self, chemical):
+    def sample(self, chemical, rng=None):
+        rng = get_rng(rng)
         max_mz = chemical.mass
-        unique_vals = [self._base_sample(max_mz)]
+        unique_vals = [self._base_sample(max_mz, rng)]
         counts = [1]
         for i in range(self.n_draws - 1):
             temp = counts + [self.alpha]
             s = sum(temp)
             probs = [t / s for t in temp]
-            choice = np.random.choice(len(temp), p=probs)
+            choice = rng.choice(len(temp), p=probs)
             if choice == len(unique_vals):
                 # new value
-                unique_vals.append(self._base_sample(max_mz))
+                unique_vals.append(self._base_sample(max_mz, rng))
                 counts.append(1)
             else:
                 counts[choice] += 1
@@ -460,13 +474,13 @@ class CRPMS2Sampler(MS2Sampler):
         mz_list = unique_vals
         s = sum(counts)
         intensity_list = [c / s for c in counts]
-        parent_proportion = np.random.rand() * (self.max_proportion - self.min_proportion) + \
+        parent_proportion = rng.random() * (self.max_proportion - self.min_proportion) + \
                             self.min_proportion
 
         return mz_list, intensity_list, parent_proportion
 
-    def _base_sample(self, max_mz):
-        return np.random.rand() * (max_mz - self.min_mz) + self.min_mz
+    def _base_sample(self, max_mz, rng):
+        return rng.random() * (max_mz - self.min_mz) + self.min_mz
 
 
 class MGFMS2Sampler(MS2Sampler):
@@ -491,7 +505,8 @@ class MGFMS2Sampler(MS2Sampler):
         self.spectra_list.sort(key=lambda x: x[0])
         logger.debug("Loaded {} spectra from {}".format(len(self.spectra_list), self.mgf_file))
 
-    def sample(self, chemical):
+    def sample(self, chemical, rng=None):
+        rng = get_rng(rng)
         formula_mz = chemical.mass
         sub_spec = list(filter(lambda x: x[0] < formula_mz, self.spectra_list))
         if len(sub_spec) == 0:
@@ -502,7 +517,7 @@ class MGFMS2Sampler(MS2Sampler):
         n_attempts = 0
         while not found_permissable:
             n_attempts += 1
-            spec = np.random.choice(len(sub_spec))
+            spec = rng.choice(len(sub_spec))
             if self.replace == True or sub_spec[spec][2] == 0 or n_attempts > 100:
                 found_permissable = True
 
@@ -511,7 +526,7 @@ class MGFMS2Sampler(MS2Sampler):
         mz_list, intensity_list = zip(*spectrum.peaks)
         s = sum(intensity_list)
         intensity_list = [i / s for i in intensity_list]
-        parent_proportion = np.random.rand() * (self.max_proportion - self.min_proportion) + \
+        parent_proportion = rng.random() * (self.max_proportion - self.min_proportion) + \
                             self.min_proportion
 
         return mz_list, intensity_list, parent_proportion
@@ -523,10 +538,11 @@ class ExactMatchMS2Sampler(MGFMS2Sampler):
     def __init__(self, mgf_file, min_proportion=0.1, max_proportion=0.8, id_field="SPECTRUMID"):
         super().__init__(mgf_file, min_proportion=min_proportion, max_proportion=max_proportion, id_field=id_field)
 
-    def sample(self, chemical):
+    def sample(self, chemical, rng=None):
+        rng = get_rng(rng)
         spectrum = self.spectra_dict[chemical.database_accession]
         mz_list, intensity_list = zip(*spectrum.peaks)
-        parent_proportion = np.random.rand() * (self.max_proportion - self.min_proportion) + \
+        parent_proportion = rng.random() * (self.max_proportion - self.min_proportion) + \
                             self.min_proportion
         return mz_list, intensity_list, parent_proportion
 
@@ -555,16 +571,17 @@ class MZMLMS2Sampler(MS2Sampler):
         logger.debug("{} MS2 scansn remaining".format(len(ms2_scans)))
         self.ms2_scans = ms2_scans
 
-    def sample(self, chemical):
+    def sample(self, chemical, rng=None):
+        rng = get_rng(rng)
         assert len(
             self.ms2_scans) > 0, "MS2 sampler ran out of scans. Consider an alternative, or setting with_replacement to True"
         # pick a scan and removoe
-        scan_idx = np.random.choice(len(self.ms2_scans), 1)[0]
+        scan_idx = rng.choice(len(self.ms2_scans), 1)[0]
         scan = self.ms2_scans[scan_idx]
         if not self.with_replacement:
             del self.ms2_scans[scan_idx]
 
-        parent_proportion = np.random.rand() * (self.max_proportion - self.min_proportion) + \
+        parent_proportion = rng.random() * (self.max_proportion - self.min_proportion) + \
                             self.min_proportion
 
         mz_list, intensity_list = zip(*scan.peaks)
@@ -577,7 +594,7 @@ class MZMLMS2Sampler(MS2Sampler):
 ###############################################################################################################
 
 class DefaultScanTimeSampler():
-    def sample_time(self, current_level, next_level):
+    def sample_time(self, current_level, next_level, rng=None):
         return DEFAULT_SCAN_TIME_DICT[current_level]
 
 
@@ -595,14 +612,15 @@ class MzMLScanTimeSampler():
             logger.warning('Not enough MS1 scans to compute (1, 1) scan duration. The default of %f will be used' % default)
             self.time_dict[(1, 1)] = [default]
 
-    def sample_time(self, current_level, next_level):
+    def sample_time(self, current_level, next_level, rng=None):
+        rng = get_rng(rng)
         if self.use_mean:
             # return only the average time for current_level
             return self.mean_time_dict[current_level]
         else:
             # sample a scan duration value extracted from the mzML based on the current and next level
             values = self.time_dict[(current_level, next_level)]
-            sampled = np.random.choice(values, replace=False, size=1)
+            sampled = rng.choice(values, replace=False, size=1)
             return sampled[0]
 
     def _extract_timing(self, seed_file):
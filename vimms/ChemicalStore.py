@@ -0,0 +1,326 @@
+"""
+Provides a columnar (struct-of-arrays) view of the chemicals in a dataset. This is used by the mass spec to
+generate scans in a few array operations rather than by walking every chemical object in Python.
+"""
+import numpy as np
+
+from vimms.Chromatograms import ChromatogramBank
+from vimms.Common import adduct_transformation, counts_to_offsets, expand_ranges
+
+
+class ChemicalStore(object):
+    """
+    A struct-of-arrays store of the chemicals in a dataset.
+
+    For each chemical i, its isotopes are kept in the slice isotope_offsets[i]:isotope_offsets[i + 1] of the
+    isotope arrays, and its adducts (for the selected ionisation mode) in the slice
+    adduct_offsets[i]:adduct_offsets[i + 1] of the adduct arrays.
+
+    MS1 signals, i.e. the isotope/adduct combinations of a chemical that appear in an MS1 scan, are also
+    precomputed. Their m/z values already have the adduct transformation applied, and their intensity factors
+    are the product of isotope proportion, adduct proportion and the max intensity of the chemical. Signals of
+    chemical i are in the slice signal_offsets[i]:signal_offsets[i + 1].
+
+    Precursors are all the isotope/adduct combinations of a chemical, which can be isolated for fragmentation.
+    Their m/z values (before the chromatogram is applied) are kept in the same way, in the slice
+    precursor_offsets[i]:precursor_offsets[i + 1], with the isotope as the outer loop.
+
+    The fragmentation tree of a chemical is compiled into a FragmentTable the first time the chemical is isolated
+    in an MS2+ scan, and kept for later scans.
+
+    The store can be shared by several mass spec objects (e.g. multiple injections) of the same chemicals, so that
+    it, and the elution index it contains, only have to be built once.
+    """
+
+    def __init__(self, chemicals, ionisation_mode):
+        """
+        Creates a chemical store
+        :param chemicals: a list of MS1 Chemical objects
+        :param ionisation_mode: POSITIVE or NEGATIVE
+        """
+        self.chemicals = chemicals
+        self.ionisation_mode = ionisation_mode
+        self.chromatograms = [chem.chromatogram for chem in chemicals]
+        self.chromatogram_bank = ChromatogramBank(self.chromatograms)
+        self.chem_rts = np.array([chem.rt for chem in chemicals], dtype=np.float64)
+
+        isotope_mzs, isotope_props, isotope_counts = [], [], []
+        adduct_names, adduct_props, adduct_counts = [], [], []
+        signal_chems, signal_isotopes, signal_adducts, signal_mzs, signal_factors, signal_counts = \
+            [], [], [], [], [], []
+        precursor_mzs, precursor_counts = [], []
+        for i, chem in enumerate(chemicals):
+            adducts = chem.adducts[ionisation_mode] if ionisation_mode in chem.adducts else []
+            isotope_mzs.extend([isotope[0] for isotope in chem.isotopes])
+            isotope_props.extend([isotope[1] for isotope in chem.isotopes])
+            isotope_counts.append(len(chem.isotopes))
+            adduct_names.extend([adduct[0] for adduct in adducts])
+            adduct_props.extend([adduct[1] for adduct in adducts])
+            adduct_counts.append(len(adducts))
+
+            # same combinations, in the same order, as IndependentMassSpectrometer._get_mz_peaks for MS1 scans:
+            # all adducts of the monoisotopic peak, and all isotopes of the first adduct
+            n_signals = 0
+            for which_isotope, isotope in enumerate(chem.isotopes):
+                for which_adduct, adduct in enumerate(adducts):
+                    if which_isotope > 0 and which_adduct > 0:
+                        continue
+                    signal_chems.append(i)
+                    signal_isotopes.append(which_isotope)
+                    signal_adducts.append(which_adduct)
+                    signal_mzs.append(adduct_transformation(isotope[0], adduct[0]))
+                    signal_factors.append(isotope[1] * adduct[1] * chem.max_intensity)
+                    n_signals += 1
+            signal_counts.append(n_signals)
+
+            precursor_mzs.extend([adduct_transformation(isotope[0], adduct[0])
+                                  for isotope in chem.isotopes for adduct in adducts])
+            precursor_counts.append(len(chem.isotopes) * len(adducts))
+
+        self.isotope_mzs = np.array(isotope_mzs, dtype=np.float64)
+        self.isotope_props = np.array(isotope_props, dtype=np.float64)
+        self.isotope_offsets = counts_to_offsets(isotope_counts)
+        self.adduct_names = adduct_names
+        self.adduct_props = np.array(adduct_props, dtype=np.float64)
+        self.adduct_offsets = counts_to_offsets(adduct_counts)
+
+        self.signal_chems = np.array(signal_chems, dtype=np.int64)
+        self.signal_isotopes = np.array(signal_isotopes, dtype=np.int64)
+        self.signal_adducts = np.array(signal_adducts, dtype=np.int64)
+        self.signal_mzs = np.array(signal_mzs, dtype=np.float64)
+        self.signal_factors = np.array(signal_factors, dtype=np.float64)
+        self.signal_offsets = counts_to_offsets(signal_counts)
+
+        self.precursor_mzs = np.array(precursor_mzs, dtype=np.float64)
+        self.precursor_offsets = counts_to_offsets(precursor_counts)
+
+        # retention time intervals during which each chemical elutes
+        min_rts = np.array([chrom.min_rt for chrom in self.chromatograms], dtype=np.float64) + self.chem_rts
+        max_rts = np.array([chrom.max_rt for chrom in self.chromatograms], dtype=np.float64) + self.chem_rts
+        self.elution_index = ElutionIndex(min_rts, max_rts)
+
+        # compiled fragmentation trees, by chemical index
+        self.fragment_tables = {}
+
+    def __len__(self):
+        return len(self.chemicals)
+
+    def get_signal_indices(self, chem_idx):
+        """
+        Gets the indices into the signal arrays of all the MS1 signals of some chemicals
+        :param chem_idx: an array of chemical indices
+        :return: a tuple of (signal indices, number of signals per chemical in chem_idx)
+        """
+        chem_idx = np.asarray(chem_idx, dtype=np.int64)
+        starts = self.signal_offsets[chem_idx]
+        counts = self.signal_offsets[chem_idx + 1] - starts
+        return expand_ranges(starts, counts), counts
+
+    def get_chromatogram_values(self, chem_idx, query_rt):
+        """
+        Evaluates the chromatograms of some chemicals at a retention time, once per chemical
+        :param chem_idx: an array of chemical indices
+        :param query_rt: the retention time
+        :return: a tuple of (relative intensities, relative m/z values, mask of chemicals whose chromatogram
+        is defined at query_rt)
+        """
+        chem_idx = np.asarray(chem_idx, dtype=np.int64)
+        n = len(chem_idx)
+        relative_intensities = np.zeros(n, dtype=np.float64)
+        relative_mzs = np.zeros(n, dtype=np.float64)
+        matched = np.zeros(n, dtype=bool)
+
+        # empirical and gaussian chromatograms are evaluated all at once from the bank
+        in_bank = self.chromatogram_bank.in_bank[chem_idx]
+        bank_idx = chem_idx[in_bank]
+        bank_intensities, bank_mzs, bank_matched = self.chromatogram_bank.get_values(
+            bank_idx, query_rt - self.chem_rts[bank_idx])
+        relative_intensities[in_bank] = np.where(bank_matched, bank_intensities, 0.0)
+        relative_mzs[in_bank] = np.where(bank_matched, bank_mzs, 0.0)
+        matched[in_bank] = bank_matched
+
+        # other chromatograms are queried one by one
+        for k in np.flatnonzero(~in_bank):
+            i = chem_idx[k]
+            chrom = self.chromatograms[i]
+            rt = query_rt - self.chem_rts[i]
+            if chrom._rt_match(rt):
+                relative_intensities[k] = chrom.get_relative_intensity(rt)
+                relative_mzs[k] = chrom.get_relative_mz(rt)
+                matched[k] = True
+        return relative_intensities, relative_mzs, matched
+
+    def get_isolated(self, chem_idx, relative_mzs, window_set):
+        """
+        Finds the chemicals that have at least one precursor in the isolation windows of a scan, testing
+        the precursors of all chemicals at once
+        :param chem_idx: an array of chemical indices
+        :param relative_mzs: the relative m/z values of the chromatograms of the chemicals, see
+        get_chromatogram_values
+        :param window_set: an IsolationWindowSet
+        :return: a boolean mask over chem_idx
+        """
+        chem_idx = np.asarray(chem_idx, dtype=np.int64)
+        starts = self.precursor_offsets[chem_idx]
+        counts = self.precursor_offsets[chem_idx + 1] - starts
+        precursor_idx = expand_ranges(starts, counts)
+        mzs = self.precursor_mzs[precursor_idx] + np.repeat(relative_mzs, counts)
+        owners = np.repeat(np.arange(len(chem_idx)), counts)
+        num_isolated = np.bincount(owners, weights=window_set.contains(mzs), minlength=len(chem_idx))
+        return num_isolated > 0
+
+    def get_fragment_table(self, chem_idx):
+        """
+        Gets the compiled fragmentation tree of a chemical, compiling it if needed
+        :param chem_idx: a chemical index
+        :return: a FragmentTable
+        """
+        table = self.fragment_tables.get(chem_idx)
+        if table is None:
+            start, end = self.adduct_offsets[chem_idx], self.adduct_offsets[chem_idx + 1]
+            table = FragmentTable(self.chemicals[chem_idx], self.adduct_names[start:end],
+                                  self.adduct_props[start:end])
+            self.fragment_tables[chem_idx] = table
+        return table
+
+    def get_ms1_signals(self, chem_idx, query_rt):
+        """
+        Computes the m/z and intensity values of all the MS1 signals of some chemicals at a retention time
+        :param chem_idx: an array of chemical indices
+        :param query_rt: the retention time
+        :return: a tuple of (signal indices, m/z values, intensity values)
+        """
+        chem_idx = np.asarray(chem_idx, dtype=np.int64)
+        relative_intensities, relative_mzs, matched = self.get_chromatogram_values(chem_idx, query_rt)
+        signal_idx, counts = self.get_signal_indices(chem_idx[matched])
+        mzs = self.signal_mzs[signal_idx] + np.repeat(relative_mzs[matched], counts)
+        intensities = self.signal_factors[signal_idx] * np.repeat(relative_intensities[matched], counts)
+        return signal_idx, mzs, intensities
+
+
+class FragmentTable(object):
+    """
+    The fragmentation tree of an MS1 chemical, flattened into arrays.
+
+    Node 0 is the chemical itself, and the MS2+ fragments below it follow in depth-first order, so that the parent of
+    a node always comes before it. For every node, the table keeps its MS level, its parent, the m/z value of the node
+    for each adduct of the chemical (before the isotope shift), and the two proportions that scale the intensity
+    of the parent into the intensity of the node.
+    """
+
+    def __init__(self, chemical, adduct_names, adduct_props):
+        """
+        Compiles the fragmentation tree of a chemical
+        :param chemical: an MS1 Chemical object
+        :param adduct_names: the names of the adducts of the chemical, for the ionisation mode in use
+        :param adduct_props: the proportions of the adducts of the chemical
+        """
+        nodes, parents = [], []
+        stack = [(chemical, -1)]
+        while len(stack) > 0:
+            node, parent = stack.pop()
+            parents.append(parent)
+            nodes.append(node)
+            children = node.children if node.children is not None else []
+            stack.extend((child, len(nodes) - 1) for child in reversed(children))
+
+        self.levels = np.array([node.ms_level for node in nodes], dtype=np.int64)
+        self.parents = np.array(parents, dtype=np.int64)
+        self.max_level = int(np.max(self.levels))
+
+        # the m/z values of the chemical itself depend on its chromatogram, so they're not kept
+        self.adduct_mzs = np.full((len(nodes), len(adduct_names)), np.nan)
+        for k in range(1, len(nodes)):
+            self.adduct_mzs[k] = [adduct_transformation(nodes[k].isotopes[0][0], name) for name in adduct_names]
+        self.parent_mass_props = np.array([np.nan] + [_get_parent_mass_prop(node) for node in nodes[1:]])
+        self.prop_ms2_masses = np.array([np.nan] + [node.prop_ms2_mass for node in nodes[1:]], dtype=np.float64)
+
+        # fragments are shifted by the same amount as the isotope of the chemical they come from
+        isotope_mzs = np.array([isotope[0] for isotope in chemical.isotopes], dtype=np.float64)
+        self.isotope_shifts = isotope_mzs - isotope_mzs[0]
+
+        # m/z values and intensities of the chemical itself for each isotope (rows) and adduct (columns),
+        # before its chromatogram is applied
+        isotope_props = np.array([isotope[1] for isotope in chemical.isotopes], dtype=np.float64)
+        self.isotope_adduct_mzs = np.array([[adduct_transformation(isotope[0], name) for name in adduct_names]
+                                            for isotope in chemical.isotopes], dtype=np.float64)
+        self.isotope_adduct_intensities = np.outer(isotope_props, adduct_props) * chemical.max_intensity
+
+    def get_nodes(self, ms_level):
+        """
+        Gets the nodes at an MS level
+        :param ms_level: the MS level
+        :return: an array of node indices, in depth-first order
+        """
+        return np.flatnonzero(self.levels == ms_level)
+
+
+def _get_parent_mass_prop(chemical):
+    prop = chemical.parent_mass_prop
+    if isinstance(prop, np.ndarray):
+        prop = prop[0]
+    return prop
+
+
+class ElutionIndex(object):
+    """
+    An index over the retention time intervals during which chemicals elute from the column, used to find the
+    chemicals that are active at a given time in O(log N + k) rather than O(N).
+
+    Interval starts and ends are kept in sorted order. Queries with non-decreasing retention times, which is how
+    a simulated run proceeds, advance two sweep pointers and update the set of active chemicals incrementally.
+    Going back in time (e.g. a new injection that reuses the same chemicals) resets the sweep with a binary search.
+    """
+
+    def __init__(self, min_rts, max_rts):
+        """
+        Creates an elution index
+        :param min_rts: an array of the first retention time at which each chemical elutes
+        :param max_rts: an array of the last retention time at which each chemical elutes
+        """
+        self.min_rts = np.asarray(min_rts, dtype=np.float64)
+        self.max_rts = np.asarray(max_rts, dtype=np.float64)
+        self.start_order = np.argsort(self.min_rts, kind='stable')
+        self.sorted_starts = self.min_rts[self.start_order]
+        self.end_order = np.argsort(self.max_rts, kind='stable')
+        self.sorted_ends = self.max_rts[self.end_order]
+        self._reset(-np.inf)
+
+    def get_active(self, query_rt):
+        """
+        Gets the chemicals eluting at a retention time, i.e. those with min_rt <= query_rt <= max_rt
+        :param query_rt: the retention time
+        :return: a sorted array of chemical indices
+        """
+        if query_rt < self.last_rt:
+            self._reset(query_rt)
+        else:
+            # number of intervals that have started (start <= rt) and ended (end < rt) by query_rt
+            start_pos = int(np.searchsorted(self.sorted_starts, query_rt, side='right'))
+            end_pos = int(np.searchsorted(self.sorted_ends, query_rt, side='left'))
+            self.active.update(self.start_order[self.start_pos:start_pos].tolist())
+            self.active.difference_update(self.end_order[self.end_pos:end_pos].tolist())
+            self.start_pos, self.end_pos, self.last_rt = start_pos, end_pos, query_rt
+        return np.array(sorted(self.active), dtype=np.int64)
+
+    def get_empty_until(self, query_rt):
+        """
+        Finds how long no chemicals elute for, starting from a retention time. Unlike get_active, this doesn't
+        move the sweep.
+        :param query_rt: the retention time
+        :return: the min_rt of the next chemical to elute after query_rt (infinity if there are none), or query_rt
+        itself if some chemicals are eluting at query_rt
+        """
+        # chemicals that have started (start <= rt) and ended (end < rt) by query_rt, the rest are eluting
+        n_started = int(np.searchsorted(self.sorted_starts, query_rt, side='right'))
+        n_ended = int(np.searchsorted(self.sorted_ends, query_rt, side='left'))
+        if n_started > n_ended:
+            return query_rt
+        return float(self.sorted_starts[n_started]) if n_started < len(self.sorted_starts) else np.inf
+
+    def _reset(self, query_rt):
+        self.start_pos = int(np.searchsorted(self.sorted_starts, query_rt, side='right'))
+        self.end_pos = int(np.searchsorted(self.sorted_ends, query_rt, side='left'))
+        started = self.start_order[:self.start_pos]
+        self.active = set(started[self.max_rts[started] >= query_rt].tolist())
+        self.last_rt = query_rt
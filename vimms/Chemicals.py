@@ -10,8 +10,8 @@ from loguru import logger
 
 from vimms.ChemicalSamplers import UniformRTAndIntensitySampler, GaussianChromatogramSampler, UniformMS2Sampler
 from vimms.Chromatograms import EmpiricalChromatogram
-from vimms.Common import POS_TRANSFORMATIONS, Formula, DummyFormula, PROTON_MASS, POSITIVE, NEGATIVE
-from vimms.Noise import GaussianPeakNoise
+from vimms.Common import POS_TRANSFORMATIONS, Formula, DummyFormula, PROTON_MASS, POSITIVE, NEGATIVE, get_rng
+from vimms.Noise import GaussianPeakNoise, get_array_noise
 from vimms.Roi import make_roi, RoiParams
 
 
@@ -81,7 +81,7 @@ class Adducts(object):
     """
     A class to represent an adduct of a chemical
     """
-    def __init__(self, formula, adduct_proportion_cutoff=0.05, adduct_prior_dict=None):
+    def __init__(self, formula, adduct_proportion_cutoff=0.05, adduct_prior_dict=None, rng=None):
         if adduct_prior_dict is None:
             self.adduct_names = {POSITIVE: list(POS_TRANSFORMATIONS.keys())}
             self.adduct_prior = {POSITIVE: np.ones(len(self.adduct_names[POSITIVE])) * 0.1}
@@ -92,6 +92,7 @@ class Adducts(object):
             self.adduct_prior = {k: np.array(list(adduct_prior_dict[k].values())) for k in adduct_prior_dict}
         self.formula = formula
         self.adduct_proportion_cutoff = adduct_proportion_cutoff
+        self.rng = get_rng(rng)
 
     def get_adducts(self):
         """
@@ -113,9 +114,9 @@ class Adducts(object):
         # TODO: replace this with something proper
         proportions = {}
         for k in self.adduct_prior:
-            proportions[k] = np.random.dirichlet(self.adduct_prior[k])
+            proportions[k] = self.rng.dirichlet(self.adduct_prior[k])
             while max(proportions[k]) < 0.2:
-                proportions[k] = np.random.dirichlet(self.adduct_prior[k])
+                proportions[k] = self.rng.dirichlet(self.adduct_prior[k])
             proportions[k][np.where(proportions[k] < self.adduct_proportion_cutoff)] = 0
             proportions[k] = proportions[k] / max(proportions[k])
             proportions[k].tolist()
@@ -262,20 +263,26 @@ class ChemicalMixtureCreator(object):
         #     logger.debug('Sorting database compounds by masses')
         #     self.database.sort(key = lambda x: Formula(x.chemical_formula).mass)
 
-    def sample(self, n_chemicals, ms_levels, include_adducts_isotopes=True):
+    def sample(self, n_chemicals, ms_levels, include_adducts_isotopes=True, rng=None):
         '''
         Samples chemicals.
+        rng: the random number generator, see vimms.Common.get_rng. If None, numpy's global random state is used.
         '''
+        # samplers are only given the generator if there is one, so that samplers written before they took one
+        # keep working with the global random state
+        if rng is not None:
+            rng = get_rng(rng)
+        rng_kwargs = {} if rng is None else {'rng': rng}
 
-        formula_list = self.formula_sampler.sample(n_chemicals)
+        formula_list = self.formula_sampler.sample(n_chemicals, **rng_kwargs)
         rt_list = []
         intensity_list = []
         chromatogram_list = []
         for formula, db_accession in formula_list:
-            rt, intensity = self.rt_and_intensity_sampler.sample(formula)
+            rt, intensity = self.rt_and_intensity_sampler.sample(formula, **rng_kwargs)
             rt_list.append(rt)
             intensity_list.append(intensity)
-            chromatogram_list.append(self.chromatogram_sampler.sample(formula, rt, intensity))
+            chromatogram_list.append(self.chromatogram_sampler.sample(formula, rt, intensity, **rng_kwargs))
         logger.debug('Sampled rt and intensity values and chromatograms')
 
         # make into known chemical objects
@@ -286,7 +293,8 @@ class ChemicalMixtureCreator(object):
             chromatogram = chromatogram_list[i]
             if isinstance(formula, Formula):
                 isotopes = Isotopes(formula)
-                adducts = Adducts(formula, self.adduct_proportion_cutoff, adduct_prior_dict=self.adduct_prior_dict)
+                adducts = Adducts(formula, self.adduct_proportion_cutoff, adduct_prior_dict=self.adduct_prior_dict,
+                                  **rng_kwargs)
 
                 chemicals.append(KnownChemical(formula, isotopes, adducts, rt, max_intensity, chromatogram,
                                                include_adducts_isotopes=include_adducts_isotopes,
@@ -298,7 +306,7 @@ class ChemicalMixtureCreator(object):
 
             if ms_levels == 2:
                 parent = chemicals[-1]
-                child_mz, child_intensity, parent_proportion = self.ms2_sampler.sample(parent)
+                child_mz, child_intensity, parent_proportion = self.ms2_sampler.sample(parent, **rng_kwargs)
 
                 children = []
                 for mz, intensity in zip(child_mz, child_intensity):
@@ -315,7 +323,8 @@ class MultipleMixtureCreator(object):
     A class to create a list of known chemical objects in multiple samples (mixtures)
     '''
     def __init__(self, master_chemical_list, group_list, group_dict,
-                 intensity_noise=GaussianPeakNoise(sigma=0.001, log_space=True), overall_missing_probability=0.0):
+                 intensity_noise=GaussianPeakNoise(sigma=0.001, log_space=True), overall_missing_probability=0.0,
+                 rng=None):
         # example
         # group_list = ['control', 'control', 'case', 'case']
         # group_dict = {'control': {'missing_probability': 0.0, 'changing_probability': 0.0},
@@ -325,6 +334,7 @@ class MultipleMixtureCreator(object):
         self.group_dict = group_dict
         self.intensity_noise = intensity_noise
         self.overall_missing_probability = overall_missing_probability
+        self.rng = get_rng(rng)
 
         if 'control' not in self.group_dict:
             self.group_dict['control'] = {}
@@ -341,21 +351,23 @@ class MultipleMixtureCreator(object):
             changing_probability = self.group_dict[group]['changing_probability']
             for chemical in self.master_chemical_list:
                 self.group_multipliers[group][chemical] = 1.0  # default is no change
-                if np.random.rand() <= changing_probability:
-                    self.group_multipliers[group][chemical] = np.exp(np.random.rand() * (
+                if self.rng.random() <= changing_probability:
+                    self.group_multipliers[group][chemical] = np.exp(self.rng.random() * (
                             np.log(5) - np.log(0.2) + np.log(0.2)))  # uniform between doubling and halving
-                if np.random.rand() <= missing_probability:
+                if self.rng.random() <= missing_probability:
                     self.group_multipliers[group][chemical] = 0.0
 
     def generate_chemical_lists(self):
+        intensity_noise = get_array_noise(self.intensity_noise)
         chemical_lists = []
         for group in self.group_list:
             new_list = []
             for chemical in self.master_chemical_list:
-                if np.random.rand() < self.overall_missing_probability or self.group_multipliers[group][chemical] == 0.:
+                if self.rng.random() < self.overall_missing_probability or \
+                        self.group_multipliers[group][chemical] == 0.:
                     continue  # chemical is missing overall
                 new_intensity = chemical.max_intensity * self.group_multipliers[group][chemical]
-                new_intensity = self.intensity_noise.get(new_intensity, 1)
+                new_intensity = intensity_noise.get(new_intensity, 1, rng=self.rng)
 
                 # make a new known chemical
                 new_chemical = copy.deepcopy(chemical)
@@ -391,18 +403,22 @@ class ChemicalMixtureFromMZML(object):
         logger.debug("Extracted {} good ROIs from {}".format(len(good), self.mzml_file_name))
         return good
 
-    def sample(self, n_chemicals, ms_levels, source_polarity=POSITIVE):
+    def sample(self, n_chemicals, ms_levels, source_polarity=POSITIVE, rng=None):
         """
             Generate a dataset from the mzml file
             n_chemicals: set to None if you want all the ROIs turned into chemicals
+            rng: the random number generator, see vimms.Common.get_rng
         """
+        if rng is not None:
+            rng = get_rng(rng)
+        rng_kwargs = {} if rng is None else {'rng': rng}
         if n_chemicals is None:
             rois_to_use = range(len(self.good_rois))
         elif n_chemicals > len(self.good_rois):
             rois_to_use = range(len(self.good_rois))
             logger.warning("Requested more chemicals than ROIs")
         else:
-            rois_to_use = np.random.permutation(len(self.good_rois))[:n_chemicals]
+            rois_to_use = get_rng(rng).permutation(len(self.good_rois))[:n_chemicals]
         chemicals = []
         for roi_idx in rois_to_use:
             r = self.good_rois[roi_idx]
@@ -426,7 +442,7 @@ class ChemicalMixtureFromMZML(object):
 
             if ms_levels == 2:
                 parent = chemicals[-1]
-                child_mz, child_intensity, parent_proportion = self.ms2_sampler.sample(parent)
+                child_mz, child_intensity, parent_proportion = self.ms2_sampler.sample(parent, **rng_kwargs)
 
                 children = []
                 for mz, intensity in zip(child_mz, child_intensity):
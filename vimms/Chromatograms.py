@@ -1,5 +1,6 @@
 import numpy as np
 import scipy.stats
+from loguru import logger
 
 from vimms.Common import MAX_POSSIBLE_RT
 
@@ -46,6 +47,17 @@ class EmpiricalChromatogram(Chromatogram):
 
         self.min_rt = min(self.rts)
         self.max_rt = max(self.rts)
+        self._neighbours_cache = None  # (query_rt, neighbours) of the last query
+
+    def __getstate__(self):
+        # the cache isn't part of the chromatogram, so it isn't pickled or hashed
+        state = self.__dict__.copy()
+        state.pop('_neighbours_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._neighbours_cache = None
 
     def get_apex_rt(self):
         max_pos = 0
@@ -74,6 +86,33 @@ class EmpiricalChromatogram(Chromatogram):
             mz_above = self.mzs[neighbours_which[1]]
             return mz_below + (mz_above - mz_below) * self._get_distance(query_rt)
 
+    def get_relative_intensity_many(self, query_rts):
+        """
+        Gets the relative intensities at many query RTs at once
+        :param query_rts: an array of query RTs
+        :return: an array of relative intensities, NaN where the chromatogram is not defined
+        """
+        return self._interpolate_many(self.intensities, query_rts)
+
+    def get_relative_mz_many(self, query_rts):
+        """
+        Gets the relative m/z values at many query RTs at once
+        :param query_rts: an array of query RTs
+        :return: an array of relative m/z values, NaN where the chromatogram is not defined
+        """
+        return self._interpolate_many(self.mzs, query_rts)
+
+    def _interpolate_many(self, values, query_rts):
+        query_rts = np.asarray(query_rts, dtype=np.float64)
+        result = np.full(query_rts.shape, np.nan)
+        matched = (self.min_rt < query_rts) & (query_rts < self.max_rt)
+        q = query_rts[matched]
+        above = np.searchsorted(self.rts, q, side='right')
+        below = above - 1
+        distance = (q - self.rts[below]) / (self.rts[above] - self.rts[below])
+        result[matched] = values[below] + (values[above] - values[below]) * distance
+        return result
+
     def _get_rt_neighbours(self, query_rt):
         which_rt_below, which_rt_above = self._get_rt_neighbours_which(query_rt)
         rt_below = self.rts[which_rt_below]
@@ -81,14 +120,18 @@ class EmpiricalChromatogram(Chromatogram):
         return [rt_below, rt_above]
 
     def _get_rt_neighbours_which(self, query_rt):
-        # find the max index of self.rts smaller than query_rt
-        pos = np.where(self.rts <= query_rt)[0]
-        which_rt_below = pos[-1]
-
-        # take the min index of self.rts larger than query_rt
-        pos = np.where(self.rts > query_rt)[0]
-        which_rt_above = pos[0]
-        return [which_rt_below, which_rt_above]
+        # intensity, m/z and distance are usually computed for the same query_rt one after the other,
+        # so remember the neighbours of the last query
+        cache = self._neighbours_cache
+        if cache is not None and cache[0] == query_rt:
+            return cache[1]
+
+        # rts is sorted: the max index of self.rts smaller than or equal to query_rt is just before
+        # the min index of self.rts larger than query_rt
+        which_rt_above = int(np.searchsorted(self.rts, query_rt, side='right'))
+        neighbours_which = [which_rt_above - 1, which_rt_above]
+        self._neighbours_cache = (query_rt, neighbours_which)
+        return neighbours_which
 
     def _get_distance(self, query_rt):
         rt_below, rt_above = self._get_rt_neighbours(query_rt)
@@ -107,6 +150,95 @@ class EmpiricalChromatogram(Chromatogram):
                np.array_equal(sorted(self.raw_intensities), sorted(other.raw_intensities))
 
 
+class ChromatogramBank(object):
+    """
+    Packs the empirical chromatograms of a dataset into single concatenated RT, m/z and intensity arrays, where
+    chromatogram i occupies the slice offsets[i]:offsets[i + 1]. The relative intensities and m/z values of many
+    chromatograms, each at its own query RT, can then be computed by a single vectorised interpolation.
+    The parameters of (untabulated) normal functional chromatograms are also kept, so that they can be evaluated
+    in closed form alongside. Other types of chromatograms are not in the bank and should be queried directly.
+    """
+
+    def __init__(self, chromatograms):
+        """
+        Creates a chromatogram bank
+        :param chromatograms: a list of Chromatogram objects
+        """
+        self.is_packed = np.array([isinstance(chrom, EmpiricalChromatogram) for chrom in chromatograms], dtype=bool)
+        self.is_gaussian = np.array([isinstance(chrom, FunctionalChromatogram) and
+                                     chrom.distribution_name == 'normal' and chrom.table_rts is None
+                                     for chrom in chromatograms], dtype=bool)
+        self.in_bank = self.is_packed | self.is_gaussian
+        packed = [chrom if is_packed else None for chrom, is_packed in zip(chromatograms, self.is_packed)]
+        lengths = [len(chrom.rts) if chrom is not None else 0 for chrom in packed]
+        self.offsets = np.zeros(len(chromatograms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.max_length = max(lengths, default=0)
+
+        empty = np.zeros(0, dtype=np.float64)
+        self.rts = np.concatenate([empty] + [chrom.rts for chrom in packed if chrom is not None])
+        self.mzs = np.concatenate([empty] + [chrom.mzs for chrom in packed if chrom is not None])
+        self.intensities = np.concatenate([empty] + [chrom.intensities for chrom in packed if chrom is not None])
+        self.min_rts = np.array([chrom.min_rt if chrom is not None else np.nan for chrom in packed])
+        self.max_rts = np.array([chrom.max_rt if chrom is not None else np.nan for chrom in packed])
+
+        gaussian = [chrom if is_gaussian else None for chrom, is_gaussian in zip(chromatograms, self.is_gaussian)]
+        self.gaussian_means = np.array([chrom.parameters[0] if chrom is not None else np.nan for chrom in gaussian],
+                                       dtype=np.float64)
+        self.gaussian_sigmas = np.array([chrom.parameters[1] if chrom is not None else np.nan for chrom in gaussian],
+                                        dtype=np.float64)
+        self.gaussian_offsets = np.array([chrom.rt_offset if chrom is not None else np.nan for chrom in gaussian],
+                                         dtype=np.float64)
+        self.gaussian_max_rts = np.array([chrom.max_rt if chrom is not None else np.nan for chrom in gaussian],
+                                         dtype=np.float64)
+
+    def get_values(self, idx, query_rts):
+        """
+        Computes the relative intensity and m/z of chromatograms in the bank
+        :param idx: an array of indices of chromatograms in the bank
+        :param query_rts: an array of query RTs, one for each index in idx
+        :return: a tuple of (relative intensities, relative m/z values, mask of chromatograms defined at their
+        query RTs). Intensities and m/z values are NaN where the chromatogram is not defined.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        query_rts = np.asarray(query_rts, dtype=np.float64)
+        relative_intensities = np.full(len(idx), np.nan)
+        relative_mzs = np.full(len(idx), np.nan)
+        is_packed = self.is_packed[idx]
+        is_gaussian = self.is_gaussian[idx]
+        matched = (is_packed & (self.min_rts[idx] < query_rts) & (query_rts < self.max_rts[idx])) | \
+                  (is_gaussian & (query_rts >= 0) & (query_rts <= self.gaussian_max_rts[idx]))
+
+        which = matched & is_packed
+        i, q = idx[which], query_rts[which]
+        above = self._searchsorted_right(self.offsets[i], self.offsets[i + 1], q)
+        below = above - 1
+        distance = (q - self.rts[below]) / (self.rts[above] - self.rts[below])
+        relative_intensities[which] = self.intensities[below] + \
+                                      (self.intensities[above] - self.intensities[below]) * distance
+        relative_mzs[which] = self.mzs[below] + (self.mzs[above] - self.mzs[below]) * distance
+
+        # same expression as FunctionalChromatogram._compute_relative_intensity
+        which = matched & is_gaussian
+        i, q = idx[which], query_rts[which]
+        relative_intensities[which] = np.exp(
+            (-0.5 * (q + self.gaussian_offsets[i] - self.gaussian_means[i]) ** 2) / self.gaussian_sigmas[i] ** 2)
+        relative_mzs[which] = 0.0
+        return relative_intensities, relative_mzs, matched
+
+    def _searchsorted_right(self, lo, hi, q):
+        # binary search for all queries at once, each within its own chromatogram slice [lo, hi)
+        lo, hi = lo.copy(), hi.copy()
+        for _ in range(int(self.max_length).bit_length()):
+            active = lo < hi
+            mid = (lo + hi) // 2
+            go_right = active & (self.rts[np.minimum(mid, len(self.rts) - 1)] <= q)
+            go_left = active & ~go_right
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(go_left, mid, hi)
+        return lo
+
+
 class ConstantChromatogram(Chromatogram):
     def __init__(self):
         self.mz = 0.0
@@ -130,10 +262,24 @@ class ConstantChromatogram(Chromatogram):
 # Make this more generalisable. Make scipy.stats... as input, However this makes it difficult to do the cutoff
 class FunctionalChromatogram(Chromatogram):
     """
-    Functional Chromatograms to be used within Chemicals
+    Functional Chromatograms to be used within Chemicals.
+
+    Normal distributions are evaluated in closed form without going through scipy. Other shapes call the frozen
+    scipy distribution on every query, unless the chromatogram is tabulated: the shape is then sampled once on an
+    RT grid and queries are answered by linear interpolation.
     """
 
-    def __init__(self, distribution, parameters, cutoff=0.01):
+    def __init__(self, distribution, parameters, cutoff=0.01, tabulate=False, resolution=0.1, max_error=1e-4):
+        """
+        Creates a functional chromatogram
+        :param distribution: the name of the distribution, either 'normal', 'gamma' or 'uniform'
+        :param parameters: the parameters of the distribution
+        :param cutoff: the probability mass cut off from the tails of the distribution
+        :param tabulate: whether to precompute a lookup table of relative intensities
+        :param resolution: the initial RT spacing of the lookup table
+        :param max_error: the maximum absolute interpolation error of the lookup table, measured halfway between
+        grid points. The spacing is halved until this is met.
+        """
         self.cutoff = cutoff
         self.mz = 0
         self.distribution_name = distribution
@@ -146,19 +292,46 @@ class FunctionalChromatogram(Chromatogram):
             self.distrib = scipy.stats.uniform(parameters[0], parameters[1])
         else:
             raise NotImplementedError("distribution not implemented")
+        # query RT 0 corresponds to this point of the distribution
+        self.rt_offset = self.distrib.ppf(self.cutoff / 2)
         self.min_rt = 0
-        self.max_rt = self.distrib.ppf(1 - (self.cutoff / 2)) - self.distrib.ppf(self.cutoff / 2)
+        self.max_rt = self.distrib.ppf(1 - (self.cutoff / 2)) - self.rt_offset
+        self.table_rts = None
+        self.table_intensities = None
+        if tabulate:
+            self._tabulate(resolution, max_error)
+
+    def __setstate__(self, state):
+        # chromatograms pickled by older versions don't have the cached offset or lookup table
+        self.__dict__.update(state)
+        if 'rt_offset' not in state:
+            self.rt_offset = self.distrib.ppf(self.cutoff / 2)
+        if 'table_rts' not in state:
+            self.table_rts = None
+            self.table_intensities = None
 
     def get_relative_intensity(self, query_rt):
         if self._rt_match(query_rt) == False:
             return None
-        elif self.distribution_name == 'normal':
-            rv = np.exp(
-                (-0.5 * (query_rt + self.distrib.ppf(self.cutoff / 2) - self.parameters[0]) ** 2) / self.parameters[
-                    1] ** 2)
-            return rv
+        elif self.table_rts is not None:
+            return np.interp(query_rt, self.table_rts, self.table_intensities)
+        else:
+            return self._compute_relative_intensity(query_rt)
+
+    def get_relative_intensity_many(self, query_rts):
+        """
+        Gets the relative intensities at many RTs at once
+        :param query_rts: an array of query RTs
+        :return: an array of relative intensities, NaN where the chromatogram is not defined
+        """
+        query_rts = np.asarray(query_rts, dtype=np.float64)
+        relative_intensities = np.full(len(query_rts), np.nan)
+        matched = (query_rts >= 0) & (query_rts <= self.max_rt)
+        if self.table_rts is not None:
+            relative_intensities[matched] = np.interp(query_rts[matched], self.table_rts, self.table_intensities)
         else:
-            return (self.distrib.pdf(query_rt + self.distrib.ppf(self.cutoff / 2)) * (1 / (1 - self.cutoff)))
+            relative_intensities[matched] = self._compute_relative_intensity(query_rts[matched])
+        return relative_intensities
 
     def get_relative_mz(self, query_rt):
         if self._rt_match(query_rt) == False:
@@ -166,6 +339,35 @@ class FunctionalChromatogram(Chromatogram):
         else:
             return self.mz
 
+    def _compute_relative_intensity(self, query_rt):
+        # works on scalars and arrays
+        if self.distribution_name == 'normal':
+            return np.exp((-0.5 * (query_rt + self.rt_offset - self.parameters[0]) ** 2) / self.parameters[1] ** 2)
+        else:
+            return (self.distrib.pdf(query_rt + self.rt_offset) * (1 / (1 - self.cutoff)))
+
+    def _tabulate(self, resolution, max_error, max_size=10 ** 7):
+        n_points = max(int(np.ceil(self.max_rt / resolution)), 1) + 1
+        rts = np.linspace(0, self.max_rt, n_points)
+        intensities = self._compute_relative_intensity(rts)
+        while 2 * n_points - 1 <= max_size:
+            midpoints = (rts[:-1] + rts[1:]) / 2
+            exact = self._compute_relative_intensity(midpoints)
+            if np.max(np.abs(exact - (intensities[:-1] + intensities[1:]) / 2)) <= max_error:
+                break
+            # halve the spacing, reusing the values already computed
+            n_points = 2 * n_points - 1
+            rts = np.linspace(0, self.max_rt, n_points)
+            refined = np.empty(n_points)
+            refined[0::2] = intensities
+            refined[1::2] = exact
+            intensities = refined
+        else:
+            logger.warning('The lookup table of a {} chromatogram stopped at {} points, the most allowed, so its '
+                           'interpolation error may be above max_error={}', self.distribution_name, n_points, max_error)
+        self.table_rts = rts
+        self.table_intensities = intensities
+
     def _rt_match(self, query_rt):
         if query_rt < 0 or query_rt > self.max_rt:
             return False
@@ -3,9 +3,21 @@ import copy
 import matplotlib.pyplot as plt
 import numpy as np
 
+from vimms.Common import GLOBAL_RNG, get_rng
+
 
 class Column(object):
-    def __init__(self, dataset, noise_sd):
+    # columns pickled before they had a generator draw from the global random state
+    rng = GLOBAL_RNG
+
+    def __init__(self, dataset, noise_sd, rng=None):
+        """
+        Creates a column, which shifts the RT of chemicals
+        :param dataset: a list of chemicals
+        :param noise_sd: the standard deviation of the noise added to the RT shifts
+        :param rng: the random number generator that draws the shifts, see vimms.Common.get_rng
+        """
+        self.rng = get_rng(rng)
         self.dataset = dataset
         self.dataset_rts = np.array([chem.rt for chem in self.dataset])
         self.dataset_apex_rts = np.array([chem.get_apex_rt() for chem in self.dataset])
@@ -14,7 +26,7 @@ class Column(object):
 
     def _get_offsets(self):
         true_offset_function = np.array([0.0 for chem in self.dataset])
-        offsets = true_offset_function + np.random.normal(0, self.noise_sd, len(self.dataset))
+        offsets = true_offset_function + self.rng.normal(0, self.noise_sd, len(self.dataset))
         return offsets, true_offset_function
 
     def get_dataset(self):
@@ -51,28 +63,29 @@ class Column(object):
 
 
 class CleanColumn(Column):
-    def __init__(self, dataset):
-        super().__init__(dataset, 0.0)
+    def __init__(self, dataset, rng=None):
+        super().__init__(dataset, 0.0, rng=rng)
 
 
 class LinearColumn(Column):
-    def __init__(self, dataset, noise_sd, intercept_params, linear_params):
+    def __init__(self, dataset, noise_sd, intercept_params, linear_params, rng=None):
+        self.rng = get_rng(rng)
         self.intercept_params = intercept_params
         self.linear_params = linear_params
-        self.intercept_term = np.random.normal(self.intercept_params[0], self.intercept_params[1])
-        self.linear_term = np.random.normal(self.linear_params[0], self.linear_params[1])
-        super().__init__(dataset, noise_sd)
+        self.intercept_term = self.rng.normal(self.intercept_params[0], self.intercept_params[1])
+        self.linear_term = self.rng.normal(self.linear_params[0], self.linear_params[1])
+        super().__init__(dataset, noise_sd, rng=self.rng)
 
     @staticmethod
-    def from_fixed_offsets(dataset, noise_sd, intercept_term, linear_term):
-        new = LinearColumn(dataset, noise_sd, (0, 0), (0, 0))
+    def from_fixed_offsets(dataset, noise_sd, intercept_term, linear_term, rng=None):
+        new = LinearColumn(dataset, noise_sd, (0, 0), (0, 0), rng=rng)
         new.intercept_term, new.linear_term = intercept_term, linear_term
         new.offsets, new.true_drift_function = new._get_offsets()
         return new
 
     def _get_offsets(self):
         true_offset_function = self.intercept_term + self.linear_term * self.dataset_apex_rts
-        offsets = true_offset_function + np.random.normal(0, self.noise_sd, len(self.dataset))
+        offsets = true_offset_function + self.rng.normal(0, self.noise_sd, len(self.dataset))
         return offsets, true_offset_function
 
     def drift_fn(self, roi, injection_number):
@@ -85,15 +98,15 @@ class LinearColumn(Column):
 
 
 class GaussianProcessColumn(Column):
-    def __init__(self, dataset, noise_sd, rbf_params, intercept_params, linear_params):
+    def __init__(self, dataset, noise_sd, rbf_params, intercept_params, linear_params, rng=None):
         self.rbf_params = rbf_params
         self.intercept_params = intercept_params
         self.linear_params = linear_params
-        super().__init__(dataset, noise_sd)
+        super().__init__(dataset, noise_sd, rng=rng)
 
     def _get_offsets(self):
-        intercept_term = np.random.normal(self.intercept_params[0], self.intercept_params[1])
-        linear_term = np.random.normal(self.linear_params[0], self.linear_params[1])
+        intercept_term = self.rng.normal(self.intercept_params[0], self.intercept_params[1])
+        linear_term = self.rng.normal(self.linear_params[0], self.linear_params[1])
         mean = intercept_term + linear_term * self.dataset_apex_rts
         return self._draw_offset(mean)
 
@@ -104,6 +117,6 @@ class GaussianProcessColumn(Column):
             for m in range(N):
                 K[n, m] = self.rbf_params[0] * np.exp(
                     -(1. / self.rbf_params[1]) * (self.dataset_apex_rts[n] - self.dataset_apex_rts[m]) ** 2)
-        true_offset_function = np.random.multivariate_normal(mean, K)
-        offsets = true_offset_function + np.random.normal(0, self.noise_sd, N)
+        true_offset_function = self.rng.multivariate_normal(mean, K)
+        offsets = true_offset_function + self.rng.normal(0, self.noise_sd, N)
         return offsets, true_offset_function
@@ -1,5 +1,6 @@
 import collections
 import gzip
+import inspect
 import logging
 import math
 import os
@@ -409,6 +410,32 @@ def find_nearest_index_in_array(array, value):
     return idx
 
 
+def counts_to_offsets(counts):
+    """
+    Converts the lengths of consecutive slices of an array into their offsets, so that slice k is
+    offsets[k]:offsets[k + 1]
+    :param counts: an array of slice lengths
+    :return: an int64 array of len(counts) + 1 offsets, starting at 0
+    """
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def expand_ranges(starts, counts):
+    """
+    Concatenates the ranges [starts[k], starts[k] + counts[k]) into a single index array
+    :param starts: an array of the first index of each range
+    :param counts: an array of the length of each range
+    :return: an int64 array of all the indices in the ranges, in order
+    """
+    total = int(np.sum(counts))
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    run_starts = np.cumsum(counts) - counts
+    return np.repeat(starts - run_starts, counts) + np.arange(total, dtype=np.int64)
+
+
 def download_file(url, out_file=None):
     r = requests.get(url, stream=True)
     total_size = int(r.headers.get('content-length', 0));
@@ -439,8 +466,65 @@ def extract_zip_file(in_file, delete=True):
         os.remove(in_file)
 
 
-def uniform_list(N, min_val, max_val):
-    return list(np.random.rand(N) * (max_val - min_val) + min_val)
+class GlobalRandomState(object):
+    """
+    Draws random numbers from numpy's global random state, through the same methods as numpy.random. This is what
+    is used when no random number generator is given, so that np.random.seed keeps controlling those draws.
+    """
+
+    def __getattr__(self, name):
+        return getattr(np.random, name)
+
+    def __reduce__(self):
+        return 'GLOBAL_RNG'
+
+    def __repr__(self):
+        return 'GlobalRandomState'
+
+
+# the shared instance of GlobalRandomState
+GLOBAL_RNG = GlobalRandomState()
+
+
+def get_rng(rng=None):
+    """
+    Gets a random number generator. Only the methods that numpy.random.Generator has in common with the global
+    random state (e.g. random, normal, choice, poisson) should be used on the result.
+    :param rng: None to use numpy's global random state, an int or numpy.random.SeedSequence to create a new
+    numpy.random.Generator, or a Generator (or RandomState), which is returned as it is
+    :return: a random number generator
+    """
+    if rng is None:
+        return GLOBAL_RNG
+    if isinstance(rng, (np.random.Generator, np.random.RandomState, GlobalRandomState)):
+        return rng
+    return np.random.default_rng(rng)
+
+
+def spawn_rngs(seed, n):
+    """
+    Creates independent random number generators, e.g. one for each injection of an experiment run in parallel.
+    The same seed always gives the same generators, and the streams of the generators don't overlap.
+    :param seed: an int or numpy.random.SeedSequence
+    :param n: the number of generators
+    :return: a list of numpy.random.Generator objects
+    """
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return [np.random.default_rng(child) for child in seed_sequence.spawn(n)]
+
+
+def takes_rng(method):
+    """
+    Checks whether a method takes a random number generator, so that objects written before methods took one
+    (e.g. custom noise or samplers) can still be called without it, and use numpy's global random state
+    :param method: the method
+    :return: True if the method has an rng parameter
+    """
+    return 'rng' in inspect.signature(method).parameters
+
+
+def uniform_list(N, min_val, max_val, rng=None):
+    return list(get_rng(rng).random(N) * (max_val - min_val) + min_val)
 
 
 def get_default_scan_params(polarity=POSITIVE, agc_target=DEFAULT_MS1_AGC_TARGET, max_it=DEFAULT_MS1_MAXIT,
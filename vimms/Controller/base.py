@@ -10,6 +10,7 @@ from vimms.Common import DEFAULT_MS1_SCAN_WINDOW, DEFAULT_MS1_AGC_TARGET, DEFAUL
     DEFAULT_MS2_MAXIT, DEFAULT_MS2_COLLISION_ENERGY, DEFAULT_MS2_ORBITRAP_RESOLUTION, DEFAULT_MS2_ACTIVATION_TYPE, \
     DEFAULT_MS2_MASS_ANALYSER, DEFAULT_MS2_ISOLATION_MODE, INITIAL_SCAN_ID, ScanParameters, get_default_scan_params, \
     get_dda_scan_param
+from vimms.Timing import NULL_TIMER
 
 
 class AdvancedParams(object):
@@ -53,6 +54,9 @@ class AdvancedParams(object):
 
 
 class Controller(object):
+    # records how long each stage of processing a scan takes, set by the environment when timing is enabled
+    timer = NULL_TIMER
+
     def __init__(self, params=None):
         if params is None:
             self.params = AdvancedParams()
@@ -60,6 +64,7 @@ class Controller(object):
             self.params = params
 
         self.scans = defaultdict(list)  # key: ms level, value: list of scans for that level
+        self.keep_scans = True  # whether to record the scans received in self.scans
         self.scan_to_process = None
         self.environment = None
         self.next_processed_scan_id = INITIAL_SCAN_ID
@@ -117,11 +122,12 @@ class Controller(object):
         self.environment = env
 
     def handle_scan(self, scan, current_size, pending_size):
-        logger.debug('tasks to be sent = %d' % (current_size))
-        logger.debug('tasks sent but not received = %d' % (pending_size))
+        logger.debug('tasks to be sent = {}', current_size)
+        logger.debug('tasks sent but not received = {}', pending_size)
 
         # record every scan that we've received
-        self.scans[scan.ms_level].append(scan)
+        if self.keep_scans:
+            self.scans[scan.ms_level].append(scan)
 
         # update ms1 time (used for ROI matching)
         if scan.ms_level == 1:
@@ -131,15 +137,14 @@ class Controller(object):
         # we get an ms1 scan and it has some peaks AND all the pending tasks have been sent and processed AND
         # this ms1 scan is a custom scan we'd sent before (not a method scan)
         # then store it for fragmentation next time
-        logger.debug(
-            'scan.scan_id = %d, self.next_processed_scan_id = %d' % (scan.scan_id, self.next_processed_scan_id))
+        logger.debug('scan.scan_id = {}, self.next_processed_scan_id = {}', scan.scan_id, self.next_processed_scan_id)
         if scan.scan_id == self.next_processed_scan_id:
             self.scan_to_process = scan
-            logger.debug('Next processed scan %d has arrived' % self.next_processed_scan_id)
+            logger.debug('Next processed scan {} has arrived', self.next_processed_scan_id)
         else:
             self.scan_to_process = None
-        logger.debug('scan_to_process = %s' % self.scan_to_process)
-        logger.debug('scan.scan_params = %s' % scan.scan_params)
+        logger.debug('scan_to_process = {}', self.scan_to_process)
+        logger.debug('scan.scan_params = {}', scan.scan_params)
 
         # implemented by subclass
         if self.scan_to_process is not None:
@@ -157,6 +162,15 @@ class Controller(object):
     def update_state_after_scan(self, last_scan):
         raise NotImplementedError()
 
+    def is_stateless_for_empty_scans(self):
+        """
+        Whether this controller only responds to an empty MS1 scan by scheduling the next MS1 scan, without changing
+        any other state. The environment can then skip over the times when no chemicals elute, see the
+        fast_forward parameter of Environment.
+        :return: False, unless overridden by subclass
+        """
+        return False
+
     def dump_scans(self, output_method):
         all_scans = self.scans[1] + self.scans[2]
         all_scans.sort(key=lambda x: x.scan_id)  # sort by scan_id
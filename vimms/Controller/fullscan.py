@@ -38,3 +38,6 @@ class SimpleMs1Controller(Controller):
 
     def update_state_after_scan(self, last_scan):
         pass
+
+    def is_stateless_for_empty_scans(self):
+        return True
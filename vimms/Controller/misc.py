@@ -57,8 +57,9 @@ class FixedScansController(Controller):
 
     def handle_scan(self, scan, current_size, pending_size):
         # simply record every scan that we've received, but return no new tasks
-        logger.debug('Time %f Received %s' % (scan.rt, scan))
-        self.scans[scan.ms_level].append(scan)
+        logger.debug('Time {:f} Received {}', scan.rt, scan)
+        if self.keep_scans:
+            self.scans[scan.ms_level].append(scan)
         return []
 
     def update_state_after_scan(self, last_scan):
@@ -1,4 +1,3 @@
-import bisect
 from copy import deepcopy
 
 import numpy as np
@@ -8,8 +7,8 @@ from mass_spec_utils.data_import.mzml import MZMLFile
 from vimms.Common import ROI_EXCLUSION_DEW, ROI_EXCLUSION_WEIGHTED_DEW
 from vimms.Controller.topN import TopNController
 from vimms.Exclusion import MinIntensityFilter, LengthFilter, SmartROIFilter, WeightedDEWExclusion, DEWFilter, \
-    WeightedDEWFilter
-from vimms.Roi import match, Roi, SmartRoi
+    WeightedDEWFilter, CompositeFilter, ScoreCandidates
+from vimms.Roi import Roi, SmartRoi
 
 
 class RoiBuilder():
@@ -32,11 +31,26 @@ class RoiBuilder():
         assert self.roi_type in [RoiBuilder.ROI_TYPE_NORMAL, RoiBuilder.ROI_TYPE_SMART]
 
         # Create ROI
-        self.live_roi = []
+        self.live_roi = []  # sorted by mean m/z
         self.dead_roi = []
         self.junk_roi = []
-        self.live_roi_fragmented = []
-        self.live_roi_last_rt = []  # last fragmentation time of ROI
+
+        # the state of the live ROIs as arrays, in the same order as live_roi
+        self.live_mz_sums = np.zeros(0, dtype=np.float64)
+        self.live_ns = np.zeros(0, dtype=np.int64)
+        self.live_first_rts = np.zeros(0, dtype=np.float64)
+        self.live_last_mzs = np.zeros(0, dtype=np.float64)
+        self.live_last_intensities = np.zeros(0, dtype=np.float64)
+        self.live_max_intensities = np.zeros(0, dtype=np.float64)
+        self.live_ids = np.zeros(0, dtype=np.int64)
+        self.live_roi_fragmented = np.zeros(0, dtype=bool)
+        self.live_roi_last_rt = np.zeros(0, dtype=np.float64)  # last fragmentation time of ROI, NaN if never
+
+        # the live ROIs after the last MS1 scan, for the controllers
+        self.current_roi_ids = self.live_ids
+        self.current_roi_mzs = self.live_last_mzs
+        self.current_roi_intensities = self.live_last_intensities
+        self.current_roi_length = self.live_ns
 
         # fragmentation to Roi dictionaries
         self.frag_roi_dicts = []  # scan_id, roi_id, precursor_intensity
@@ -52,61 +66,136 @@ class RoiBuilder():
         self.register_all_roi = register_all_roi
 
     def update_roi(self, new_scan):
+        """
+        Adds the peaks of an MS1 scan to the live ROIs, or starts new ROIs with them. Each peak is assigned to the
+        live ROI with the nearest mean m/z within mz_tol. An ROI that several peaks are assigned to is extended by
+        all of them, in the order of the scan, rather than splitting into near-duplicate ROIs. Live ROIs that weren't
+        extended end, and are kept if they are at least min_roi_length long.
+        :param new_scan: the scan
+        """
         if new_scan.ms_level == 1:
-            order = np.argsort(self.live_roi)
-            self.live_roi.sort()
-            self.live_roi_fragmented = np.array(self.live_roi_fragmented)[order].tolist()
-            self.live_roi_last_rt = np.array(self.live_roi_last_rt)[order].tolist()
             current_ms1_scan_rt = new_scan.rt
-            not_grew = set(self.live_roi)
-            for idx in range(len(new_scan.intensities)):
-                intensity = new_scan.intensities[idx]
-                mz = new_scan.mzs[idx]
-                if intensity >= self.min_roi_intensity:
-                    roi = self._get_roi_obj(mz, 0, 0, None)
-                    match_roi = match(roi, self.live_roi, self.mz_tol, mz_units=self.mz_units)
-                    if match_roi:
-                        match_roi.add(mz, current_ms1_scan_rt, intensity)
-                        if match_roi in not_grew:
-                            not_grew.remove(match_roi)
-                    else:
-                        new_roi = self._get_roi_obj(mz, current_ms1_scan_rt, intensity, self.roi_id_counter)
-                        self.roi_id_counter += 1
-                        bisect.insort_right(self.live_roi, new_roi)
-                        self.live_roi_fragmented.insert(self.live_roi.index(new_roi), False)
-                        self.live_roi_last_rt.insert(self.live_roi.index(new_roi), None)
-                        if self.register_all_roi and self.grid is not None:
-                            self.grid.register_roi(new_roi)
-
-            for roi in not_grew:
-                if self.length_units == "scans":
-                    if roi.n >= self.min_roi_length:
-                        self.dead_roi.append(roi)
-                    else:
-                        self.junk_roi.append(roi)
+            keep = np.asarray(new_scan.intensities) >= self.min_roi_intensity
+            mzs = np.asarray(new_scan.mzs, dtype=np.float64)[keep]
+            intensities = np.asarray(new_scan.intensities, dtype=np.float64)[keep]
+            roi_idx = self._match_peaks(mzs)
+
+            # extend the ROIs that peaks were assigned to
+            extended = np.flatnonzero(roi_idx >= 0)
+            rois = roi_idx[extended]
+            for i, mz, intensity in zip(rois.tolist(), mzs[extended], intensities[extended]):
+                self.live_roi[i].add(mz, current_ms1_scan_rt, intensity)
+            # unbuffered, so that an ROI extended by several peaks sums them in the same order as Roi.add
+            np.add.at(self.live_mz_sums, rois, mzs[extended])
+            self.live_ns += np.bincount(rois, minlength=len(self.live_roi))
+            np.maximum.at(self.live_max_intensities, rois, intensities[extended])
+            uniq, last_from_end = np.unique(rois[::-1], return_index=True)
+            last = extended[len(rois) - 1 - last_from_end]
+            self.live_last_mzs[uniq] = mzs[last]
+            self.live_last_intensities[uniq] = intensities[last]
+
+            # end the others
+            grew = np.zeros(len(self.live_roi), dtype=bool)
+            grew[rois] = True
+            for i in np.flatnonzero(~grew).tolist():
+                roi = self.live_roi[i]
+                length = roi.n if self.length_units == "scans" else roi.length_in_seconds
+                if length >= self.min_roi_length:
+                    self.dead_roi.append(roi)
+                else:
+                    self.junk_roi.append(roi)
+
+            # start new ROIs with the unassigned peaks, close peaks sharing one, in the order of the scan
+            new_peaks = np.flatnonzero(roi_idx < 0)
+            new_mzs, new_intensities = mzs[new_peaks], intensities[new_peaks]
+            groups = self._group_new_peaks(new_mzs)
+            n_new = int(groups.max()) + 1 if len(groups) > 0 else 0
+            new_rois = [None] * n_new
+            for g, mz, intensity in zip(groups.tolist(), new_mzs, new_intensities):
+                if new_rois[g] is None:
+                    new_roi = self._get_roi_obj(mz, current_ms1_scan_rt, intensity, self.roi_id_counter)
+                    self.roi_id_counter += 1
+                    new_rois[g] = new_roi
+                    if self.register_all_roi and self.grid is not None:
+                        self.grid.register_roi(new_roi)
                 else:
-                    if roi.length_in_seconds >= self.min_roi_length:
-                        self.dead_roi.append(roi)
-                    else:
-                        self.junk_roi.append(roi)
-
-                pos = self.live_roi.index(roi)
-                del self.live_roi[pos]
-                del self.live_roi_fragmented[pos]
-                del self.live_roi_last_rt[pos]
-
-            self.current_roi_ids = [roi.id for roi in self.live_roi]
-            self.current_roi_mzs = [roi.mz_list[-1] for roi in self.live_roi]
+                    new_rois[g].add(mz, current_ms1_scan_rt, intensity)
+            new_mz_sums = np.zeros(n_new, dtype=np.float64)
+            np.add.at(new_mz_sums, groups, new_mzs)
+            new_max_intensities = np.full(n_new, -np.inf)
+            np.maximum.at(new_max_intensities, groups, new_intensities)
+            _, last_from_end = np.unique(groups[::-1], return_index=True)
+            new_last = len(groups) - 1 - last_from_end
+
+            # the live ROIs are the extended and the new ones, sorted by mean m/z
+            grew = np.flatnonzero(grew)
+            live_roi = np.empty(len(grew) + n_new, dtype=object)
+            live_roi[:len(grew)] = [self.live_roi[i] for i in grew.tolist()]
+            live_roi[len(grew):] = new_rois
+            columns = {
+                'live_mz_sums': (self.live_mz_sums[grew], new_mz_sums),
+                'live_ns': (self.live_ns[grew], np.bincount(groups, minlength=n_new).astype(np.int64)),
+                'live_first_rts': (self.live_first_rts[grew], np.full(n_new, current_ms1_scan_rt, dtype=np.float64)),
+                'live_last_mzs': (self.live_last_mzs[grew], new_mzs[new_last]),
+                'live_last_intensities': (self.live_last_intensities[grew], new_intensities[new_last]),
+                'live_max_intensities': (self.live_max_intensities[grew], new_max_intensities),
+                'live_ids': (self.live_ids[grew], np.array([roi.id for roi in new_rois], dtype=np.int64)),
+                'live_roi_fragmented': (self.live_roi_fragmented[grew], np.zeros(n_new, dtype=bool)),
+                'live_roi_last_rt': (self.live_roi_last_rt[grew], np.full(n_new, np.nan))
+            }
+            columns = {name: np.concatenate(values) for name, values in columns.items()}
+            # the extended ROIs are almost in order already, which the stable sort is fast for
+            order = np.argsort(columns['live_mz_sums'] / columns['live_ns'], kind='stable')
+            for name, values in columns.items():
+                setattr(self, name, values[order])
+            self.live_roi = live_roi[order].tolist()
+
+            self.current_roi_ids = self.live_ids
+            self.current_roi_mzs = self.live_last_mzs
             if self.roi_type == RoiBuilder.ROI_TYPE_NORMAL:
-                self.current_roi_intensities = [roi.intensity_list[-1] for roi in self.live_roi]
+                self.current_roi_intensities = self.live_last_intensities
             elif self.roi_type == RoiBuilder.ROI_TYPE_SMART:
-                self.current_roi_intensities = [roi.get_max_intensity() for roi in self.live_roi]
+                self.current_roi_intensities = self.live_max_intensities
 
             # FIXME: only the 'scans' mode seems to work on the real mass spec (IAPI), why??
             if self.length_units == "scans":
-                self.current_roi_length = np.array([roi.n for roi in self.live_roi])
+                self.current_roi_length = self.live_ns
             else:
-                self.current_roi_length = np.array([roi.length_in_seconds for roi in self.live_roi])
+                self.current_roi_length = current_ms1_scan_rt - self.live_first_rts
+
+    def _match_peaks(self, mzs):
+        # the index of the live ROI that each peak is assigned to, or -1, as in match() but for all peaks at once
+        n_live = len(self.live_roi)
+        if n_live == 0:
+            return np.full(len(mzs), -1, dtype=np.int64)
+        mean_mzs = self.live_mz_sums / self.live_ns
+        pos = np.searchsorted(mean_mzs, mzs, side='left')
+        left, right = np.maximum(pos - 1, 0), np.minimum(pos, n_live - 1)
+        dist_left, dist_right = mzs - mean_mzs[left], mean_mzs[right] - mzs
+        if self.mz_units == 'ppm':
+            dist_left, dist_right = 1e6 * dist_left / mzs, 1e6 * dist_right / mzs
+        ok_left = (pos > 0) & (dist_left < self.mz_tol)
+        ok_right = (pos < n_live) & (dist_right < self.mz_tol)
+        use_left = ok_left & ~(ok_right & (dist_right < dist_left))
+        return np.where(use_left, left, np.where(ok_right, right, -1))
+
+    def _group_new_peaks(self, mzs):
+        # the new ROI that each unassigned peak starts or joins, numbered in m/z order. The peaks are swept in m/z
+        # order and each joins the last new ROI if it is within mz_tol of its running mean m/z, as match() would
+        # have matched it against the ROIs started earlier in the scan
+        groups = np.empty(len(mzs), dtype=np.int64)
+        order = np.argsort(mzs, kind='stable')
+        group, mz_sum, n = -1, 0.0, 0
+        for i, mz in zip(order.tolist(), mzs[order].tolist()):
+            dist = mz - mz_sum / n if n > 0 else np.inf
+            if self.mz_units == 'ppm':
+                dist = 1e6 * dist / mz
+            if dist >= self.mz_tol:
+                group, mz_sum, n = group + 1, 0.0, 0
+            mz_sum += mz
+            n += 1
+            groups[i] = group
+        return groups
 
     def _get_roi_obj(self, mz, rt, intensity, roi_id):
         if self.roi_type == RoiBuilder.ROI_TYPE_NORMAL:
@@ -119,7 +208,7 @@ class RoiBuilder():
     def get_mz_intensity(self, i):
         mz = self.current_roi_mzs[i]
         intensity = self.current_roi_intensities[i]
-        roi_id = self.current_roi_ids[i]
+        roi_id = int(self.current_roi_ids[i])
         return mz, intensity, roi_id
 
     def set_fragmented(self, current_task_id, i, roi_id, rt, intensity):
@@ -139,8 +228,7 @@ class RoiBuilder():
     def add_scan_to_roi(self, scan):
         frag_event_ids = np.array([event['scan_id'] for event in self.frag_roi_dicts])
         which_event = np.where(frag_event_ids == scan.scan_id)[0]
-        live_roi_ids = np.array([roi.id for roi in self.live_roi])
-        which_roi = np.where(live_roi_ids == self.frag_roi_dicts[which_event[0]]['roi_id'])[0]
+        which_roi = np.where(self.live_ids == self.frag_roi_dicts[which_event[0]]['roi_id'])[0]
         if len(which_roi) > 0:
             self.live_roi[which_roi[0]].add_fragmentation_event(
                 scan, self.frag_roi_dicts[which_event[0]]['precursor_intensity'])
@@ -178,7 +266,7 @@ class RoiController(TopNController):
         ms1_scan_params = self.get_ms1_scan_params()
         self.current_task_id += 1
         self.next_processed_scan_id = self.current_task_id
-        logger.debug('Created the next processed scan %d' % (self.next_processed_scan_id))
+        logger.debug('Created the next processed scan {}', self.next_processed_scan_id)
         new_tasks.append(ms1_scan_params)
 
     class MS2Scheduler():
@@ -206,7 +294,7 @@ class RoiController(TopNController):
             done_ms1, ms2s, scores = False, self.MS2Scheduler(self), self._get_scores()
             for i in np.argsort(scores)[::-1]:
                 if scores[i] <= 0:  # stopping criteria is done based on the scores
-                    logger.debug('Time %f Top-%d ions have been selected' % (rt, self.N))
+                    logger.debug('Time {:f} Top-{} ions have been selected', rt, self.N)
                     break
 
                 mz, intensity, roi_id = self.roi_builder.get_mz_intensity(i)
@@ -228,34 +316,53 @@ class RoiController(TopNController):
             self.roi_builder.add_scan_to_roi(scan)
             return []
 
+    def is_stateless_for_empty_scans(self):
+        # live ROIs are ended by the empty scans that follow them
+        return False
+
     ####################################################################################################################
     # Scoring functions
     ####################################################################################################################
 
+    def _get_candidates(self):
+        # the live ROIs as arrays, for the filters
+        roi_builder = self.roi_builder
+        can_fragment = None
+        if roi_builder.roi_type == RoiBuilder.ROI_TYPE_SMART:
+            can_fragment = [roi.get_can_fragment() for roi in roi_builder.live_roi]
+        return ScoreCandidates(self.scan_to_process.rt, mzs=roi_builder.current_roi_mzs,
+                               intensities=roi_builder.current_roi_intensities,
+                               last_frag_rts=roi_builder.live_roi_last_rt,
+                               roi_lengths=roi_builder.current_roi_length, can_fragment=can_fragment)
+
     def _log_roi_intensities(self):
         return np.log(self.roi_builder.current_roi_intensities)
 
     def _min_intensity_filter(self):
-        f = MinIntensityFilter(self.min_ms1_intensity)
-        return f.filter(self.roi_builder.current_roi_intensities)
+        return MinIntensityFilter(self.min_ms1_intensity).apply(self._get_candidates())
 
-    def _time_filter(self):
+    def _get_time_filter(self):
         if self.exclusion_method == ROI_EXCLUSION_DEW:
-            f = DEWFilter(self.rt_tol)
+            return DEWFilter(self.rt_tol)
         elif self.exclusion_method == ROI_EXCLUSION_WEIGHTED_DEW:
-            f = WeightedDEWFilter(self.rt_tol, self.exclusion_t_0)
-        return f.filter(self.scan_to_process.rt, self.roi_builder.live_roi_last_rt)
+            return WeightedDEWFilter(self.rt_tol, self.exclusion_t_0)
+
+    def _time_filter(self):
+        return self._get_time_filter().apply(self._get_candidates())
 
     def _length_filter(self):
-        f = LengthFilter(self.roi_builder.min_roi_length_for_fragmentation)
-        return f.filter(self.roi_builder.current_roi_length)
+        return LengthFilter(self.roi_builder.min_roi_length_for_fragmentation).apply(self._get_candidates())
 
     def _smartroi_filter(self):
-        f = SmartROIFilter()
-        return f.filter(self.roi_builder.live_roi)
+        return SmartROIFilter().apply(self._get_candidates())
+
+    def _get_score_filter(self):
+        # the filters that a live ROI has to pass to be fragmented
+        return CompositeFilter([MinIntensityFilter(self.min_ms1_intensity), self._get_time_filter(),
+                                LengthFilter(self.roi_builder.min_roi_length_for_fragmentation)])
 
     def _score_filters(self):
-        return self._min_intensity_filter() * self._time_filter() * self._length_filter()
+        return self._get_score_filter().apply(self._get_candidates())
 
     def _get_dda_scores(self):
         return self._log_roi_intensities() * self._score_filters()
@@ -286,7 +393,8 @@ class TopN_SmartRoiController(RoiController):
                                       length_units=length_units, roi_type=RoiBuilder.ROI_TYPE_SMART)
 
     def _get_dda_scores(self):
-        return self._log_roi_intensities() * self._min_intensity_filter() * self._smartroi_filter()
+        f = CompositeFilter([MinIntensityFilter(self.min_ms1_intensity), SmartROIFilter()])
+        return self._log_roi_intensities() * f.apply(self._get_candidates())
 
     def _get_scores(self):
         initial_scores = self._get_dda_scores()
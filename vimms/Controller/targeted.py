@@ -9,6 +9,7 @@ from molmass import Formula
 from vimms.Common import DEFAULT_ISOLATION_WIDTH, ScanParameters
 from vimms.Controller.base import Controller
 from vimms.Exclusion import TopNExclusion
+from vimms.Timing import STAGE_EXCLUSION_UPDATE
 
 
 def create_targets_from_toxid(toxid_file_name, file_rt_units='minutes', mz_delta=10, rt_delta=60.,
@@ -240,7 +241,9 @@ class SimpleTargetController(Controller):
             new_tasks.append(ms1_scan_params)
 
             # create new exclusion items based on the scheduled ms2 tasks
+            start = self.timer.start()
             self.exclusion.update(self.scan_to_process, ms2_tasks)
+            self.timer.stop(STAGE_EXCLUSION_UPDATE, start)
 
             # set this ms1 scan as has been processed
             self.scan_to_process = None
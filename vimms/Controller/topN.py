@@ -4,6 +4,7 @@ from loguru import logger
 from vimms.Common import DUMMY_PRECURSOR_MZ
 from vimms.Controller.base import Controller
 from vimms.Exclusion import TopNExclusion, WeightedDEWExclusion
+from vimms.Timing import STAGE_EXCLUSION_UPDATE
 
 
 class TopNController(Controller):
@@ -39,8 +40,13 @@ class TopNController(Controller):
             assert mzs.shape == intensities.shape
             rt = self.scan_to_process.rt
 
-            # loop over points in decreasing intensity
-            idx = np.argsort(intensities)[::-1]
+            # the top-N ions above the minimum intensity that are not in the dynamic exclusion list,
+            # in decreasing intensity
+            candidates = np.flatnonzero(intensities >= self.min_ms1_intensity)
+            excluded, _ = self.exclusion.is_excluded_many(mzs[candidates], rt)
+            idx = get_top_n(intensities, candidates[~excluded], self.N)
+            logger.debug('Time {:f} Selected {} of {} ions above minimum intensity {:f}', rt, len(idx),
+                         len(candidates), self.min_ms1_intensity)
 
             done_ms1 = False
             ms2_tasks = []
@@ -48,22 +54,6 @@ class TopNController(Controller):
                 mz = mzs[i]
                 intensity = intensities[i]
 
-                # stopping criteria is after we've fragmented N ions or we found ion < min_intensity
-                if fragmented_count >= self.N:
-                    logger.debug('Time %f Top-%d ions have been selected' % (rt, self.N))
-                    break
-
-                if intensity < self.min_ms1_intensity:
-                    logger.debug(
-                        'Time %f Minimum intensity threshold %f reached at %f, %d' % (
-                            rt, self.min_ms1_intensity, intensity, fragmented_count))
-                    break
-
-                # skip ion in the dynamic exclusion list of the mass spec
-                is_exc, weight = self.exclusion.is_excluded(mz, rt)
-                if is_exc:
-                    continue
-
                 # create a new ms2 scan parameter to be sent to the mass spec
                 precursor_scan_id = self.scan_to_process.scan_id
                 dda_scan_params = self.get_ms2_scan_params(mz, intensity, precursor_scan_id, self.isolation_width,
@@ -103,7 +93,9 @@ class TopNController(Controller):
                 new_tasks.append(ms1_scan_params)
 
             # create new exclusion items based on the scheduled ms2 tasks
+            start = self.timer.start()
             self.exclusion.update(self.scan_to_process, ms2_tasks)
+            self.timer.stop(STAGE_EXCLUSION_UPDATE, start)
 
             # set this ms1 scan as has been processed
             self.scan_to_process = None
@@ -113,6 +105,27 @@ class TopNController(Controller):
         # update dynamic exclusion list after time has been increased
         self.exclusion.cleanup(scan)
 
+    def is_stateless_for_empty_scans(self):
+        # exclusion windows are checked against their RT range, so cleaning them up less often doesn't matter.
+        # With force_N, dummy MS2 scans are scheduled even after an empty scan.
+        return not self.force_N
+
+
+def get_top_n(values, candidates, n):
+    """
+    Selects the candidates with the largest values, without sorting all of them
+    :param values: an array of values
+    :param candidates: an array of indices into values to select from
+    :param n: the number of candidates to select
+    :return: the indices of the (up to) n candidates with the largest values, in decreasing order of value
+    """
+    if n <= 0:
+        return candidates[:0]
+    if len(candidates) > n:
+        top = np.argpartition(values[candidates], len(candidates) - n)[len(candidates) - n:]
+        candidates = candidates[top]
+    return candidates[np.argsort(values[candidates])[::-1]]
+
 
 class ScanItem(object):
     """
@@ -161,8 +174,8 @@ class WeightedDEWController(TopNController):
                 mzi = [ScanItem(mz, np.log(intensities[i])) for i, mz in enumerate(mzs) if
                        intensities[i] >= self.min_ms1_intensity]
 
-            for si in mzi:
-                is_exc, weight = self.exclusion.is_excluded(si.mz, rt)
+            _, weights = self.exclusion.is_excluded_many([si.mz for si in mzi], rt)
+            for si, weight in zip(mzi, weights.tolist()):
                 si.weight = weight
 
             mzi.sort(reverse=True)
@@ -174,7 +187,7 @@ class WeightedDEWController(TopNController):
                 # intensity = mzi[i].intensity
                 # stopping criteria is after we've fragmented N ions or we found ion < min_intensity
                 if fragmented_count >= self.N:
-                    logger.debug('Time %f Top-%d ions have been selected' % (rt, self.N))
+                    logger.debug('Time {:f} Top-{} ions have been selected', rt, self.N)
                     break
 
                 mz = mzi[i].mz
@@ -187,9 +200,7 @@ class WeightedDEWController(TopNController):
                 #     print(mz,intensity,mzi[i].weight)
 
                 if mzi[i].weight == 0.0:
-                    logger.debug(
-                        'Time %f no ions left reached at %f, %d' % (
-                            rt, intensity, fragmented_count))
+                    logger.debug('Time {:f} no ions left reached at {:f}, {}', rt, intensity, fragmented_count)
                     break
 
                 # create a new ms2 scan parameter to be sent to the mass spec
@@ -218,7 +229,9 @@ class WeightedDEWController(TopNController):
                 new_tasks.append(ms1_scan_params)
 
             # create new exclusion items based on the scheduled ms2 tasks
+            start = self.timer.start()
             self.exclusion.update(self.scan_to_process, ms2_tasks)
+            self.timer.stop(STAGE_EXCLUSION_UPDATE, start)
 
             # set this ms1 scan as has been processed
             self.scan_to_process = None
@@ -57,7 +57,7 @@ class BaseController(Controller):
         ms1_scan_params = self.get_ms1_scan_params()
         self.current_task_id += 1
         self.next_processed_scan_id = self.current_task_id
-        logger.debug('Created the next processed scan %d' % (self.next_processed_scan_id))
+        logger.debug('Created the next processed scan {}', self.next_processed_scan_id)
         self.done_ms1 = True
         return ms1_scan_params
 
@@ -1,31 +1,68 @@
+import random
+import sys
+import time
 from pathlib import Path
 
+import numpy as np
 import pylab as plt
 from loguru import logger
 from tqdm import tqdm
 
-from vimms.Common import save_obj
+from vimms.Checkpoint import save_checkpoint, load_checkpoint
+from vimms.Common import save_obj, ScanParameters
 from vimms.MassSpec import IndependentMassSpectrometer
-from vimms.MzmlWriter import MzmlWriter
+from vimms.MzmlWriter import MzmlWriter, StreamingMzmlWriter
+from vimms.Timing import NULL_TIMER, StageTimer, STAGE_CONTROLLER, STAGE_MZML_WRITING, STAGE_UPDATE_STATE
 
 
 class Environment(object):
-    def __init__(self, mass_spec, controller, min_time, max_time, progress_bar=True, out_dir=None, out_file=None):
+    def __init__(self, mass_spec, controller, min_time, max_time, progress_bar=True, out_dir=None, out_file=None,
+                 stream_mzml=False, keep_scans=True, quiet=False, timing=False, checkpoint_path=None,
+                 checkpoint_interval=600, fast_forward=False):
         """
         Initialises a synchronous environment to run the mass spec and controller
         :param mass_spec: An instance of Mass Spec object
         :param controller: An instance of Controller object
         :param min_time: start time
         :param max_time: end time
-        :param progress_bar: True if a progress bar is to be shown
+        :param progress_bar: True if a progress bar is to be shown. It is only shown in interactive sessions
+        (a terminal or a notebook), so that scripts and batch jobs don't pay for updating it.
+        :param out_dir: output directory of the mzML file, if any
+        :param out_file: output filename of the mzML file, if any
+        :param stream_mzml: if True, scans are written to the mzML file as they arrive instead of at the end
+        :param keep_scans: if False, the controller doesn't keep the scans it receives. Use together with
+        stream_mzml so that memory use doesn't grow with the length of the run.
+        :param quiet: if True, log messages from vimms are disabled while the environment runs
+        :param timing: if True, the wall and CPU time of each stage of every scan are recorded in self.timer,
+        see vimms.Timing.StageTimer
+        :param checkpoint_path: if given, the full state of the run is saved to this file every checkpoint_interval
+        seconds, so that an interrupted run can be continued with Environment.resume. Can't be used with stream_mzml,
+        since a partly written mzML file can't be resumed.
+        :param checkpoint_interval: how often to save a checkpoint, in seconds of wall time
+        :param fast_forward: if True, and the controller is stateless for empty scans (see
+        Controller.is_stateless_for_empty_scans), the times when no chemicals elute are skipped without producing
+        any scans, e.g. before the first chemical elutes and during the column wash. Otherwise, a scan is made
+        every scan duration as usual, although scans without chemicals are cheap to make. Nothing is skipped when
+        the mass spec adds spike noise, since its scans are never empty.
         """
+        if checkpoint_path is not None and stream_mzml:
+            raise ValueError('Checkpointing is not supported when streaming the mzML file')
         self.mass_spec = mass_spec
         self.controller = controller
         self.min_time = min_time
         self.max_time = max_time
-        self.progress_bar = progress_bar
+        self.progress_bar = progress_bar and _is_interactive()
         self.out_dir = out_dir
         self.out_file = out_file
+        self.stream_mzml = stream_mzml
+        self.keep_scans = keep_scans
+        self.quiet = quiet
+        self.timer = StageTimer() if timing else NULL_TIMER
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = None
+        self.fast_forward = fast_forward
+        self.mzml_stream = None
         self.pending_tasks = []
         self.bar = tqdm(total=self.max_time - self.min_time, initial=0) if self.progress_bar else None
 
@@ -34,10 +71,79 @@ class Environment(object):
         Runs the mass spec and controller
         :return: None
         """
+        self._run_logged(self._run)
+
+    @classmethod
+    def resume(cls, checkpoint_path, progress_bar=True):
+        """
+        Continues a run from a checkpoint saved by an environment with a checkpoint_path. The random states and
+        everything the mass spec and controller have done up to the checkpoint are restored, so the resumed run
+        produces the same scans as a run that wasn't interrupted. Further checkpoints are saved to the same file.
+        :param checkpoint_path: the checkpoint file
+        :param progress_bar: True if a progress bar is to be shown
+        :return: the environment, after the run has finished
+        """
+        state = load_checkpoint(checkpoint_path)
+        np.random.set_state(state['np_random_state'])
+        random.setstate(state['random_state'])
+
+        env = state['environment']
+        logger.debug('Resuming run from {} at time {:f}', checkpoint_path, env.mass_spec.time)
+        env.checkpoint_path = checkpoint_path
+        env.progress_bar = progress_bar and _is_interactive()
+        if env.progress_bar:
+            env.bar = tqdm(total=env.max_time - env.min_time, initial=env.mass_spec.time - env.min_time)
+        env._run_logged(env._continue_run)
+        return env
+
+    def checkpoint(self, checkpoint_path=None):
+        """
+        Saves the full state of the run, including the state of the mass spec and controller, the scans produced
+        so far and the random states, so that the run can be continued with Environment.resume
+        :param checkpoint_path: the checkpoint file, by default the checkpoint_path of this environment
+        :return: None
+        """
+        checkpoint_path = self.checkpoint_path if checkpoint_path is None else checkpoint_path
+        start = time.time()
+        state = {
+            'environment': self,
+            'np_random_state': np.random.get_state(),
+            'random_state': random.getstate()
+        }
+        save_checkpoint(state, checkpoint_path)
+        self.last_checkpoint = time.time()
+        logger.debug('Saved checkpoint at time {:f} to {} in {:.2f}s', self.mass_spec.time, checkpoint_path,
+                     self.last_checkpoint - start)
+
+    def _run_logged(self, run_func):
+        if self.quiet:
+            logger.disable('vimms')
+        try:
+            run_func()
+        finally:
+            if self.quiet:
+                logger.enable('vimms')
+
+    def _run(self):
         # set some initial values for each run
         self._set_initial_values()
+        if self.stream_mzml:
+            self._open_mzml_stream()
 
         # register event handlers from the controller
+        self._register_events()
+
+        # initial scan should be generated here when the acquisition opens
+        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
+        self._run_loop()
+
+    def _continue_run(self):
+        # the handlers of the interrupted run were saved with the mass spec, replace them with this environment's
+        self.mass_spec.clear_events()
+        self._register_events()
+        self._run_loop()
+
+    def _register_events(self):
         self.mass_spec.register_event(IndependentMassSpectrometer.MS_SCAN_ARRIVED, self.add_scan)
         self.mass_spec.register_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING,
                                       self.handle_acquisition_open)
@@ -46,35 +152,73 @@ class Environment(object):
         self.mass_spec.register_event(IndependentMassSpectrometer.STATE_CHANGED,
                                       self.handle_state_changed)
 
-        # initial scan should be generated here when the acquisition opens
-        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
-
+    def _run_loop(self):
         # main loop to the simulate scan generation process of the mass spec
+        self.last_checkpoint = time.time()
+        # spike noise puts peaks in every MS1 scan, so no scan can be skipped when there is any
+        skip_empty = self.fast_forward and self.controller.is_stateless_for_empty_scans() and \
+            self.mass_spec.spike_noise is None
         try:
             # perform one step of mass spec up to max_time
             while self.mass_spec.time < self.max_time:
+                if skip_empty:
+                    self._skip_empty_time()
+                    if self.mass_spec.time >= self.max_time:
+                        break
+
                 # unless no more scan scheduled by the controller, then stop the simulated run
                 scan = self._one_step()
                 if scan is None:
                     break
+                if self.checkpoint_path is not None and \
+                        time.time() - self.last_checkpoint >= self.checkpoint_interval:
+                    self.checkpoint()
         except Exception as e:
             raise e
         finally:
             self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_CLOSED)
             self.mass_spec.close()
             self.close_progress_bar()
-        self.write_mzML(self.out_dir, self.out_file)
+            if self.mzml_stream is not None:
+                self.mzml_stream.close()
+                self.mzml_stream = None
+                logger.debug('mzML file successfully written!')
+        if not self.stream_mzml:
+            self.write_mzML(self.out_dir, self.out_file)
 
     def _one_step(self, params=None):
         # controller._process_scan() is called here immediately when a scan is produced within a step
         scan = self.mass_spec.step(params=params)
         if scan is not None:
             # update controller internal states AFTER a scan has been generated and handled
+            start = self.timer.start()
             self.controller.update_state_after_scan(scan)
+            self.timer.stop(STAGE_UPDATE_STATE, start)
             # increment progress bar
             self._update_progress_bar(scan)
         return scan
 
+    def _skip_empty_time(self):
+        """
+        Moves the mass spec time forward to when the next chemical starts to elute, if none are eluting now and
+        the controller is idle, i.e. the only scan queued is the next MS1 scan
+        :return: None
+        """
+        mass_spec = self.mass_spec
+        task_manager = mass_spec.task_manager
+        if task_manager.current_size() + task_manager.pending_size() != 1:
+            return
+        task = task_manager.peek_current() if task_manager.current_size() > 0 else task_manager.peek_pending()
+        if task.get(ScanParameters.MS_LEVEL) != 1:
+            return
+
+        next_time = min(mass_spec.chemical_store.elution_index.get_empty_until(mass_spec.time), self.max_time)
+        if next_time > mass_spec.time:
+            logger.debug('No chemicals elute from {:f}, skipping to {:f}', mass_spec.time, next_time)
+            if self.bar is not None:
+                self.bar.update(min(next_time - mass_spec.time, self.bar.total - self.bar.n))
+            mass_spec.time = next_time
+
     def handle_acquisition_open(self):
         logger.debug('Acquisition open')
         # send the initial custom scan to start the custom scan generation process
@@ -114,7 +258,12 @@ class Environment(object):
         :param scan: A newly generated scan
         :return: None
         """
-        logger.debug('Time %f Received %s' % (scan.rt, scan))
+        logger.debug('Time {:f} Received {}', scan.rt, scan)
+
+        if self.mzml_stream is not None:
+            start = self.timer.start()
+            self.mzml_stream.add_scan(scan)
+            self.timer.stop(STAGE_MZML_WRITING, start)
 
         # check the status of the last block of pending tasks we sent to determine if their corresponding scans
         # have actually been performed by the mass spec
@@ -126,7 +275,9 @@ class Environment(object):
         # and get new set of tasks from the controller
         current_size = self.mass_spec.task_manager.current_size()
         pending_size = self.mass_spec.task_manager.pending_size()
+        start = self.timer.start()
         tasks = self.controller.handle_scan(scan, current_size, pending_size)
+        self.timer.stop(STAGE_CONTROLLER, start)
 
         # immediately push newly generated tasks to mass spec queue
         self.mass_spec.task_manager.add_current(tasks)
@@ -138,25 +289,48 @@ class Environment(object):
         :param out_file: output filename
         :return: None
         """
-        if out_file is None:  # if no filename provided, just quits
+        mzml_filename = self._get_mzml_filename(out_dir, out_file)
+        if mzml_filename is None:  # if no filename provided, just quits
             return
-        else:
-            if out_dir is None:  # no out_dir, use only out_file
-                mzml_filename = Path(out_file)
-            else:  # both our_dir and out_file are provided
-                mzml_filename = Path(out_dir, out_file)
 
-        logger.debug('Writing mzML file to %s' % mzml_filename)
+        logger.debug('Writing mzML file to {}', mzml_filename)
+        start = self.timer.start()
         writer = MzmlWriter('my_analysis', self.controller.scans)
         writer.write_mzML(mzml_filename)
+        self.timer.set_scan(-1)
+        self.timer.stop(STAGE_MZML_WRITING, start)
         logger.debug('mzML file successfully written!')
 
+    def _get_mzml_filename(self, out_dir, out_file):
+        if out_file is None:
+            return None
+        elif out_dir is None:  # no out_dir, use only out_file
+            return Path(out_file)
+        else:  # both our_dir and out_file are provided
+            return Path(out_dir, out_file)
+
+    def _open_mzml_stream(self):
+        """
+        Opens the mzML file that scans are written to as they arrive
+        :return: None
+        """
+        mzml_filename = self._get_mzml_filename(self.out_dir, self.out_file)
+        if mzml_filename is None:
+            logger.warning('No output file provided, mzML will not be written')
+            return
+        logger.debug('Streaming mzML file to {}', mzml_filename)
+        self.mzml_stream = StreamingMzmlWriter('my_analysis', mzml_filename)
+        self.mzml_stream.open()
+
     def _set_initial_values(self):
         """
         Sets initial environment, mass spec start time, default scan parameters and other values
         :return: None
         """
         self.controller.set_environment(self)
+        self.controller.keep_scans = self.keep_scans
+        self.controller.timer = self.timer
+        self.mass_spec.timer = self.timer
         self.mass_spec.set_environment(self)
         self.mass_spec.time = self.min_time
 
@@ -166,6 +340,13 @@ class Environment(object):
     def get_initial_scan_params(self):
         return self.controller.get_initial_scan_params()
 
+    def __getstate__(self):
+        # progress bars and open files can't be pickled
+        state = self.__dict__.copy()
+        state['bar'] = None
+        state['mzml_stream'] = None
+        return state
+
     def save(self, outname):
         data_to_save = {
             'scans': self.controller.scans,
@@ -186,3 +367,8 @@ class Environment(object):
         plt.xlabel('m/z')
         plt.ylabel('Intensities')
         plt.show()
+
+
+def _is_interactive():
+    # a terminal, or a Jupyter notebook where stderr isn't a tty but progress bars are still shown
+    return sys.stderr.isatty() or 'ipykernel' in sys.modules
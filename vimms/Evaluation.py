@@ -12,12 +12,20 @@ from mass_spec_utils.data_import.mzml import MZMLFile
 def evaluate_simulated_env(env, min_intensity=0.0, base_chemicals=None):
     '''Evaluates a single simulated injection against the chemicals present in that injection'''
     true_chems = env.mass_spec.chemicals if base_chemicals is None else base_chemicals
-    fragmented = {}  # map chem to highest observed intensity
-    for event in env.mass_spec.fragmentation_events:
-        if (event.ms_level > 1):
-            chem = event.chem.get_original_parent()
-            fragmented[chem] = max(event.parents_intensity[0], fragmented.get(chem, 0))
-    num_frags = sum(1 for event in env.mass_spec.fragmentation_events if event.ms_level > 1)
+
+    # highest observed precursor intensity of each fragmented chemical, grouped by chemical index
+    events = env.mass_spec.fragmentation_events.get_columns()
+    is_msn = events['ms_level'] > 1
+    chem_idx = events['chem_idx'][is_msn]
+    num_frags = len(chem_idx)
+    unique_idx, first_pos, inverse = np.unique(chem_idx, return_index=True, return_inverse=True)
+    max_intensities = np.zeros(len(unique_idx))
+    np.maximum.at(max_intensities, inverse, events['intensity'][is_msn])
+
+    fragmented = {}  # map chem to highest observed intensity, in order of first fragmentation
+    for k in np.argsort(first_pos, kind='stable'):
+        chem = env.mass_spec.chemicals[unique_idx[k]].get_original_parent()
+        fragmented[chem] = max(max_intensities[k], fragmented.get(chem, 0))
     coverage = np.array([fragmented.get(chem, -1) >= min_intensity for chem in true_chems])
     raw_intensities = np.array([fragmented.get(chem, 0) for chem in true_chems])
     coverage_intensities = raw_intensities * (raw_intensities >= min_intensity)
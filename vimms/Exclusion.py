@@ -1,10 +1,10 @@
+import heapq
 from abc import abstractmethod
 
 import numpy as np
-from intervaltree import IntervalTree
 from loguru import logger
 
-from vimms.Common import ScanParameters
+from vimms.Common import ScanParameters, expand_ranges
 
 
 ########################################################################################################################
@@ -63,107 +63,445 @@ class ExclusionItem(object):
 
 class BoxHolder(object):
     """
-    A class to allow quick lookup of boxes (e.g. exclusion items, targets, etc)
-    Creates an interval tree on mz as this is likely to narrow things down quicker
-    Also has a method for returning an rt interval tree for a particular mz
-    and an mz interval tree for a particular rt
+    A class to allow quick lookup of boxes (e.g. exclusion items, targets, etc), i.e. objects with from_mz, to_mz,
+    from_rt and to_rt attributes, which contain the points inside those bounds (inclusive).
+
+    The boxes are bucketed in a uniform 2D grid over m/z and RT, with cells about the size of a typical box, so a
+    point only has to be checked against the few boxes in its cell. The grid is stored as numpy arrays (the boxes in
+    each cell are a contiguous range of one array), and all the peaks of a scan can be looked up at once.
+    Boxes added after the grid was built are checked directly until there are max_pending of them, when the grid is
+    rebuilt, and boxes that would span many cells are always checked directly rather than copied into every cell.
     """
 
-    def __init__(self):
-        self.boxes_mz = IntervalTree()
-        self.boxes_rt = IntervalTree()
+    # boxes covering more grid cells than this are checked directly
+    MAX_CELLS_PER_BOX = 64
+
+    def __init__(self, boxes=None, max_pending=1024):
+        """
+        Creates a box holder
+        :param boxes: a list of boxes to add, if any
+        :param max_pending: the number of boxes that can be added before the grid is rebuilt
+        """
+        self.max_pending = max_pending
+        self.boxes = []
+        self.bounds = np.zeros((0, 4), dtype=np.float64)  # from_mz, to_mz, from_rt, to_rt, with spare rows at the end
+        self._set_bounds_views()
+        self.num_built = 0  # the grid contains boxes[:num_built]
+        self._reset_grid()
+        if boxes is not None:
+            self.add_boxes(boxes)
 
     def add_box(self, box):
         """
-        Add a box to the IntervalTree
+        Adds a box
+        :param box: the box
         """
-        mz_from = box.from_mz
-        mz_to = box.to_mz
-        rt_from = box.from_rt
-        rt_to = box.to_rt
-        self.boxes_mz.addi(mz_from, mz_to, box)
-        self.boxes_rt.addi(rt_from, rt_to, box)
+        self.add_boxes([box])
+
+    def add_boxes(self, boxes):
+        """
+        Adds many boxes at once, e.g. those of previous injections
+        :param boxes: a list of boxes
+        """
+        if len(boxes) == 0:
+            return
+        bounds = np.array([(box.from_mz, box.to_mz, box.from_rt, box.to_rt) for box in boxes], dtype=np.float64)
+        n_boxes = len(self.boxes)
+        if n_boxes + len(boxes) > len(self.bounds):  # grow the array geometrically, so adding boxes is O(1) each
+            new_bounds = np.zeros((max(2 * len(self.bounds), n_boxes + len(boxes)), 4), dtype=np.float64)
+            new_bounds[:n_boxes] = self.bounds[:n_boxes]
+            self.bounds = new_bounds
+        self.bounds[n_boxes:n_boxes + len(boxes)] = bounds
+        self.boxes.extend(boxes)
+        self._set_bounds_views()
+        if len(self.boxes) - self.num_built > self.max_pending:
+            self._build_grid()
+
+    def check_points(self, mzs, rts):
+        """
+        Finds the boxes that contain each of many points
+        :param mzs: an array of m/z values
+        :param rts: an array of RT values, or a single RT value for all the points (e.g. the peaks of a scan)
+        :return: a tuple of two arrays, with an entry for every pair of a point and a box containing it: the index
+        of the point, and the index of the box in self.boxes
+        """
+        mzs = np.asarray(mzs, dtype=np.float64)
+        rts = np.broadcast_to(np.asarray(rts, dtype=np.float64), mzs.shape)
+        point_idx, box_idx = [], []
+
+        # boxes in the grid cells of the points
+        if self.num_built > 0:
+            cells = self._get_cells(mzs, rts)
+            counts = self.cell_starts[cells + 1] - self.cell_starts[cells]
+            point_idx.append(np.repeat(np.arange(len(mzs)), counts))
+            box_idx.append(self.cell_boxes[expand_ranges(self.cell_starts[cells], counts)])
+
+        # boxes that are checked directly
+        direct = np.concatenate([self.large_boxes, np.arange(self.num_built, len(self.boxes))])
+        if len(direct) > 0:
+            points, candidates = np.nonzero(self._contains(direct[None, :], mzs[:, None], rts[:, None]))
+            point_idx.append(points)
+            box_idx.append(direct[candidates])
+
+        if len(point_idx) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        point_idx, box_idx = np.concatenate(point_idx), np.concatenate(box_idx)
+        found = self._contains(box_idx, mzs[point_idx], rts[point_idx])
+        return point_idx[found], box_idx[found]
+
+    def is_in_box_many(self, mzs, rts):
+        """
+        Checks which of many points are in *any* box
+        :param mzs: an array of m/z values
+        :param rts: an array of RT values, or a single RT value for all the points
+        :return: a boolean array that is True for the points in a box
+        """
+        in_box = np.zeros(len(mzs), dtype=bool)
+        point_idx, _ = self.check_points(mzs, rts)
+        in_box[point_idx] = True
+        return in_box
 
     def check_point(self, mz, rt):
         """
         Find the boxes that match this mz and rt value
         """
-        regions = self.boxes_mz.at(mz)
-        hits = set()
-        for r in regions:
-            if r.data.rt_match(rt):
-                hits.add(r.data)
-        return hits
+        _, box_idx = self.check_points([mz], rt)
+        return set(self.boxes[i] for i in box_idx)
 
     def check_point_2(self, mz, rt):
         """
-        An alternative method that searches both trees
-        Might be faster if there are lots of rt ranges that 
-        can map to a particular mz value
+        Find the boxes that match this mz and rt value, as a list in the order they were added
         """
-        mz_regions = self.boxes_mz.at(mz)
-        rt_regions = self.boxed_rt.at(rt)
-        inter = mz_regions.intersection(rt_regions)
-        return [r.data for r in inter]
+        _, box_idx = self.check_points([mz], rt)
+        return [self.boxes[i] for i in np.sort(box_idx)]
 
     def is_in_box(self, mz, rt):
         """
         Check if this mz and rt is in *any* box
         """
-        hits = self.check_point(mz, rt)
-        if len(hits) > 0:
-            return True
-        else:
-            return False
+        point_idx, _ = self.check_points([mz], rt)
+        return len(point_idx) > 0
 
     def is_in_box_mz(self, mz):
         """
         Check if an mz value is in any box
         """
-        regions = self.boxes_mz.at(mz)
-        if len(regions) > 0:
-            return True
-        else:
-            return False
+        return bool(np.any((self.from_mzs <= mz) & (mz <= self.to_mzs)))
 
     def is_in_box_rt(self, rt):
         """
         Check if an rt value is in any box
         """
-        regions = self.boxes_rt.at(rt)
-        if len(regions) > 0:
-            return True
-        else:
-            return False
+        return bool(np.any((self.from_rts <= rt) & (rt <= self.to_rts)))
 
     def get_subset_rt(self, rt):
         """
-        Create an interval tree based upon mz for all boxes active at rt
+        Create a BoxHolder of all boxes active at rt
         """
-        regions = self.boxes_rt.at(rt)
-        it = BoxHolder()
-        for r in regions:
-            box = r.data
-            it.add_box(box)
-        return it
+        matches = np.flatnonzero((self.from_rts <= rt) & (rt <= self.to_rts))
+        return BoxHolder([self.boxes[i] for i in matches], max_pending=self.max_pending)
 
     def get_subset_mz(self, mz):
         """
-        Create an interval tree based upon rt fro all boxes active at mz
+        Create a BoxHolder of all boxes active at mz
         """
-        regions = self.boxes_mz.at(mz)
-        it = BoxHolder()
-        for r in regions:
-            box = r.data
-            it.add_box(box)
-        return it
+        matches = np.flatnonzero((self.from_mzs <= mz) & (mz <= self.to_mzs))
+        return BoxHolder([self.boxes[i] for i in matches], max_pending=self.max_pending)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _set_bounds_views(self):
+        n_boxes = len(self.boxes)
+        self.from_mzs, self.to_mzs, self.from_rts, self.to_rts = (self.bounds[:n_boxes, i] for i in range(4))
+
+    def __getstate__(self):
+        # don't pickle the spare rows
+        state = self.__dict__.copy()
+        state['bounds'] = self.bounds[:len(self.boxes)].copy()
+        for name in ('from_mzs', 'to_mzs', 'from_rts', 'to_rts'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_bounds_views()
+
+    def _contains(self, box_idx, mzs, rts):
+        return (self.from_mzs[box_idx] <= mzs) & (mzs <= self.to_mzs[box_idx]) & \
+               (self.from_rts[box_idx] <= rts) & (rts <= self.to_rts[box_idx])
+
+    def _reset_grid(self):
+        self.grid_origin = (0.0, 0.0)
+        self.cell_size = (1.0, 1.0)
+        self.grid_shape = (1, 1)
+        self.cell_starts = np.zeros(2, dtype=np.int64)
+        self.cell_boxes = np.zeros(0, dtype=np.int64)
+        self.large_boxes = np.zeros(0, dtype=np.int64)
+
+    def _get_cells(self, mzs, rts):
+        # the grid cell of each point, with points outside the grid in the nearest cell at its edge
+        mz_cells, rt_cells = self._get_cell_coordinates(mzs, rts)
+        return mz_cells * self.grid_shape[1] + rt_cells
+
+    def _get_cell_coordinates(self, mzs, rts):
+        coordinates = []
+        for values, origin, size, n_cells in zip((mzs, rts), self.grid_origin, self.cell_size, self.grid_shape):
+            cells = np.floor((values - origin) / size)
+            coordinates.append(np.clip(cells, 0, n_cells - 1).astype(np.int64))
+        return coordinates
+
+    def _build_grid(self):
+        # rebuilds the grid with all the boxes
+        self._reset_grid()
+        self.num_built = len(self.boxes)
+        n_boxes = self.num_built
+
+        # one cell per box, with the cells shaped like a typical box
+        extents = []
+        for lower, upper in ((self.from_mzs, self.to_mzs), (self.from_rts, self.to_rts)):
+            origin, extent = lower.min(), upper.max() - lower.min()
+            width = np.median(upper - lower)
+            n_cells = extent / width if width > 0 else n_boxes
+            extents.append((origin, extent, max(n_cells, 1.0)))
+        scale = min(1.0, np.sqrt(n_boxes / (extents[0][2] * extents[1][2])))
+        shape = tuple(int(min(max(np.ceil(n_cells * scale), 1), n_boxes)) for _, _, n_cells in extents)
+        self.grid_origin = tuple(float(origin) for origin, _, _ in extents)
+        self.cell_size = tuple(float(extent) / n if extent > 0 else 1.0 for (_, extent, _), n in zip(extents, shape))
+        self.grid_shape = shape
+
+        # each box goes in all the cells it overlaps, unless there are too many of them
+        mz_lo, rt_lo = self._get_cell_coordinates(self.from_mzs, self.from_rts)
+        mz_hi, rt_hi = self._get_cell_coordinates(self.to_mzs, self.to_rts)
+        n_mz, n_rt = mz_hi - mz_lo + 1, rt_hi - rt_lo + 1
+        is_large = n_mz * n_rt > self.MAX_CELLS_PER_BOX
+        self.large_boxes = np.flatnonzero(is_large)
+        gridded = np.flatnonzero(~is_large)
+        n_mz, n_rt, mz_lo, rt_lo = n_mz[gridded], n_rt[gridded], mz_lo[gridded], rt_lo[gridded]
+
+        counts = n_mz * n_rt
+        box_idx = np.repeat(gridded, counts)
+        offsets = expand_ranges(np.zeros(len(counts), dtype=np.int64), counts)  # position within each box
+        n_rt_rep = np.repeat(n_rt, counts)
+        mz_cells = np.repeat(mz_lo, counts) + offsets // n_rt_rep
+        rt_cells = np.repeat(rt_lo, counts) + offsets % n_rt_rep
+        cells = mz_cells * shape[1] + rt_cells
+
+        order = np.argsort(cells, kind='stable')
+        self.cell_boxes = box_idx[order]
+        self.cell_starts = np.zeros(shape[0] * shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=shape[0] * shape[1]), out=self.cell_starts[1:])
+
+
+class ExclusionIndex(object):
+    """
+    An index of dynamic exclusion items, which finds the items containing an m/z value with a binary search rather
+    than checking every item, so that long exclusion lists don't slow down every scan.
+
+    The bounds of the items are kept in numpy arrays sorted by from_mz. No item is wider than the widest live one,
+    so the items that can contain an m/z value all start at most that width below it, and are found with a binary
+    search. The widest live item is the top of a max-heap of widths, from which expired items are dropped lazily,
+    so one wide window only widens the search until it expires. Finding the k items containing an m/z value then
+    takes O(log n + k'), where k' also counts the items that start within that width below it.
+
+    A min-heap of the items keyed on to_rt gives the next ones to expire in O(log n) each. Expired items are only
+    marked as dead, and the arrays are compacted once more than half of the items in them are dead, so removal
+    costs amortised O(log n) per item. Items added together, e.g. those of one MS1 scan, are inserted into the
+    arrays at once, which copies the arrays once per batch, i.e. O(n) per scan rather than per item.
+
+    The latest item containing an m/z value, which gives its weight in WeightedDEWExclusion, is found among the
+    items containing it without sorting the others.
+    """
+
+    def __init__(self, items=None):
+        """
+        Creates an exclusion index
+        :param items: a list of ExclusionItem objects to add, if any
+        """
+        self.from_mzs = np.zeros(0, dtype=np.float64)
+        self.to_mzs = np.zeros(0, dtype=np.float64)
+        self.from_rts = np.zeros(0, dtype=np.float64)
+        self.to_rts = np.zeros(0, dtype=np.float64)
+        self.frag_ats = np.zeros(0, dtype=np.float64)  # NaN for items that weren't fragmented
+        self.orders = np.zeros(0, dtype=np.int64)  # the order in which the items were added
+        self.items = np.zeros(0, dtype=object)
+        self.alive = np.zeros(0, dtype=bool)  # False for expired items that haven't been compacted away yet
+        self.num_dead = 0
+        self.expiry_heap = []  # of (to_rt, order, item)
+        self.width_heap = []  # of (-width, order), including expired items until they reach the top
+        self.expired_orders = set()  # orders of the expired items still in width_heap
+        self.max_width = 0.0  # the width of the widest live item
+        self.num_added = 0
+        if items is not None:
+            self.add(items)
+
+    def add(self, items):
+        """
+        Adds items to the index
+        :param items: a list of ExclusionItem objects
+        """
+        if len(items) == 0:
+            return
+        new_items = np.empty(len(items), dtype=object)
+        new_items[:] = items
+        bounds = np.array([(x.from_mz, x.to_mz, x.from_rt, x.to_rt, x.frag_at) for x in items], dtype=np.float64)
+        orders = np.arange(self.num_added, self.num_added + len(items))
+
+        # new items go after existing ones with the same from_mz, and in the order they were added
+        sort = np.argsort(bounds[:, 0], kind='stable')
+        positions = np.searchsorted(self.from_mzs, bounds[sort, 0], side='right')
+        self.from_mzs = np.insert(self.from_mzs, positions, bounds[sort, 0])
+        self.to_mzs = np.insert(self.to_mzs, positions, bounds[sort, 1])
+        self.from_rts = np.insert(self.from_rts, positions, bounds[sort, 2])
+        self.to_rts = np.insert(self.to_rts, positions, bounds[sort, 3])
+        self.frag_ats = np.insert(self.frag_ats, positions, bounds[sort, 4])
+        self.orders = np.insert(self.orders, positions, orders[sort])
+        self.items = np.insert(self.items, positions, new_items[sort])
+        self.alive = np.insert(self.alive, positions, True)
+
+        widths = (bounds[:, 1] - bounds[:, 0]).tolist()
+        for item, to_rt, width, order in zip(items, bounds[:, 3].tolist(), widths, orders.tolist()):
+            heapq.heappush(self.expiry_heap, (to_rt, order, item))
+            heapq.heappush(self.width_heap, (-width, order))
+        self.max_width = -self.width_heap[0][0]
+        self.num_added += len(items)
+
+    def remove_expired(self, current_time):
+        """
+        Removes the items that end at or before a time
+        :param current_time: the time
+        :return: the number of items removed
+        """
+        positions = []
+        while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] <= current_time:
+            _, order, item = heapq.heappop(self.expiry_heap)
+            pos = int(np.searchsorted(self.from_mzs, item.from_mz, side='left'))
+            while self.orders[pos] != order:  # step over other items with the same from_mz
+                pos += 1
+            positions.append(pos)
+            self.expired_orders.add(order)
+        if len(positions) == 0:
+            return 0
+
+        self.alive[positions] = False
+        self.num_dead += len(positions)
+        while len(self.width_heap) > 0 and self.width_heap[0][1] in self.expired_orders:
+            self.expired_orders.discard(heapq.heappop(self.width_heap)[1])
+        self.max_width = -self.width_heap[0][0] if len(self.width_heap) > 0 else 0.0
+        if 2 * self.num_dead > len(self.alive):
+            self._compact()
+        return len(positions)
+
+    def _compact(self):
+        # drops the dead items from the arrays
+        keep = self.alive
+        self.from_mzs = self.from_mzs[keep]
+        self.to_mzs = self.to_mzs[keep]
+        self.from_rts = self.from_rts[keep]
+        self.to_rts = self.to_rts[keep]
+        self.frag_ats = self.frag_ats[keep]
+        self.orders = self.orders[keep]
+        self.items = self.items[keep]
+        self.alive = self.alive[keep]
+        self.num_dead = 0
+
+    def find(self, mz, rt):
+        """
+        Finds the items that contain an m/z value at an RT
+        :param mz: m/z value
+        :param rt: RT value
+        :return: an array of the positions of the items in the index arrays, in order of from_mz
+        """
+        lo, hi = self._get_candidate_ranges(mz)
+        positions = np.arange(lo, hi)
+        found = (mz <= self.to_mzs[lo:hi]) & (self.from_rts[lo:hi] <= rt) & (rt <= self.to_rts[lo:hi]) & \
+            self.alive[lo:hi]
+        return positions[found]
+
+    def find_many(self, mzs, rt):
+        """
+        Finds the items that contain each of many m/z values at an RT
+        :param mzs: an array of m/z values
+        :param rt: RT value
+        :return: a tuple of two arrays, with an entry for every pair of an m/z value and an item containing it:
+        the index of the m/z value in mzs, and the position of the item in the index arrays
+        """
+        mzs = np.asarray(mzs, dtype=np.float64)
+        lo, hi = self._get_candidate_ranges(mzs)
+        counts = hi - lo
+        positions = expand_ranges(lo, counts)
+        mz_idx = np.repeat(np.arange(len(mzs)), counts)
+        found = (mzs[mz_idx] <= self.to_mzs[positions]) & (self.from_rts[positions] <= rt) & \
+                (rt <= self.to_rts[positions]) & self.alive[positions]
+        return mz_idx[found], positions[found]
+
+    def find_latest_many(self, mzs, rt):
+        """
+        Finds the latest item, i.e. the one with the largest from_rt, that contains each of many m/z values at an RT.
+        Of items with the same from_rt, the one added first is used.
+        :param mzs: an array of m/z values
+        :param rt: RT value
+        :return: a tuple of two arrays, with an entry for every m/z value contained in an item: the index of the m/z
+        value in mzs, and the position of the latest item containing it in the index arrays
+        """
+        mz_idx, positions = self.find_many(mzs, rt)
+        order = np.lexsort((self.orders[positions], -self.from_rts[positions], mz_idx))
+        mz_idx, positions = mz_idx[order], positions[order]
+        first = np.ones(len(mz_idx), dtype=bool)
+        first[1:] = mz_idx[1:] != mz_idx[:-1]
+        return mz_idx[first], positions[first]
+
+    def get_items(self):
+        """
+        Gets all the items in the index
+        :return: a list of ExclusionItem objects, in the order they were added
+        """
+        items, orders = self.items[self.alive], self.orders[self.alive]
+        return items[np.argsort(orders)].tolist()
+
+    def _get_candidate_ranges(self, mzs):
+        # the range of positions of the items that start at most max_width below each m/z value, with some slack
+        # for rounding errors in the widths
+        lo = np.searchsorted(self.from_mzs, mzs - self.max_width * (1 + 1e-6), side='left')
+        hi = np.searchsorted(self.from_mzs, mzs, side='right')
+        return lo, hi
+
+    def __len__(self):
+        return len(self.items) - self.num_dead
 
 
 class TopNExclusion(object):
     def __init__(self, initial_exclusion_list=None):
-        self.exclusion_list = []
+        self.index = ExclusionIndex()
         if initial_exclusion_list is not None:  # copy initial list, if provided
-            self.exclusion_list = list(initial_exclusion_list)
+            self.index.add(list(initial_exclusion_list))
+
+    @property
+    def exclusion_list(self):
+        """
+        Gets a snapshot of the current exclusion items. The items are held in an index, so changing the snapshot
+        has no effect: assign to exclusion_list to replace the items, or use add_items to add to them.
+        :return: a tuple of ExclusionItem objects, in the order they were added
+        """
+        return tuple(self.index.get_items())
+
+    @exclusion_list.setter
+    def exclusion_list(self, items):
+        self.index = ExclusionIndex(list(items))
+
+    def add_items(self, items):
+        """
+        Adds exclusion items
+        :param items: a list of ExclusionItem objects
+        """
+        self.index.add(list(items))
+
+    def __setstate__(self, state):
+        # objects pickled before the index was added keep their items in a list
+        items = state.pop('exclusion_list', None)
+        self.__dict__.update(state)
+        if items is not None:
+            self.exclusion_list = items
 
     def is_excluded(self, mz, rt):
         """
@@ -172,16 +510,26 @@ class TopNExclusion(object):
         :param rt: RT value
         :return: True if excluded (with weight 0.0), False otherwise (weight 1.0)
         """
-        # TODO: make this faster?
-        for x in self.exclusion_list:
-            exclude_mz = x.from_mz <= mz <= x.to_mz
-            exclude_rt = x.from_rt <= rt <= x.to_rt
-            if exclude_mz and exclude_rt:
-                logger.debug(
-                    'Excluded precursor ion mz {:.4f} rt {:.2f} because of {}'.format(mz, rt, x))
-                return True, 0.0
+        positions = self.index.find(mz, rt)
+        if len(positions) > 0:
+            logger.debug('Excluded precursor ion mz {:.4f} rt {:.2f} because of {}', mz, rt,
+                         self.index.items[positions[0]])
+            return True, 0.0
         return False, 1.0
 
+    def is_excluded_many(self, mzs, rt):
+        """
+        Checks which of many m/z values, e.g. all the peaks of an MS1 scan, are currently excluded at the same RT
+        :param mzs: an array of m/z values
+        :param rt: RT value
+        :return: a tuple of a boolean array that is True for the excluded m/z values, and an array of their weights
+        (0.0 if excluded, 1.0 otherwise)
+        """
+        excluded = np.zeros(len(mzs), dtype=bool)
+        mz_idx, _ = self.index.find_many(mzs, rt)
+        excluded[mz_idx] = True
+        return excluded, np.where(excluded, 0.0, 1.0)
+
     def update(self, current_scan, ms2_tasks):
         """
         Updates the state of this exclusion object based on the current ms1 scan and scheduled ms2 tasks
@@ -196,12 +544,10 @@ class TopNExclusion(object):
                 mz_tol = task.get(ScanParameters.DYNAMIC_EXCLUSION_MZ_TOL)
                 rt_tol = task.get(ScanParameters.DYNAMIC_EXCLUSION_RT_TOL)
                 x = self._get_exclusion_item(mz, rt, mz_tol, rt_tol)
-                logger.debug('Time {:.6f} Created dynamic temporary exclusion window mz ({}-{}) rt ({}-{})'.format(
-                    rt,
-                    x.from_mz, x.to_mz, x.from_rt, x.to_rt
-                ))
+                logger.debug('Time {:.6f} Created dynamic temporary exclusion window mz ({}-{}) rt ({}-{})',
+                             rt, x.from_mz, x.to_mz, x.from_rt, x.to_rt)
                 temp_exclusion_list.append(x)
-        self.exclusion_list.extend(temp_exclusion_list)
+        self.add_items(temp_exclusion_list)
 
     def cleanup(self, current_scan):
         """
@@ -217,7 +563,7 @@ class TopNExclusion(object):
             current_time += current_scan.scan_duration
 
         # remove expired items from dynamic exclusion list
-        self.exclusion_list = list(filter(lambda x: x.to_rt > current_time, self.exclusion_list))
+        self.index.remove_expired(current_time)
 
     def _get_exclusion_item(self, mz, rt, mz_tol, rt_tol):
         mz_lower = mz * (1 - mz_tol / 1e6)
@@ -243,17 +589,30 @@ class WeightedDEWExclusion(TopNExclusion):
         :param rt: RT value
         :return: True if excluded, False otherwise
         """
-        # TODO: make this faster?
-        self.exclusion_list.sort(key=lambda x: x.from_rt, reverse=True)
-        for x in self.exclusion_list:
-            exclude_mz = x.from_mz <= mz <= x.to_mz
-            exclude_rt = x.from_rt <= rt <= x.to_rt
-            if exclude_mz and exclude_rt:
-                logger.debug(
-                    'Excluded precursor ion mz {:.4f} rt {:.2f} because of {}'.format(mz, rt, x))
-                return compute_weight(rt, x.frag_at, self.rt_tol, self.exclusion_t_0)
+        _, latest = self.index.find_latest_many([mz], rt)
+        if len(latest) > 0:
+            # the weight comes from the latest window that contains the ion
+            x = self.index.items[latest[0]]
+            logger.debug('Excluded precursor ion mz {:.4f} rt {:.2f} because of {}', mz, rt, x)
+            return compute_weight(rt, x.frag_at, self.rt_tol, self.exclusion_t_0)
         return False, 1.0
 
+    def is_excluded_many(self, mzs, rt):
+        """
+        Checks which of many m/z values, e.g. all the peaks of an MS1 scan, are currently excluded by the weighted
+        dynamic exclusion window at the same RT
+        :param mzs: an array of m/z values
+        :param rt: RT value
+        :return: a tuple of a boolean array that is True for the excluded m/z values, and an array of their weights
+        """
+        excluded = np.zeros(len(mzs), dtype=bool)
+        weights = np.ones(len(mzs), dtype=np.float64)
+        # as in is_excluded, the weight of an m/z value comes from the latest window that contains it
+        mz_idx, latest = self.index.find_latest_many(mzs, rt)
+        excluded[mz_idx], weights[mz_idx] = compute_weights(rt, self.index.frag_ats[latest], self.rt_tol,
+                                                            self.exclusion_t_0)
+        return excluded, weights
+
 
 def compute_weight(current_rt, frag_at, rt_tol, exclusion_t_0):
     if frag_at is None:
@@ -275,22 +634,109 @@ def compute_weight(current_rt, frag_at, rt_tol, exclusion_t_0):
         return True, weight
 
 
+def compute_weights(current_rt, frag_ats, rt_tol, exclusion_t_0):
+    """
+    Computes the weights of many ions at once, as compute_weight does for one
+    :param current_rt: the current RT
+    :param frag_ats: an array of the RTs at which the ions were last fragmented, NaN if they never were
+    :param rt_tol: the RT tolerance of the weighted dynamic exclusion window
+    :param exclusion_t_0: the time after fragmentation during which ions are always excluded
+    :return: a tuple of a boolean array that is True for the excluded ions, and an array of their weights
+    """
+    frag_ats = np.asarray(frag_ats, dtype=np.float64)
+    # comparisons with NaN are False, so ions that were never fragmented are included
+    excluded = current_rt < frag_ats + rt_tol
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = (current_rt - (exclusion_t_0 + frag_ats)) / (rt_tol - exclusion_t_0)
+    weights[current_rt <= frag_ats + exclusion_t_0] = 0.0
+    weights[~excluded] = 1.0
+    if np.any(weights > 1):
+        logger.warning('exclusion weights {} are greater than 1 (current_rt {} exclusion_t_0 {} rt_tol {})',
+                       weights[weights > 1], current_rt, exclusion_t_0, rt_tol)
+    return excluded, weights
+
+
 ########################################################################################################################
 # Filters
 ########################################################################################################################
 
 
+class ScoreCandidates(object):
+    """
+    The attributes of the candidate precursors of a scan (e.g. the live ROIs of an ROI-based controller) as numpy
+    arrays, so that filters can be applied to all of them at once
+    """
+
+    def __init__(self, current_rt, mzs=None, intensities=None, last_frag_rts=None, roi_lengths=None,
+                 can_fragment=None):
+        """
+        Creates the candidates of a scan. Attributes that aren't given are None, and filters that need them can't
+        be applied.
+        :param current_rt: the RT of the scan
+        :param mzs: the m/z values of the candidates
+        :param intensities: their intensities
+        :param last_frag_rts: the RTs at which they were last fragmented, None (or NaN) if they never were
+        :param roi_lengths: the lengths of their ROIs
+        :param can_fragment: whether they can be fragmented, according to the SmartROI rules
+        """
+        self.current_rt = current_rt
+        self.mzs = None if mzs is None else np.asarray(mzs, dtype=np.float64)
+        self.intensities = None if intensities is None else np.asarray(intensities, dtype=np.float64)
+        # None values become NaN, for which all comparisons are False
+        self.last_frag_rts = None if last_frag_rts is None else np.asarray(last_frag_rts, dtype=np.float64)
+        self.roi_lengths = None if roi_lengths is None else np.asarray(roi_lengths)
+        self.can_fragment = None if can_fragment is None else np.asarray(can_fragment, dtype=bool)
+
+    def __len__(self):
+        # the number of candidates, from whichever attributes were given
+        for values in (self.mzs, self.intensities, self.last_frag_rts, self.roi_lengths, self.can_fragment):
+            if values is not None:
+                return len(values)
+        return 0
+
+
 class ScoreFilter():
     @abstractmethod
     def filter(self): pass
 
+    @abstractmethod
+    def apply(self, candidates):
+        """
+        Applies the filter to all the candidates of a scan at once
+        :param candidates: a ScoreCandidates object
+        :return: a boolean mask of the candidates that pass the filter, or an array of their weights
+        """
+        pass
+
+
+class CompositeFilter(ScoreFilter):
+    """
+    Several filters applied together, which a candidate passes if it passes all of them. If any of the filters
+    gives weights, the result is the product of the weights and masks.
+    """
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    def filter(self, candidates):
+        return self.apply(candidates)
+
+    def apply(self, candidates):
+        result = self.filters[0].apply(candidates)
+        for f in self.filters[1:]:
+            result = result * f.apply(candidates)  # logical and of masks, product otherwise
+        return result
+
 
 class MinIntensityFilter(ScoreFilter):
     def __init__(self, min_ms1_intensity):
         self.min_ms1_intensity = min_ms1_intensity
 
     def filter(self, intensities):
-        return np.array(intensities) > self.min_ms1_intensity
+        return np.asarray(intensities) > self.min_ms1_intensity
+
+    def apply(self, candidates):
+        return self.filter(candidates.intensities)
 
 
 class DEWFilter(ScoreFilter):
@@ -301,6 +747,9 @@ class DEWFilter(ScoreFilter):
         # Handles None values by converting to NaN for which all comparisons return 0
         return np.logical_not(current_rt - np.array(last_frag_rts, dtype=np.double) <= self.rt_tol)
 
+    def apply(self, candidates):
+        return np.logical_not(candidates.current_rt - candidates.last_frag_rts <= self.rt_tol)
+
 
 class WeightedDEWFilter(ScoreFilter):
     def __init__(self, rt_tol, exclusion_t_0):
@@ -308,11 +757,14 @@ class WeightedDEWFilter(ScoreFilter):
         self.exclusion_t_0 = exclusion_t_0
 
     def filter(self, current_rt, last_frag_rts):
-        weights = []
-        for frag_at in last_frag_rts:
-            is_exc, weight = compute_weight(current_rt, frag_at, self.rt_tol, self.exclusion_t_0)
-            weights.append(weight)
-        return np.array(weights)
+        _, weights = compute_weights(current_rt, np.array(last_frag_rts, dtype=np.double), self.rt_tol,
+                                     self.exclusion_t_0)
+        return weights
+
+    def apply(self, candidates):
+        _, weights = compute_weights(candidates.current_rt, candidates.last_frag_rts, self.rt_tol,
+                                     self.exclusion_t_0)
+        return weights
 
 
 class LengthFilter(ScoreFilter):
@@ -320,7 +772,10 @@ class LengthFilter(ScoreFilter):
         self.min_roi_length_for_fragmentation = min_roi_length_for_fragmentation
 
     def filter(self, roi_lengths):
-        return roi_lengths >= self.min_roi_length_for_fragmentation
+        return np.asarray(roi_lengths) >= self.min_roi_length_for_fragmentation
+
+    def apply(self, candidates):
+        return self.filter(candidates.roi_lengths)
 
 
 class SmartROIFilter(ScoreFilter):
@@ -329,6 +784,12 @@ class SmartROIFilter(ScoreFilter):
         # otherwise track the status based on the SmartROI rules
         return np.array([roi.get_can_fragment() for roi in rois])
 
+    def apply(self, candidates):
+        # as in filter, candidates that aren't SmartROIs, and so have no can_fragment, can always be fragmented
+        if candidates.can_fragment is None:
+            return np.ones(len(candidates), dtype=bool)
+        return candidates.can_fragment
+
 
 if __name__ == '__main__':
     e = ExclusionItem(1.1, 1.2, 3.4, 3.5, 3.45)
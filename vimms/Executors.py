@@ -0,0 +1,147 @@
+"""
+Provides interchangeable backends to map a function over many independent tasks, e.g. the parameter sweeps of
+in-silico optimisation. The 'serial', 'threads' and 'processes' backends only need the standard library and start
+in a fraction of a second; the 'ipyparallel' backend uses a running IPython cluster, if ipyparallel is installed.
+
+Tasks are sent to workers in chunks, so that many small tasks are pickled and dispatched together. Objects shared
+by the tasks in a chunk (e.g. the same list of chemicals) are only pickled once per chunk.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from loguru import logger
+
+EXECUTOR_SERIAL = 'serial'
+EXECUTOR_THREADS = 'threads'
+EXECUTOR_PROCESSES = 'processes'
+EXECUTOR_IPYPARALLEL = 'ipyparallel'
+
+
+class Executor(object):
+    """
+    Base class of all executors
+    """
+
+    def __init__(self, max_workers=None, chunksize=1):
+        """
+        Creates an executor
+        :param max_workers: the number of workers, by default the number of cores
+        :param chunksize: the number of tasks sent to a worker at once, or 'auto' to split the tasks into about four
+        chunks per worker
+        """
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.chunksize = chunksize
+
+    def map(self, func, items):
+        """
+        Applies a function to each item
+        :param func: the function, which must be picklable (defined at the top level of a module) for the
+        'processes' and 'ipyparallel' backends
+        :param items: the items
+        :return: a list of the results, in the same order as items
+        """
+        raise NotImplementedError()
+
+    def get_chunksize(self, n_items):
+        """
+        Gets the number of tasks to send to a worker at once
+        :param n_items: the total number of tasks
+        :return: the chunk size
+        """
+        if self.chunksize == 'auto':
+            return max(1, -(-n_items // (4 * self.max_workers)))
+        return max(1, int(self.chunksize))
+
+
+class SerialExecutor(Executor):
+    """
+    Runs the tasks one after another in the current process
+    """
+
+    def __init__(self, max_workers=None, chunksize=1):
+        super().__init__(max_workers=1, chunksize=chunksize)
+
+    def map(self, func, items):
+        return [func(item) for item in items]
+
+
+class ThreadExecutor(Executor):
+    """
+    Runs the tasks in a pool of threads. This only helps when the tasks release the GIL, e.g. while writing files.
+    """
+
+    def map(self, func, items):
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, items))
+
+
+class ProcessExecutor(Executor):
+    """
+    Runs the tasks in a pool of local worker processes
+    """
+
+    def __init__(self, max_workers=None, chunksize=1, mp_context=None):
+        """
+        Creates a process executor
+        :param max_workers: the number of worker processes, by default the number of cores
+        :param chunksize: the number of tasks sent to a worker at once, or 'auto'
+        :param mp_context: a multiprocessing context, by default that of the platform
+        """
+        super().__init__(max_workers=max_workers, chunksize=chunksize)
+        self.mp_context = mp_context
+
+    def map(self, func, items):
+        items = list(items)
+        if len(items) == 0:
+            return []
+        max_workers = min(self.max_workers, len(items))
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=self.mp_context) as executor:
+            return list(executor.map(func, items, chunksize=self.get_chunksize(len(items))))
+
+
+class IPyParallelExecutor(Executor):
+    """
+    Runs the tasks on all the engines of a running IPython cluster. If no cluster can be reached, the tasks are
+    run serially instead.
+    """
+
+    def map(self, func, items):
+        import ipyparallel as ipp
+        items = list(items)
+        try:
+            rc = ipp.Client()
+            dview = rc[:]  # use all engines
+            with dview.sync_imports():
+                pass
+            return dview.map_sync(func, items)
+        except OSError:  # cluster has not been started
+            logger.warning('IPython cluster not found, running tasks in serial mode')
+        except ipp.error.TimeoutError:  # takes too long to run
+            logger.warning('IPython cluster timed out, running tasks in serial mode')
+        return SerialExecutor().map(func, items)
+
+
+EXECUTORS = {
+    EXECUTOR_SERIAL: SerialExecutor,
+    EXECUTOR_THREADS: ThreadExecutor,
+    EXECUTOR_PROCESSES: ProcessExecutor,
+    EXECUTOR_IPYPARALLEL: IPyParallelExecutor,
+}
+
+
+def get_executor(executor=EXECUTOR_PROCESSES, max_workers=None, chunksize=1):
+    """
+    Gets an executor
+    :param executor: the name of a backend ('serial', 'threads', 'processes' or 'ipyparallel'), or an Executor
+    object, which is returned as it is
+    :param max_workers: the number of workers, by default the number of cores
+    :param chunksize: the number of tasks sent to a worker at once, or 'auto'
+    :return: an Executor object
+    """
+    if isinstance(executor, Executor):
+        return executor
+    try:
+        return EXECUTORS[executor](max_workers=max_workers, chunksize=chunksize)
+    except KeyError:
+        raise ValueError('Unknown executor %s, must be one of %s' % (executor, list(EXECUTORS.keys())))
@@ -0,0 +1,323 @@
+"""
+Runs independent simulated injections (e.g. the same controller on different datasets, or different controller
+parameters on the same dataset) in parallel on the cores of a local machine.
+
+Datasets are sent to each worker process once, either inherited through fork or passed to the worker when it
+starts, and jobs only refer to them by key. Results are sent back as soon as each job finishes. Chemicals in the
+results are replaced by references to the datasets, so they are not copied back and the results refer to the same
+chemical objects as the caller's datasets.
+
+If the runner is given a ResultCache, jobs with an evaluate function that have been run before are not run again,
+and their summaries are read from the cache instead.
+
+Jobs without a seed are each given their own child of a random SeedSequence when they are submitted, and the global
+random state of each worker is reseeded when it starts, so that unseeded injections are independent rather than all
+continuing the random state that forked workers inherit from the parent.
+"""
+import io
+import multiprocessing
+import os
+import pickle
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from loguru import logger
+
+from vimms.Common import POSITIVE
+from vimms.Environment import Environment
+from vimms.MassSpec import IndependentMassSpectrometer
+
+# the datasets of a worker process, set when the worker starts or inherited from the parent through fork
+_DATASETS = None
+
+
+class JobTimeoutError(Exception):
+    """
+    Raised in a worker when a job runs for longer than its timeout
+    """
+    pass
+
+
+class ExperimentJob(object):
+    """
+    A single simulated injection: a controller run on one dataset
+    """
+
+    def __init__(self, name, dataset_key, controller, min_rt, max_rt, ionisation_mode=POSITIVE,
+                 mass_spec_params=None, out_dir=None, out_file=None, evaluate=None, seed=None):
+        """
+        Creates a job
+        :param name: a name to identify the job
+        :param dataset_key: the key (or index) of the dataset in the datasets of the ExperimentRunner
+        :param controller: a new controller object to run
+        :param min_rt: start time of the injection
+        :param max_rt: end time of the injection
+        :param ionisation_mode: the ionisation mode of the mass spec
+        :param mass_spec_params: a dictionary of other arguments to IndependentMassSpectrometer, if any
+        :param out_dir: output directory of the mzML file, if any
+        :param out_file: output filename of the mzML file, if any
+        :param evaluate: a function that takes the environment after the run and returns the result of the job.
+        It must be picklable, i.e. defined at the top level of a module. If None, the environment is returned.
+        :param seed: the seed of the random number generator of the mass spec for the run (an int, a
+        numpy.random.SeedSequence, or a Generator such as one from vimms.Common.spawn_rngs), or None to use numpy's
+        global random state. An ExperimentRunner gives each job without a seed its own random seed.
+        """
+        self.name = name
+        self.dataset_key = dataset_key
+        self.controller = controller
+        self.min_rt = min_rt
+        self.max_rt = max_rt
+        self.ionisation_mode = ionisation_mode
+        self.mass_spec_params = {} if mass_spec_params is None else mass_spec_params
+        self.out_dir = out_dir
+        self.out_file = out_file
+        self.evaluate = evaluate
+        self.seed = seed
+
+    def run(self, datasets, seed=None):
+        """
+        Runs the job
+        :param datasets: the datasets of the runner
+        :param seed: the seed to use if the job doesn't have one, e.g. given by the runner, or None
+        :return: the result of the job
+        """
+        mass_spec_params = dict(self.mass_spec_params)
+        if self.seed is not None:
+            mass_spec_params['rng'] = np.random.default_rng(self.seed)
+        elif seed is not None and 'rng' not in mass_spec_params:
+            mass_spec_params['rng'] = np.random.default_rng(seed)
+        mass_spec = IndependentMassSpectrometer(self.ionisation_mode, datasets[self.dataset_key], **mass_spec_params)
+        env = Environment(mass_spec, self.controller, self.min_rt, self.max_rt, progress_bar=False,
+                          out_dir=self.out_dir, out_file=self.out_file)
+        env.run()
+        return env if self.evaluate is None else self.evaluate(env)
+
+    def get_cache_key(self, cache, datasets):
+        """
+        Computes the key of the result of the job in a cache
+        :param cache: a ResultCache
+        :param datasets: the datasets of the runner
+        :return: the key
+        """
+        params = {
+            'ionisation_mode': self.ionisation_mode,
+            'mass_spec_params': self.mass_spec_params,
+            'min_rt': self.min_rt,
+            'max_rt': self.max_rt,
+            'evaluate': self.evaluate
+        }
+        return cache.get_key(datasets[self.dataset_key], self.controller, params=params, seed=self.seed)
+
+    def __repr__(self):
+        return 'ExperimentJob %s on dataset %s' % (self.name, self.dataset_key)
+
+
+class JobResult(object):
+    """
+    The outcome of a job
+    """
+
+    def __init__(self, job, result=None, error=None, elapsed=None, cached=False):
+        """
+        Creates a job result
+        :param job: the ExperimentJob
+        :param result: the result of the job, None if it failed
+        :param error: the exception raised by the job, if it failed
+        :param elapsed: how long the job took to run, in seconds
+        :param cached: whether the result was read from a cache rather than computed
+        """
+        self.job = job
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+        self.cached = cached
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def __repr__(self):
+        if self.failed:
+            status = 'failed (%s)' % self.error
+        else:
+            status = 'cached' if self.cached else 'done in %.1fs' % self.elapsed
+        return 'JobResult for %s: %s' % (self.job.name, status)
+
+
+class ExperimentRunner(object):
+    """
+    Runs ExperimentJobs in a pool of worker processes
+    """
+
+    def __init__(self, datasets, max_workers=None, max_pending=None, timeout=None, mp_context=None, cache=None):
+        """
+        Creates an experiment runner
+        :param datasets: a list or dictionary of datasets (lists of chemicals), referred to by the jobs
+        :param max_workers: the number of worker processes, by default the number of cores
+        :param max_pending: the maximum number of jobs submitted to the pool at once, by default twice the number
+        of workers. Other jobs wait until one of these finishes, so large sweeps don't use much memory.
+        :param timeout: the maximum time in seconds that a job can run for, or None. Jobs that take longer fail
+        with a JobTimeoutError. Only supported on platforms with SIGALRM.
+        :param mp_context: the multiprocessing start method ('fork', 'spawn' or 'forkserver'), by default that of
+        the platform. With 'fork', datasets are inherited by the workers rather than pickled.
+        :param cache: a ResultCache to store the results of jobs with an evaluate function, or None
+        """
+        self.datasets = datasets
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.max_pending = 2 * self.max_workers if max_pending is None else max_pending
+        self.timeout = timeout
+        self.mp_context = multiprocessing.get_context(mp_context)
+        self.cache = cache
+        if timeout is not None and not hasattr(signal, 'setitimer'):
+            logger.warning('Job timeouts are not supported on this platform and will be ignored')
+
+    def run(self, jobs):
+        """
+        Runs jobs, yielding their results in the order they finish
+        :param jobs: an iterable of ExperimentJob objects
+        :return: a generator of JobResult objects
+        """
+        global _DATASETS
+        if self.mp_context.get_start_method() == 'fork':
+            _DATASETS = self.datasets
+            init_datasets = None
+        else:
+            init_datasets = self.datasets
+
+        jobs = iter(jobs)
+        seed_sequence = np.random.SeedSequence()
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context,
+                                     initializer=_init_worker, initargs=(init_datasets,)) as executor:
+                pending = {}
+                while True:
+                    for job in jobs:
+                        key, summary = self._check_cache(job)
+                        if summary is not None:
+                            yield summary
+                            continue
+                        seed = seed_sequence.spawn(1)[0] if job.seed is None else None
+                        pending[executor.submit(_run_job, job, self.timeout, seed)] = (job, key)
+                        if len(pending) >= self.max_pending:
+                            break
+                    if len(pending) == 0:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job, key = pending.pop(future)
+                        yield self._get_result(job, key, future)
+        finally:
+            _DATASETS = None
+
+    def run_all(self, jobs):
+        """
+        Runs jobs and waits for all of them to finish
+        :param jobs: a list of ExperimentJob objects
+        :return: a list of JobResult objects, in the same order as jobs
+        """
+        results = {id(result.job): result for result in self.run(jobs)}
+        return [results[id(job)] for job in jobs]
+
+    def _check_cache(self, job):
+        # returns the cache key of a job, and its result if it's cached and shouldn't be verified
+        if self.cache is None or job.evaluate is None:
+            return None, None
+        key = job.get_cache_key(self.cache, self.datasets)
+        entry = self.cache.get(key)
+        if entry is None:
+            return key, None
+        if self.cache.should_verify():
+            return (key, entry), None
+        logger.info('{} found in cache', job)
+        return key, JobResult(job, result=entry.load_summary(), elapsed=0.0, cached=True)
+
+    def _get_result(self, job, key, future):
+        try:
+            data, elapsed = future.result()
+            result = _SharedUnpickler(io.BytesIO(data), self.datasets).load()
+        except Exception as e:
+            logger.warning('{} failed: {!r}', job, e)
+            return JobResult(job, error=e)
+
+        logger.info('{} finished in {:.1f}s', job, elapsed)
+        if isinstance(key, tuple):  # a cache hit that was recomputed to verify it
+            key, entry = key
+            self.cache.verify(key, entry.load_summary(), result)
+        elif key is not None:
+            mzml_path = None if job.out_file is None else os.path.join(job.out_dir, job.out_file)
+            self.cache.put(key, result, mzml_path=mzml_path)
+        return JobResult(job, result=result, elapsed=elapsed)
+
+
+def _init_worker(datasets):
+    global _DATASETS
+    if datasets is not None:
+        _DATASETS = datasets
+    # forked workers would otherwise all continue the global random state of the parent
+    np.random.seed()
+
+
+def _run_job(job, timeout, seed=None):
+    use_timer = timeout is not None and hasattr(signal, 'setitimer')
+    if use_timer:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    start = time.time()
+    try:
+        result = job.run(_DATASETS, seed=seed)
+    finally:
+        if use_timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    elapsed = time.time() - start
+
+    f = io.BytesIO()
+    _SharedPickler(f, _DATASETS).dump(result)
+    return f.getvalue(), elapsed
+
+
+def _raise_timeout(signum, frame):
+    raise JobTimeoutError('Job took longer than its timeout')
+
+
+def _iterate_datasets(datasets):
+    return datasets.items() if isinstance(datasets, dict) else enumerate(datasets)
+
+
+class _SharedPickler(pickle.Pickler):
+    """
+    Pickles the datasets, and the chemicals in them, as references
+    """
+
+    def __init__(self, f, datasets):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.datasets = datasets
+        self.shared = {}
+        for key, dataset in _iterate_datasets(datasets):
+            self.shared[id(dataset)] = (key, None)
+            self.shared.update((id(chem), (key, i)) for i, chem in enumerate(dataset))
+
+    def persistent_id(self, obj):
+        ref = self.shared.get(id(obj))
+        if ref is not None and _resolve(self.datasets, ref) is obj:
+            return ref
+        return None
+
+
+class _SharedUnpickler(pickle.Unpickler):
+    """
+    Resolves references to chemicals in the datasets
+    """
+
+    def __init__(self, f, datasets):
+        super().__init__(f)
+        self.datasets = datasets
+
+    def persistent_load(self, pid):
+        return _resolve(self.datasets, pid)
+
+
+def _resolve(datasets, ref):
+    key, i = ref
+    return datasets[key] if i is None else datasets[key][i]
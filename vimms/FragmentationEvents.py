@@ -0,0 +1,255 @@
+"""
+Provides sinks that record the fragmentation events (which chemicals produced peaks in which scans) of a mass spec.
+Events are kept either as ScanEvent objects, as columns of numpy arrays (in memory or spilled to disk in chunks),
+or not at all.
+"""
+import glob
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+# the columns recorded for every fragmentation event, and their types
+EVENT_COLUMNS = [
+    ('chem_idx', np.int64),  # index of the chemical in the list of chemicals of the mass spec
+    ('scan_id', np.int64),
+    ('rt', np.float64),
+    ('precursor_mz', np.float64),  # NaN if the scan has no precursor
+    ('intensity', np.float64),  # see FragmentationEventSink.add
+    ('ms_level', np.int64),
+]
+
+
+class FragmentationEventSink(object):
+    """
+    Base class for fragmentation event sinks.
+    """
+    # whether this sink stores ScanEvent objects, and so needs them to be created for every event
+    keeps_events = False
+
+    def add(self, scan_id, rt, ms_level, precursor_mz, chem_idx, intensities, events=None):
+        """
+        Records the fragmentation events of a scan, one for each chemical that produced peaks in it
+        :param scan_id: the scan id
+        :param rt: the time of the scan
+        :param ms_level: the MS level of the scan
+        :param precursor_mz: the m/z of the (first) precursor of the scan, or None
+        :param chem_idx: an array of chemical indices
+        :param intensities: an array of the intensities of the chemicals. For MS1 scans this is the intensity
+        of the first peak of the chemical in the scan, for MS2+ scans the MS1 intensity of the fragmented precursor.
+        :param events: a list of ScanEvent objects, one for each chemical. Only given if keeps_events is True.
+        """
+        raise NotImplementedError()
+
+    def get_columns(self):
+        """
+        Gets all the recorded events as columns
+        :return: a dictionary of column name to numpy array, see EVENT_COLUMNS
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Called when the mass spec is closed
+        """
+        pass
+
+    def __len__(self):
+        return len(self.get_columns()['chem_idx'])
+
+    def __iter__(self):
+        raise NotImplementedError('%s does not keep ScanEvent objects' % type(self).__name__)
+
+
+class NullEventSink(FragmentationEventSink):
+    """
+    A sink that discards all fragmentation events
+    """
+
+    def add(self, scan_id, rt, ms_level, precursor_mz, chem_idx, intensities, events=None):
+        pass
+
+    def get_columns(self):
+        return _empty_columns()
+
+
+class ColumnarEventSink(FragmentationEventSink):
+    """
+    A sink that stores fragmentation events in memory as columns of numpy arrays, grown by doubling
+    """
+
+    def __init__(self, initial_capacity=1024):
+        """
+        Creates a columnar event sink
+        :param initial_capacity: the initial number of events that can be stored before growing the arrays
+        """
+        self.size = 0
+        self.columns = {name: np.zeros(initial_capacity, dtype=dtype) for name, dtype in EVENT_COLUMNS}
+
+    def add(self, scan_id, rt, ms_level, precursor_mz, chem_idx, intensities, events=None):
+        n = len(chem_idx)
+        if n == 0:
+            return
+        capacity = len(self.columns['chem_idx'])
+        if self.size + n > capacity:
+            new_capacity = max(2 * capacity, self.size + n)
+            for name, dtype in EVENT_COLUMNS:
+                column = np.zeros(new_capacity, dtype=dtype)
+                column[:self.size] = self.columns[name][:self.size]
+                self.columns[name] = column
+
+        end = self.size + n
+        self.columns['chem_idx'][self.size:end] = chem_idx
+        self.columns['scan_id'][self.size:end] = scan_id
+        self.columns['rt'][self.size:end] = rt
+        self.columns['precursor_mz'][self.size:end] = np.nan if precursor_mz is None else precursor_mz
+        self.columns['intensity'][self.size:end] = intensities
+        self.columns['ms_level'][self.size:end] = ms_level
+        self.size = end
+
+    def get_columns(self):
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+    def clear(self):
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+
+class ScanEventList(ColumnarEventSink):
+    """
+    A sink that keeps a ScanEvent object for every fragmentation event, in addition to the columns.
+    This is the default, and can be iterated over like the list of events it replaces.
+    """
+    keeps_events = True
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def add(self, scan_id, rt, ms_level, precursor_mz, chem_idx, intensities, events=None):
+        super().add(scan_id, rt, ms_level, precursor_mz, chem_idx, intensities)
+        self.events.extend(events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __getitem__(self, item):
+        return self.events[item]
+
+
+class ChunkedDiskEventSink(ColumnarEventSink):
+    """
+    A sink that stores fragmentation events as columns, writing them to .npz files on disk every chunk_size events
+    so that memory use stays bounded. The chunks stay on disk, and are read back when get_columns is called.
+    """
+
+    def __init__(self, out_dir=None, chunk_size=100000):
+        """
+        Creates a chunked disk event sink
+        :param out_dir: the directory to write chunks to. If None, a temporary directory is created, which is removed
+        by cleanup, or when the sink is garbage collected or Python exits.
+        :param chunk_size: the number of events kept in memory before they are written out
+        """
+        super().__init__(initial_capacity=chunk_size)
+        self.owns_dir = out_dir is None
+        self.chunk_size = chunk_size
+        self.chunk_files = []
+        self.num_written = 0
+        if self.owns_dir:
+            self._make_temp_dir()
+        else:
+            self.out_dir = out_dir
+            self._finalizer = None
+        os.makedirs(self.out_dir, exist_ok=True)
+
+    def _make_temp_dir(self):
+        self.out_dir = tempfile.mkdtemp(prefix='vimms_events_')
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.out_dir, ignore_errors=True)
+
+    def add(self, scan_id, rt, ms_level, precursor_mz, chem_idx, intensities, events=None):
+        super().add(scan_id, rt, ms_level, precursor_mz, chem_idx, intensities)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the events currently held in memory to a new chunk file, unless the temporary directory has been
+        removed by cleanup, in which case they stay in memory
+        """
+        if self.size == 0 or self.out_dir is None:
+            return
+        fname = os.path.join(self.out_dir, 'events_%06d.npz' % len(self.chunk_files))
+        np.savez(fname, **super().get_columns())
+        self.chunk_files.append(fname)
+        self.num_written += self.size
+        self.clear()
+
+    def get_columns(self):
+        return _concatenate_chunks(_load_chunks(self.chunk_files) + [super().get_columns()])
+
+    def close(self):
+        """
+        Writes the remaining events to disk
+        """
+        self.flush()
+
+    def cleanup(self):
+        """
+        Removes the temporary directory created by the sink, and the events written to it. Does nothing if the sink
+        was given its own out_dir.
+        """
+        if self._finalizer is not None:
+            self._finalizer()
+            self.out_dir = None
+            self.chunk_files = []
+            self.num_written = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_finalizer']
+        if self.owns_dir and self.out_dir is not None:
+            # the temporary directory is removed with this sink, so a copy takes the events with it
+            columns = self.get_columns()
+            state.update(columns=columns, size=len(columns['chem_idx']), chunk_files=[], num_written=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._finalizer = None
+        if self.owns_dir and self.out_dir is not None:
+            self._make_temp_dir()
+            self.flush()
+            self.columns = {name: np.zeros(self.chunk_size, dtype=dtype) for name, dtype in EVENT_COLUMNS}
+
+    def __len__(self):
+        return self.num_written + self.size
+
+
+def load_chunked_events(out_dir):
+    """
+    Loads the columns of all fragmentation events written to a directory by a ChunkedDiskEventSink
+    :param out_dir: the directory containing the chunk files
+    :return: a dictionary of column name to numpy array, see EVENT_COLUMNS
+    """
+    fnames = sorted(glob.glob(os.path.join(out_dir, 'events_*.npz')))
+    return _concatenate_chunks(_load_chunks(fnames) + [_empty_columns()])
+
+
+def _load_chunks(fnames):
+    chunks = []
+    for fname in fnames:
+        with np.load(fname) as data:
+            chunks.append({name: data[name] for name, _ in EVENT_COLUMNS})
+    return chunks
+
+
+def _concatenate_chunks(chunks):
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name, _ in EVENT_COLUMNS}
+
+
+def _empty_columns():
+    return {name: np.zeros(0, dtype=dtype) for name, dtype in EVENT_COLUMNS}
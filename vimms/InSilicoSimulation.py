@@ -4,7 +4,6 @@ import json
 import os
 from pathlib import Path
 
-import ipyparallel as ipp
 import matplotlib.pyplot as plt
 import numpy as np
 from loguru import logger
@@ -16,6 +15,7 @@ from vimms.Chemicals import ChemicalMixtureFromMZML
 from vimms.Common import set_log_level_warning, set_log_level_debug
 from vimms.Controller import TopNController, TopN_SmartRoiController, WeightedDEWController
 from vimms.Environment import Environment
+from vimms.Executors import get_executor, EXECUTOR_PROCESSES
 from vimms.MassSpec import IndependentMassSpectrometer
 from vimms.Roi import RoiParams
 
@@ -126,7 +126,8 @@ def run_TopN(chems, scan_duration, params, out_dir):
     env.run()
 
 
-def run_SmartROI(chems, scan_duration, params, out_dir):
+def run_SmartROI(chems, scan_duration, params, out_dir, executor=EXECUTOR_PROCESSES, max_workers=None,
+                 chunksize=1):
     """
     Simulate SmartROI controller
     :param chems: a list of UnknownChemicals present in the injection
@@ -134,6 +135,9 @@ def run_SmartROI(chems, scan_duration, params, out_dir):
     :param params: a dictionary of parameters
     :param out_file: output mzML file
     :param out_dir: output directory
+    :param executor: the backend to run the controllers with, see vimms.Executors.get_executor
+    :param max_workers: the number of workers, by default the number of cores
+    :param chunksize: the number of controllers sent to a worker at once, or 'auto'
     :return: None
     """
     logger.info('Running SmartROI simulation')
@@ -154,24 +158,9 @@ def run_SmartROI(chems, scan_duration, params, out_dir):
             copy_params['out_dir'] = out_dir
             params_list.append(copy_params)
 
-    # Try to run the controllers in parallel. If fails, then run it serially
-    logger.warning('Running controllers in parallel, please wait ...')
-    run_serial = False
-    try:
-        rc = ipp.Client()
-        dview = rc[:]  # use all engines
-        with dview.sync_imports():
-            pass
-        dview.map_sync(run_single_SmartROI, params_list)
-    except OSError:  # cluster has not been started
-        run_serial = True
-    except ipp.error.TimeoutError:  # takes too long to run
-        run_serial = True
-
-    if run_serial:  # if any exception from above, try to run it serially
-        logger.warning('IPython cluster not found, running controllers in serial mode')
-        for copy_params in params_list:
-            run_single_SmartROI(copy_params)
+    executor = get_executor(executor, max_workers=max_workers, chunksize=chunksize)
+    logger.warning('Running controllers with {}, please wait ...', type(executor).__name__)
+    executor.map(run_single_SmartROI, params_list)
 
     set_log_level_debug(remove_id=warn_handler_id)
 
@@ -203,7 +192,8 @@ def run_single_SmartROI(params):
     env.run()
 
 
-def run_WeightedDEW(chems, scan_duration, params, out_dir):
+def run_WeightedDEW(chems, scan_duration, params, out_dir, executor=EXECUTOR_PROCESSES, max_workers=None,
+                    chunksize=1):
     """
     Simulate WeightedDEW controller
     :param chems: a list of UnknownChemicals present in the injection
@@ -211,6 +201,9 @@ def run_WeightedDEW(chems, scan_duration, params, out_dir):
     :param params: a dictionary of parameters
     :param out_file: output mzML file
     :param out_dir: output directory
+    :param executor: the backend to run the controllers with, see vimms.Executors.get_executor
+    :param max_workers: the number of workers, by default the number of cores
+    :param chunksize: the number of controllers sent to a worker at once, or 'auto'
     :return: None
     """
     logger.info('Running WeightedDEW simulation')
@@ -231,24 +224,9 @@ def run_WeightedDEW(chems, scan_duration, params, out_dir):
             copy_params['out_dir'] = out_dir
             params_list.append(copy_params)
 
-    # Try to run the controllers in parallel. If fails, then run it serially
-    logger.warning('Running controllers in parallel, please wait ...')
-    try:
-        import ipyparallel as ipp
-        rc = ipp.Client()
-        dview = rc[:]  # use all engines
-        with dview.sync_imports():
-            pass
-        dview.map_sync(run_single_WeightedDEW, params_list)
-    except OSError:  # cluster has not been started
-        run_serial = True
-    except ipp.error.TimeoutError:  # takes too long to run
-        run_serial = True
-
-    if run_serial:  # if any exception from above, try to run it serially
-        logger.warning('IPython cluster not found, running controllers in serial mode')
-        for copy_params in params_list:
-            run_single_WeightedDEW(copy_params)
+    executor = get_executor(executor, max_workers=max_workers, chunksize=chunksize)
+    logger.warning('Running controllers with {}, please wait ...', type(executor).__name__)
+    executor.map(run_single_WeightedDEW, params_list)
 
     set_log_level_debug(remove_id=warn_handler_id)
 
@@ -0,0 +1,90 @@
+"""
+Provides array kernels to match many precursor m/z values against the isolation windows of a scan at once.
+This is used by the mass spec for scans with many windows (e.g. SWATH or multiple isolation), where thousands of
+precursors are tested per scan.
+"""
+import math
+
+import numpy as np
+
+
+class IsolationWindowSet(object):
+    """
+    The isolation windows of one MS level of a scan, as a list of (min_mz, max_mz) pairs.
+
+    An m/z value is isolated if min_mz < mz <= max_mz for any of the windows. Overlapping windows are merged into
+    disjoint, sorted intervals, so that membership of N values in W windows is found with a binary search in
+    O(N log W) rather than O(N W).
+    """
+
+    def __init__(self, windows):
+        """
+        Creates an isolation window set
+        :param windows: a list of (min_mz, max_mz) pairs
+        """
+        self.windows = windows
+        bounds = np.array([(window[0], window[1]) for window in windows if window[0] < window[1]],
+                          dtype=np.float64).reshape(-1, 2)
+        bounds = bounds[np.argsort(bounds[:, 0], kind='stable')]
+
+        # merge windows that overlap or touch, since (a, b] and (c, d] with c <= b together are (a, max(b, d)]
+        lows, highs = [], []
+        for low, high in bounds.tolist():
+            if len(highs) > 0 and low <= highs[-1]:
+                highs[-1] = max(highs[-1], high)
+            else:
+                lows.append(low)
+                highs.append(high)
+        self.lows = np.array(lows, dtype=np.float64)
+        self.highs = np.array(highs, dtype=np.float64)
+
+        # the Gaussian isolation transition is centred on the first window, as it always has been
+        self.centre = sum(windows[0]) / 2 if len(windows) > 0 else None
+
+    def contains(self, mzs):
+        """
+        Finds which m/z values fall into one of the windows
+        :param mzs: an array of m/z values, of any shape
+        :return: a boolean array of the same shape as mzs
+        """
+        mzs = np.asarray(mzs, dtype=np.float64)
+        if len(self.lows) == 0:
+            return np.zeros(mzs.shape, dtype=bool)
+        # the last window starting below each m/z value is the only one that can contain it
+        pos = np.searchsorted(self.lows, mzs, side='left') - 1
+        return (pos >= 0) & (mzs <= self.highs[np.maximum(pos, 0)])
+
+    def get_transmission(self, mzs, transition='rectangular', transition_params=None):
+        """
+        Gets the fraction of the signal at some m/z values that is transmitted through the windows
+        :param mzs: an array of m/z values, of any shape
+        :param transition: the isolation transition window, 'rectangular' or 'gaussian'
+        :param transition_params: the parameters of the transition window, [sigma] for 'gaussian'
+        :return: an array of the same shape as mzs, 0 outside the windows
+        """
+        weights = self.contains(mzs).astype(np.float64)
+        if transition == 'gaussian':
+            weights *= gaussian_transition(np.asarray(mzs) - self.centre, transition_params[0])
+        return weights
+
+
+def gaussian_transition(delta_mzs, sigma):
+    """
+    The Gaussian isolation transition, i.e. the Gaussian density at some distances from the window centre
+    relative to its value at the centre. Computed in closed form, for scalars or arrays.
+    :param delta_mzs: the distances from the window centre
+    :param sigma: the standard deviation of the Gaussian
+    :return: the relative transmission, between 0 and 1
+    """
+    if np.isscalar(delta_mzs):
+        return math.exp(-0.5 * (delta_mzs / sigma) ** 2)
+    return np.exp(-0.5 * (np.asarray(delta_mzs, dtype=np.float64) / sigma) ** 2)
+
+
+def get_window_sets(isolation_windows):
+    """
+    Creates window sets for the isolation windows of a scan
+    :param isolation_windows: a list, for each MS level, of a list of (min_mz, max_mz) pairs
+    :return: a list of IsolationWindowSet objects, one for each MS level
+    """
+    return [IsolationWindowSet(windows) for windows in isolation_windows]
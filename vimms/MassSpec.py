@@ -1,12 +1,17 @@
 import math
+from collections import deque
 
 import numpy as np
-import scipy
 from events import Events
 from loguru import logger
 
-from vimms.Common import adduct_transformation, DEFAULT_SCAN_TIME_DICT, INITIAL_SCAN_ID, ScanParameters
-from vimms.Noise import NoPeakNoise
+from vimms.ChemicalStore import ChemicalStore
+from vimms.Common import adduct_transformation, DEFAULT_SCAN_TIME_DICT, INITIAL_SCAN_ID, ScanParameters, \
+    GLOBAL_RNG, get_rng, takes_rng
+from vimms.FragmentationEvents import ScanEventList
+from vimms.IsolationWindows import IsolationWindowSet, gaussian_transition, get_window_sets
+from vimms.Noise import NoPeakNoise, get_array_noise
+from vimms.Timing import NULL_TIMER, STAGE_CHEMICAL_LOOKUP, STAGE_PEAK_GENERATION, STAGE_NOISE
 
 
 class Peak(object):
@@ -43,11 +48,17 @@ class Peak(object):
 
 class Scan(object):
     """
-    A class to store scan information
+    A class to store scan information.
+
+    The m/z and intensity values are kept as contiguous float64 arrays, sorted by m/z value. Scans generated by
+    the simulator also keep the index of the chemical that produced each peak (-1 for spike noise). Peak objects
+    are only created when the peaks property is used.
     """
+    __slots__ = ('scan_id', 'mzs', 'intensities', 'chem_idx', 'ms_level', 'rt', 'num_peaks', 'scan_duration',
+                 'scan_params', 'parent', 'fragevent', '_peaks')
 
     def __init__(self, scan_id, mzs, intensities, ms_level, rt,
-                 scan_duration=None, scan_params=None, parent=None, fragevent=None):
+                 scan_duration=None, scan_params=None, parent=None, fragevent=None, chem_idx=None, is_sorted=False):
         """
         Creates a scan
         :param scan_id: current scan id
@@ -58,14 +69,25 @@ class Scan(object):
         :param scan_duration: how long this scan takes, if known.
         :param scan_params: the parameters used to generate this scan, if known
         :param parent: parent precursor peak, if known
+        :param fragevent: the last fragmentation event of this scan, if known
+        :param chem_idx: an array of the chemical index of each peak, if known
+        :param is_sorted: whether mzs is already sorted, in which case the values are not sorted again
         """
         assert len(mzs) == len(intensities)
         self.scan_id = scan_id
 
         # ensure that mzs and intensites are sorted by their mz values
-        p = mzs.argsort()
-        self.mzs = mzs[p]
-        self.intensities = intensities[p]
+        mzs = np.ascontiguousarray(mzs, dtype=np.float64)
+        intensities = np.ascontiguousarray(intensities, dtype=np.float64)
+        if is_sorted:
+            self.mzs = mzs
+            self.intensities = intensities
+            self.chem_idx = chem_idx
+        else:
+            p = mzs.argsort()
+            self.mzs = mzs[p]
+            self.intensities = intensities[p]
+            self.chem_idx = chem_idx[p] if chem_idx is not None else None
 
         self.ms_level = ms_level
         self.rt = rt
@@ -75,6 +97,26 @@ class Scan(object):
         self.scan_params = scan_params
         self.parent = parent
         self.fragevent = fragevent
+        self._peaks = None
+
+    @property
+    def peaks(self):
+        """
+        Gets the peaks of this scan as Peak objects, created the first time they're needed
+        :return: a list of Peak objects, sorted by m/z value
+        """
+        if self._peaks is None:
+            self._peaks = [Peak(mz, self.rt, intensity, self.ms_level) for mz, intensity in
+                           zip(self.mzs.tolist(), self.intensities.tolist())]
+        return self._peaks
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != '_peaks'}
+
+    def __setstate__(self, state):
+        # scans pickled before __slots__ was used may not have all the attributes
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
 
     def __repr__(self):
         return 'Scan %d num_peaks=%d rt=%.2f ms_level=%d' % (self.scan_id, self.num_peaks, self.rt, self.ms_level)
@@ -120,6 +162,10 @@ class ScanEvent(object):
 class TaskManager(object):
     """
     A class to track how many new tasks (scan commands) that we can send, given the buffer size of the mass spec.
+
+    Both queues are deques, so tasks are added and popped in O(1). Pending tasks are wrapped in nodes that are also
+    indexed by task identity, so that a completed task can be removed in O(1) by marking its nodes as removed.
+    Removed nodes are dropped lazily once they reach the front of the queue.
     """
 
     def __init__(self, buffer_size=5):
@@ -129,8 +175,10 @@ class TaskManager(object):
         ensure that there is not more than this number of tasks enqueued on the mass spec, see
         https://github.com/thermofisherlsms/iapi/issues/22.
         """
-        self.current_tasks = []
-        self.pending_tasks = []
+        self.current_tasks = deque()
+        self.pending_tasks = deque()  # of _TaskNode objects, including removed ones
+        self.pending_index = {}  # id of a pending task -> list of its nodes in pending_tasks
+        self.num_pending = 0
         self.buffer_size = buffer_size
 
     def add_current(self, tasks):
@@ -147,7 +195,11 @@ class TaskManager(object):
         :param tasks: list of pending tasks
         :return: None
         """
-        self.pending_tasks.extend(tasks)
+        for task in tasks:
+            node = _TaskNode(task)
+            self.pending_tasks.append(node)
+            self.pending_index.setdefault(id(task), []).append(node)
+            self.num_pending += 1
 
     def remove_pending(self, completed_task):
         """
@@ -155,7 +207,16 @@ class TaskManager(object):
         :param completed_task: a newly completed task
         :return:
         """
-        self.pending_tasks = [t for t in self.pending_tasks if t != completed_task]
+        nodes = self.pending_index.pop(id(completed_task), [])
+        for node in nodes:
+            node.removed = True
+        self.num_pending -= len(nodes)
+        self._drop_removed()
+
+        # removed nodes are normally at the front, since tasks complete in the order they are sent,
+        # but compact the queue if too many of them have piled up elsewhere
+        if len(self.pending_tasks) > 2 * self.num_pending + self.buffer_size:
+            self.pending_tasks = deque(node for node in self.pending_tasks if not node.removed)
 
     def to_send(self):
         """
@@ -174,14 +235,21 @@ class TaskManager(object):
         Remove the first current task (ready to send)
         :return: a current task
         """
-        return self.current_tasks.pop(0)
+        return self.current_tasks.popleft()
 
     def pop_pending(self):
         """
         Remove the first pending task (sent but not received)
         :return: a pending task
         """
-        return self.pending_tasks.pop(0)
+        self._drop_removed()
+        node = self.pending_tasks.popleft()
+        nodes = self.pending_index[id(node.task)]
+        nodes.remove(node)
+        if len(nodes) == 0:
+            del self.pending_index[id(node.task)]
+        self.num_pending -= 1
+        return node.task
 
     def peek_current(self):
         """
@@ -195,7 +263,8 @@ class TaskManager(object):
         Get the first pending task (sent but not received) without removing it
         :return: a pending task
         """
-        return self.pending_tasks[0]
+        self._drop_removed()
+        return self.pending_tasks[0].task
 
     def current_size(self):
         """
@@ -209,7 +278,35 @@ class TaskManager(object):
         Get the size of pending tasks
         :return: the size of pending tasks
         """
-        return len(self.pending_tasks)
+        return self.num_pending
+
+    def _drop_removed(self):
+        while len(self.pending_tasks) > 0 and self.pending_tasks[0].removed:
+            self.pending_tasks.popleft()
+
+    def __getstate__(self):
+        # the index is keyed by object ids, which change when unpickled, so it's rebuilt in __setstate__
+        state = self.__dict__.copy()
+        del state['pending_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pending_index = {}
+        for node in self.pending_tasks:
+            if not node.removed:
+                self.pending_index.setdefault(id(node.task), []).append(node)
+
+
+class _TaskNode(object):
+    """
+    A pending task in the queue of TaskManager
+    """
+    __slots__ = ('task', 'removed')
+
+    def __init__(self, task):
+        self.task = task
+        self.removed = False
 
 
 class IndependentMassSpectrometer(object):
@@ -223,9 +320,16 @@ class IndependentMassSpectrometer(object):
     ACQUISITION_STREAM_CLOSED = 'AcquisitionStreamClosing'
     STATE_CHANGED = 'StateChanged'
 
+    # records how long scan generation takes, set by the environment when timing is enabled
+    timer = NULL_TIMER
+
+    # draws noise and sampled scan durations, numpy's global random state unless a generator is given
+    rng = GLOBAL_RNG
+
     def __init__(self, ionisation_mode, chemicals, mz_noise=None, intensity_noise=None, spike_noise=None,
                  isolation_transition_window='rectangular', isolation_transition_window_params=None,
-                 scan_duration=DEFAULT_SCAN_TIME_DICT, task_manager=None):
+                 scan_duration=DEFAULT_SCAN_TIME_DICT, task_manager=None, chemical_store=None,
+                 event_sink=None, rng=None):
         """
         Creates a mass spec object.
         :param ionisation_mode: POSITIVE or NEGATIVE
@@ -233,6 +337,12 @@ class IndependentMassSpectrometer(object):
         :param peak_sampler: an instance of DataGenerator.PeakSampler object
         :param add_noise: a flag to indicate whether to add noise
         :param use_exclusion_list: a flag to indicate whether to perform dynamic exclusion
+        :param chemical_store: a ChemicalStore built from the same chemicals and ionisation mode, e.g. from a
+        previous injection. If None, a new one is created.
+        :param event_sink: a FragmentationEventSink that records which chemicals produce peaks in which scans.
+        If None, a ScanEventList is used, which keeps a ScanEvent object for every event.
+        :param rng: the random number generator of this mass spec, see vimms.Common.get_rng. Give each injection
+        its own generator (e.g. from vimms.Common.spawn_rngs) to make parallel runs reproducible and independent.
         """
 
         # current scan index and internal time
@@ -256,26 +366,32 @@ class IndependentMassSpectrometer(object):
         self.chemicals = chemicals
         self.ionisation_mode = ionisation_mode
 
+        # columnar view of the chemicals, used to generate MS1 scans in a batch
+        # and to look up the chemicals eluting at a given time
+        if chemical_store is not None:
+            assert chemical_store.chemicals is chemicals and chemical_store.ionisation_mode == ionisation_mode
+            self.chemical_store = chemical_store
+        else:
+            self.chemical_store = ChemicalStore(self.chemicals, self.ionisation_mode)
+
         # stores the chromatograms start and end rt for quick retrieval
-        chem_rts = np.array([chem.rt for chem in self.chemicals])
-        self.chrom_min_rts = np.array([chem.chromatogram.min_rt for chem in self.chemicals]) + chem_rts
-        self.chrom_max_rts = np.array([chem.chromatogram.max_rt for chem in self.chemicals]) + chem_rts
-
-        # whether to add noise to the generated peaks, the default is no noise
-        self.mz_noise = mz_noise
-        self.intensity_noise = intensity_noise
-        if self.mz_noise is None:
-            self.mz_noise = NoPeakNoise()
-        if self.intensity_noise is None:
-            self.intensity_noise = NoPeakNoise()
+        self.chrom_min_rts = self.chemical_store.elution_index.min_rts
+        self.chrom_max_rts = self.chemical_store.elution_index.max_rts
+
+        # whether to add noise to the generated peaks, the default is no noise.
+        # Noise objects that only implement get are wrapped so that they can be applied to whole scans
+        self.mz_noise = get_array_noise(mz_noise)
+        self.intensity_noise = get_array_noise(intensity_noise)
         self.spike_noise = spike_noise
 
-        self.fragmentation_events = []  # which chemicals produce which peaks
+        # which chemicals produce which peaks
+        self.fragmentation_events = event_sink if event_sink is not None else ScanEventList()
 
         self.isolation_transition_window = isolation_transition_window
         self.isolation_transition_window_params = isolation_transition_window_params
 
         self.scan_duration_dict = scan_duration
+        self.rng = get_rng(rng)
 
     ####################################################################################################################
     # Public methods
@@ -301,7 +417,7 @@ class IndependentMassSpectrometer(object):
         # Send params away. In the simulated case, no sending actually occurs,
         # instead we just track these params we've sent by adding them to self.environment.pending_tasks
         if len(params_list) > 0:
-            logger.debug('new tasks ready to send = %d' % len(params_list))
+            logger.debug('new tasks ready to send = {}', len(params_list))
             self.send_params(params_list)
 
         # pick up the last param that has been sent and generate a new scan
@@ -342,14 +458,14 @@ class IndependentMassSpectrometer(object):
             otherwise it returns nothing (default scan set in actual MS)
         """
         params_list = self.task_manager.to_send()
-        logger.debug('Selected %d tasks to send' % (len(params_list)))
+        logger.debug('Selected {} tasks to send', len(params_list))
         return params_list
 
     def send_params(self, params_list):
         # in the real IAPI mass spec, we would send these params to the instrument.
         # but here we just store them in the list of pending tasks to be processed later
         self.task_manager.add_pending(params_list)
-        logger.debug('Successfully sent %d tasks' % (len(params_list)))
+        logger.debug('Successfully sent {} tasks', len(params_list))
 
     def fire_event(self, event_name, arg=None):
         """
@@ -399,6 +515,7 @@ class IndependentMassSpectrometer(object):
     def close(self):
         logger.debug('Unregistering event handlers')
         self.clear_events()
+        self.fragmentation_events.close()
 
     ####################################################################################################################
     # Private methods
@@ -420,11 +537,12 @@ class IndependentMassSpectrometer(object):
             # if queue is empty, the next one is an MS1 scan by default
             next_level = next_scan_param.get(ScanParameters.MS_LEVEL) if next_scan_param is not None else 1
 
-            # pass both current and next MS level when sampling scan duration
-            current_scan_duration = scan_sampler.sample_time(current_level, next_level)
+            # pass both current and next MS level when sampling scan duration, and the generator if it takes one
+            rng_kwargs = {'rng': self.rng} if takes_rng(scan_sampler.sample_time) else {}
+            current_scan_duration = scan_sampler.sample_time(current_level, next_level, **rng_kwargs)
 
         self.time += current_scan_duration
-        logger.debug('scan_duration=%f time %f' % (current_scan_duration, self.time))
+        logger.debug('scan_duration={:f} time {:f}', current_scan_duration, self.time)
         return current_scan_duration
 
     ####################################################################################################################
@@ -437,15 +555,11 @@ class IndependentMassSpectrometer(object):
         :param scan_time: the timepoint
         :return: a mass spectrometry scan at that time
         """
-        frag = None
-
         min_measurement_mz = params.get(ScanParameters.FIRST_MASS)
         max_measurement_mz = params.get(ScanParameters.LAST_MASS)
 
         ms1_source_collision_energy = params.get(ScanParameters.SOURCE_CID_ENERGY)
 
-        scan_mzs = []  # all the mzs values in this scan
-        scan_intensities = []  # all the intensity values in this scan
         ms_level = params.get(ScanParameters.MS_LEVEL)
         if ms_level == 1:  # if ms1 then we scan the whole range of m/z
             isolation_windows = params.get(ScanParameters.ISOLATION_WINDOWS)
@@ -465,70 +579,235 @@ class IndependentMassSpectrometer(object):
         scan_id = params.get(ScanParameters.SCAN_ID)
         if scan_id is None:
             scan_id = self.idx
+        timer = self.timer
+        timer.set_scan(scan_id)
 
         # for all chemicals that come out from the column coupled to the mass spec
+        start = timer.start()
         idx = self._get_chem_indices(scan_time)
+        timer.stop(STAGE_CHEMICAL_LOOKUP, start)
 
         # the following is to ensure we generate fragment data when we have a collision energe >0
         use_ms_level = ms_level
         if ms_level == 1 and ms1_source_collision_energy > 0:
             use_ms_level = 2
 
-        for i in idx:
-            chemical = self.chemicals[i]
-            # mzs is a list of (mz, intensity) for the different adduct/isotopes combinations of a chemical
-            mzs = self._get_all_mz_peaks(chemical, scan_time, use_ms_level, isolation_windows)
-            peaks = []
-            peaks_ms1_intensities = []
-            peaks_which_isotopes = []
-            peaks_which_adducts = []
-            if mzs is not None:
-                chem_mzs = []
-                chem_intensities = []
-                for peak_mz, peak_intensity, peak_ms1_int, peak_isotope, peak_adduct in mzs:
-                    if peak_mz >= min_measurement_mz and peak_mz <= max_measurement_mz and peak_intensity > 0:
-                        chem_mzs.append(peak_mz)
-                        chem_intensities.append(peak_intensity)
-                        p = Peak(peak_mz, scan_time, peak_intensity, use_ms_level)
-                        peaks.append(p)
-                        peaks_ms1_intensities.append(peak_ms1_int)
-                        peaks_which_isotopes.append(peak_isotope)
-                        peaks_which_adducts.append(peak_adduct)
-                scan_mzs.extend(chem_mzs)
-                scan_intensities.extend(chem_intensities)
-            # for benchmarking purpose
-            if len(peaks) > 0:
-                frag = ScanEvent(chemical, scan_time, use_ms_level, peaks, scan_id,
-                                 parents_intensity=peaks_ms1_intensities,
-                                 parent_adduct=peaks_which_adducts,
-                                 parent_isotope=peaks_which_isotopes,
-                                 precursor_mz=params.get(ScanParameters.PRECURSOR_MZ),
-                                 isolation_window=isolation_windows,
-                                 scan_params=params)
-                self.fragmentation_events.append(frag)
+        start = timer.start()
+        if len(idx) == 0:
+            # nothing elutes, e.g. before the first chemical or during the column wash, so the scan is empty
+            scan_mzs, scan_intensities = np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64)
+            scan_chems, frag = np.zeros(0, dtype=np.int64), None
+        elif use_ms_level == 1:
+            scan_mzs, scan_intensities, scan_chems, frag = self._get_ms1_peaks(idx, scan_time, params, scan_id,
+                                                                               isolation_windows, min_measurement_mz,
+                                                                               max_measurement_mz)
+        else:
+            scan_mzs, scan_intensities, scan_chems, frag = self._get_msn_peaks(idx, scan_time, params, scan_id,
+                                                                               use_ms_level, isolation_windows,
+                                                                               min_measurement_mz,
+                                                                               max_measurement_mz)
+        timer.stop(STAGE_PEAK_GENERATION, start)
 
         if self.spike_noise is not None:
-            spike_mzs, spike_intensities = self.spike_noise.sample(min_measurement_mz, max_measurement_mz)
-            scan_mzs.extend(spike_mzs)
-            scan_intensities.extend(spike_intensities)
-
-        scan_mzs = np.array(scan_mzs)
-        scan_intensities = np.array(scan_intensities)
+            start = timer.start()
+            rng_kwargs = {'rng': self.rng} if takes_rng(self.spike_noise.sample) else {}
+            spike_mzs, spike_intensities = self.spike_noise.sample(min_measurement_mz, max_measurement_mz,
+                                                                   **rng_kwargs)
+            scan_mzs = np.concatenate([scan_mzs, spike_mzs])
+            scan_intensities = np.concatenate([scan_intensities, spike_intensities])
+            scan_chems = np.concatenate([scan_chems, np.full(len(spike_mzs), -1, dtype=np.int64)])
+            timer.stop(STAGE_NOISE, start)
 
         sc = Scan(scan_id, scan_mzs, scan_intensities, ms_level, scan_time, scan_duration=None, scan_params=params,
-                  fragevent=frag)
+                  fragevent=frag, chem_idx=scan_chems)
 
         # Note: at this point, the scan duration is not set yet because we don't know what the next scan is going to be
         # We will set it later in the get_next_scan() method after we've notified the controller that this scan is produced.
         return sc
 
+    def _get_ms1_peaks(self, idx, scan_time, params, scan_id, isolation_windows, min_measurement_mz,
+                       max_measurement_mz):
+        """
+        Generates the peaks of an MS1 scan for all chemicals in idx at once, using the columnar chemical store
+        :return: a tuple of (m/z array, intensity array, chemical index array, the last fragmentation event)
+        """
+        store = self.chemical_store
+        signal_idx, mzs, intensities = store.get_ms1_signals(idx, scan_time)
+
+        # keep only signals that fall into one of the isolation windows
+        in_window = IsolationWindowSet(isolation_windows[0]).contains(mzs)
+        signal_idx, mzs, intensities = signal_idx[in_window], mzs[in_window], intensities[in_window]
+
+        mzs, intensities = self._apply_noise(mzs, intensities, 1)
+        keep = (mzs >= min_measurement_mz) & (mzs <= max_measurement_mz) & (intensities > 0)
+        signal_idx, mzs, intensities = signal_idx[keep], mzs[keep], intensities[keep]
+
+        chem_idx = store.signal_chems[signal_idx]
+        n_peaks = len(chem_idx)
+        frag = self._add_fragmentation_events(chem_idx, mzs, intensities, scan_time, 1, scan_id, params,
+                                              isolation_windows, [None] * n_peaks, [None] * n_peaks,
+                                              [None] * n_peaks)
+        return mzs, intensities, chem_idx, frag
+
+    def _get_msn_peaks(self, idx, scan_time, params, scan_id, ms_level, isolation_windows, min_measurement_mz,
+                       max_measurement_mz):
+        """
+        Generates the peaks of an MS2+ scan, or of an MS1 scan with in-source fragmentation, from the fragment
+        tables of the chemicals in idx. Other MS1 scans are generated by _get_ms1_peaks.
+        :return: a tuple of (m/z array, intensity array, chemical index array, the last fragmentation event)
+        """
+        # gather the peaks of all chemicals first, so that noise can be applied to the whole scan at once.
+        # Only chemicals with a precursor in the first isolation windows can produce fragments, and these are
+        # found for all chemicals at once
+        chem_peaks = []
+        store = self.chemical_store
+        window_sets = get_window_sets(isolation_windows)
+        relative_intensities, relative_mzs, matched = store.get_chromatogram_values(idx, scan_time)
+        isolated = np.zeros(len(idx), dtype=bool)
+        isolated[matched] = store.get_isolated(np.asarray(idx)[matched], relative_mzs[matched], window_sets[0])
+        for k in np.flatnonzero(isolated):
+            mz_peaks = self._get_fragment_peaks(idx[k], relative_intensities[k], relative_mzs[k], ms_level,
+                                                isolation_windows, window_sets=window_sets)
+            if mz_peaks is not None:
+                chem_peaks.append((idx[k], mz_peaks))
+        # peaks of a chemical stay contiguous, in the order they were generated
+        peak_info = [peak for _, mz_peaks in chem_peaks for peak in mz_peaks]
+        peak_chems = np.repeat(np.array([i for i, _ in chem_peaks], dtype=np.int64),
+                               [len(mz_peaks) for _, mz_peaks in chem_peaks])
+        all_mzs = np.array([peak[0] for peak in peak_info], dtype=np.float64)
+        all_intensities = np.array([peak[1] for peak in peak_info], dtype=np.float64)
+        all_mzs, all_intensities = self._apply_noise(all_mzs, all_intensities, ms_level)
+
+        keep = np.flatnonzero((all_mzs >= min_measurement_mz) & (all_mzs <= max_measurement_mz) &
+                              (all_intensities > 0))
+        mzs, intensities, chem_idx = all_mzs[keep], all_intensities[keep], peak_chems[keep]
+        kept_info = [peak_info[k] for k in keep.tolist()]
+        frag = self._add_fragmentation_events(chem_idx, mzs, intensities, scan_time, ms_level, scan_id, params,
+                                              isolation_windows, [info[2] for info in kept_info],
+                                              [info[4] for info in kept_info], [info[3] for info in kept_info])
+        return mzs, intensities, chem_idx, frag
+
+    def _add_fragmentation_events(self, chem_idx, mzs, intensities, scan_time, ms_level, scan_id, params,
+                                  isolation_windows, parents_intensity, parent_adduct, parent_isotope):
+        """
+        Records one fragmentation event for every chemical that produced peaks in a scan. ScanEvent objects, and
+        the Peak objects in them, are only created if the event sink keeps them, apart from the last one which
+        goes in the scan.
+        :param chem_idx: the chemical that produced each peak in the scan, with the peaks of a chemical contiguous
+        :param mzs: the m/z values of the peaks
+        :param intensities: the intensity values of the peaks
+        :param parents_intensity: a list of the intensity of the fragmented precursor of each peak, None for MS1
+        :param parent_adduct: a list of the adduct of the fragmented precursor of each peak, None for MS1
+        :param parent_isotope: a list of the isotope of the fragmented precursor of each peak, None for MS1
+        :return: the last ScanEvent, or None if there are no peaks
+        """
+        if len(chem_idx) == 0:
+            return None
+        boundaries = np.flatnonzero(np.diff(chem_idx)) + 1
+        starts = np.concatenate([[0], boundaries]).astype(int)
+        ends = np.concatenate([boundaries, [len(chem_idx)]]).astype(int)
+
+        precursor_mz = params.get(ScanParameters.PRECURSOR_MZ)
+        sink = self.fragmentation_events
+        event_range = range(len(starts)) if sink.keeps_events else [len(starts) - 1]
+        events = []
+        for k in event_range:
+            start, end = starts[k], ends[k]
+            peaks = [Peak(mz, scan_time, intensity, ms_level) for mz, intensity in
+                     zip(mzs[start:end].tolist(), intensities[start:end].tolist())]
+            events.append(ScanEvent(self.chemicals[chem_idx[start]], scan_time, ms_level, peaks, scan_id,
+                                    parents_intensity=parents_intensity[start:end],
+                                    parent_adduct=parent_adduct[start:end],
+                                    parent_isotope=parent_isotope[start:end],
+                                    precursor_mz=precursor_mz,
+                                    isolation_window=isolation_windows,
+                                    scan_params=params))
+
+        # for MS1 scans the intensity of an event is that of the first peak, otherwise that of the precursor
+        if ms_level == 1:
+            event_intensities = intensities[starts]
+        else:
+            event_intensities = np.array([parents_intensity[start] for start in starts], dtype=np.float64)
+        sink.add(scan_id, scan_time, ms_level, _get_first_precursor_mz(precursor_mz), chem_idx[starts],
+                 event_intensities, events=events if sink.keeps_events else None)
+        return events[-1]
+
+    def _get_fragment_peaks(self, chem_idx, relative_intensity, relative_mz, ms_level, isolation_windows,
+                            window_sets=None):
+        """
+        Generates the MS2+ peaks of a chemical from its compiled fragment table, for all combinations of isotope
+        and adduct at once. Gives the same peaks as _get_all_mz_peaks without noise, also for MS levels above 2.
+        :param chem_idx: the index of the chemical
+        :param relative_intensity: the relative intensity of the chromatogram of the chemical at the scan time
+        :param relative_mz: the relative m/z of the chromatogram of the chemical at the scan time
+        :param ms_level: the MS level of the scan
+        :param isolation_windows: the isolation windows of the scan, for each MS level below ms_level
+        :param window_sets: the isolation windows as IsolationWindowSet objects, created if not given
+        :return: a list of (mz, intensity, ms1 intensity, isotope, adduct) tuples, or None if there are no peaks
+        """
+        if window_sets is None:
+            window_sets = get_window_sets(isolation_windows)
+        table = self.chemical_store.get_fragment_table(chem_idx)
+        leaves = table.get_nodes(ms_level)
+        n_isotopes, n_adducts = table.isotope_adduct_mzs.shape
+        if len(leaves) == 0 or n_adducts == 0:
+            return None
+
+        # one row per isotope/adduct combination, in the same order as the loops in _get_all_mz_peaks,
+        # and one column per node of the fragmentation tree
+        which_isotopes = np.repeat(np.arange(n_isotopes), n_adducts)
+        which_adducts = np.tile(np.arange(n_adducts), n_isotopes)
+        n_combinations, n_nodes = len(which_isotopes), len(table.levels)
+        mzs = np.empty((n_combinations, n_nodes))
+        intensities = np.empty((n_combinations, n_nodes))
+        isolated = np.zeros((n_combinations, n_nodes), dtype=bool)
+        mzs[:, 0] = table.isotope_adduct_mzs.ravel() + relative_mz
+        intensities[:, 0] = table.isotope_adduct_intensities.ravel() * relative_intensity
+        mzs[:, 1:] = table.adduct_mzs[1:, which_adducts].T + table.isotope_shifts[which_isotopes][:, None]
+
+        # go down the tree one level at a time: a node is isolated if it and all its ancestors fall into an
+        # isolation window of their MS level
+        for level in range(1, ms_level):
+            nodes = table.get_nodes(level)
+            if level == 1:
+                reachable = np.ones((n_combinations, len(nodes)), dtype=bool)
+            else:
+                parents = table.parents[nodes]
+                intensities[:, nodes] = intensities[:, parents] * table.parent_mass_props[nodes] * \
+                                        table.prop_ms2_masses[nodes]
+                reachable = isolated[:, parents]
+            isolated[:, nodes] = reachable & window_sets[level - 1].contains(mzs[:, nodes])
+
+        parents = table.parents[leaves]
+        rows, cols = np.nonzero(isolated[:, parents])
+        if len(rows) == 0:
+            return None
+        leaves, parents = leaves[cols], parents[cols]
+        parent_intensities = intensities[rows, parents]
+        leaf_intensities = parent_intensities * table.parent_mass_props[leaves] * table.prop_ms2_masses[leaves]
+        if self.isolation_transition_window == 'gaussian':
+            leaf_intensities *= gaussian_transition(mzs[rows, parents] - window_sets[ms_level - 2].centre,
+                                                    self.isolation_transition_window_params[0])
+        return list(zip(mzs[rows, leaves].tolist(), leaf_intensities.tolist(), parent_intensities.tolist(),
+                        which_isotopes[rows].tolist(), which_adducts[rows].tolist()))
+
+    def _apply_noise(self, mzs, intensities, ms_level):
+        """
+        Applies the m/z and intensity noise to all the peaks of a scan at once. NoPeakNoise is skipped entirely.
+        :return: a tuple of (m/z array, intensity array) with noise applied
+        """
+        start = self.timer.start()
+        if type(self.mz_noise) is not NoPeakNoise:
+            mzs = self.mz_noise.apply(mzs, ms_level, rng=self.rng)
+        if type(self.intensity_noise) is not NoPeakNoise:
+            intensities = self.intensity_noise.apply(intensities, ms_level, rng=self.rng)
+        self.timer.stop(STAGE_NOISE, start)
+        return mzs, intensities
+
     def _get_chem_indices(self, query_rt):
-        rtmin_check = self.chrom_min_rts <= query_rt
-        rtmax_check = query_rt <= self.chrom_max_rts
-        idx = np.nonzero(rtmin_check & rtmax_check)[0]
-        return idx
+        return self.chemical_store.elution_index.get_active(query_rt)
 
-    def _get_all_mz_peaks(self, chemical, query_rt, ms_level, isolation_windows):
+    def _get_all_mz_peaks(self, chemical, query_rt, ms_level, isolation_windows, add_noise=True):
         # check if the chemical RT matches the current query RT
         if not self._rt_match(chemical, query_rt):
             return None
@@ -543,13 +822,15 @@ class IndependentMassSpectrometer(object):
         # if no peaks generated, then just return None
         if len(mz_peaks) == 0:
             return None
+        if not add_noise:
+            return mz_peaks
         # apply noise if any
         noisy_mz_peaks = []
         for i in range(len(mz_peaks)):
             original_mz = mz_peaks[i][0]
             original_intensity = mz_peaks[i][1]
-            noisy_mz = self.mz_noise.get(original_mz, ms_level)
-            noisy_intensity = self.intensity_noise.get(original_intensity, ms_level)
+            noisy_mz = self.mz_noise.get(original_mz, ms_level, rng=self.rng)
+            noisy_intensity = self.intensity_noise.get(original_intensity, ms_level, rng=self.rng)
             noisy_mz_peaks.append((noisy_mz, noisy_intensity, mz_peaks[i][2], mz_peaks[i][3], mz_peaks[i][4]))
         return noisy_mz_peaks
 
@@ -574,10 +855,8 @@ class IndependentMassSpectrometer(object):
             mz = self._get_mz(chemical, query_rt, which_isotope, which_adduct)
             if self.isolation_transition_window == 'gaussian':
                 parent_mz = self._get_mz(chemical.parent, query_rt, which_isotope, which_adduct)
-                scale_factor = scipy.stats.norm(0, self.isolation_transition_window_params[0]).pdf(
-                    parent_mz - sum(isolation_windows[ms_level - 2][0]) / 2)
-                scale_factor /= scipy.stats.norm(0, self.isolation_transition_window_params[0]).pdf(0)
-                intensity *= scale_factor
+                intensity *= gaussian_transition(parent_mz - sum(isolation_windows[ms_level - 2][0]) / 2,
+                                                 self.isolation_transition_window_params[0])
             return [(mz, intensity, ms1_intensity, which_isotope, which_adduct)]
             # return extra information here for logging
             # TODO: Potential improve how the isotope spectra are generated
@@ -637,3 +916,10 @@ class IndependentMassSpectrometer(object):
             if window[0] < self._get_mz(chemical, query_rt, which_isotope, which_adduct) <= window[1]:
                 return True
         return False
+
+
+def _get_first_precursor_mz(precursors):
+    # the PRECURSOR_MZ scan parameter is a list of Precursor objects
+    if precursors is None or len(precursors) == 0:
+        return None
+    return precursors[0].precursor_mz
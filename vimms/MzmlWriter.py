@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import numpy as np
@@ -32,7 +33,9 @@ class MzmlWriter(object):
             writer.controlled_vocabularies()
 
             # write other fields like sample list, software list, etc.
-            self._write_info(writer)
+            has_ms1_spectrum = 1 in self.scans
+            has_msn_spectrum = 1 in self.scans and len(self.scans) > 1
+            self._write_info(writer, has_ms1_spectrum, has_msn_spectrum)
 
             # open the run
             with writer.run(id=self.analysis_name):
@@ -47,10 +50,7 @@ class MzmlWriter(object):
 
         writer.close()
 
-    def _write_info(self, out):
-        # check file contains what kind of spectra
-        has_ms1_spectrum = 1 in self.scans
-        has_msn_spectrum = 1 in self.scans and len(self.scans) > 1
+    def _write_info(self, out, has_ms1_spectrum, has_msn_spectrum):
         file_contents = [
             'centroid spectrum'
         ]
@@ -171,3 +171,111 @@ class MzmlWriter(object):
         time_array = np.array(time_array)
         intensity_array = np.array(intensity_array)
         return time_array, intensity_array
+
+
+class StreamingMzmlWriter(MzmlWriter):
+    """
+    A class to write scans to an mzML file one at a time, as they are produced, so that they don't need to be kept
+    in memory until the end of the run. Scans should be added in order of retention time.
+
+    The spectrum and chromatogram index offsets are tracked by psims as spectra are written, and the TIC chromatogram
+    is accumulated from the MS1 scans. Since the number of spectra is only known at the end, a fixed-width
+    placeholder is written in the spectrumList count attribute and overwritten in place when the writer is closed,
+    after which the file checksum is recomputed.
+    """
+
+    COUNT_WIDTH = 10
+
+    def __init__(self, analysis_name, out_file, has_msn_spectrum=True, min_scan_id=INITIAL_SCAN_ID):
+        """
+        Initialises the streaming mzML writer class.
+        :param analysis_name: Name of the analysis.
+        :param out_file: the mzML file to write
+        :param has_msn_spectrum: whether to declare that the file contains MSn spectra
+        :param min_scan_id: scans with a lower scan id are not written
+        """
+        super().__init__(analysis_name, None)
+        self.out_file = str(out_file)
+        self.has_msn_spectrum = has_msn_spectrum
+        self.min_scan_id = min_scan_id
+        self.spectrum_count = 0
+        self.tic_rts = []
+        self.tic_intensities = []
+        self.writer = None
+
+    def open(self):
+        """
+        Opens the output file and writes everything that comes before the spectra
+        """
+        create_if_not_exist(os.path.dirname(self.out_file))
+        self.writer = PsimsMzMLWriter(open(self.out_file, 'wb'))
+        self.writer.begin()
+        self.writer.controlled_vocabularies()
+        self._write_info(self.writer, True, self.has_msn_spectrum)
+        self.run_section = self.writer.run(id=self.analysis_name)
+        self.run_section.begin()
+        self.spectrum_list_section = self.writer.spectrum_list(count=self._format_count(0))
+        self.spectrum_list_section.begin()
+
+    def add_scan(self, scan):
+        """
+        Writes a scan to the file, if it is not empty
+        :param scan: the scan to write
+        """
+        if scan.ms_level == 1:
+            self.tic_rts.append(scan.rt)
+            self.tic_intensities.append(np.sum(scan.intensities))
+        if scan.num_peaks > 0 and scan.scan_id >= self.min_scan_id:
+            self._write_scan(self.writer, scan)
+            self.spectrum_count += 1
+
+    def close(self):
+        """
+        Writes the TIC chromatogram and the index, closes the file and fixes up the spectrum count
+        """
+        self.spectrum_list_section.end()
+        with self.writer.chromatogram_list(count=1):
+            self.writer.write_chromatogram(np.array(self.tic_rts), np.array(self.tic_intensities), id='tic',
+                                           chromatogram_type='total ion current chromatogram',
+                                           time_unit='second')
+        self.run_section.end()
+        self.writer.close()
+        self._write_spectrum_count()
+
+    def _format_count(self, count):
+        return str(count).zfill(self.COUNT_WIDTH)
+
+    def _write_spectrum_count(self):
+        placeholder = ('<spectrumList count="%s"' % self._format_count(0)).encode('utf-8')
+        replacement = ('<spectrumList count="%s"' % self._format_count(self.spectrum_count)).encode('utf-8')
+        checksum_tag = b'<fileChecksum>'
+        with open(self.out_file, 'r+b') as f:
+            # the spectrum list starts after the header, and the checksum is at the very end of the file. Both are
+            # found before anything is written, so that the file isn't left half fixed up
+            head = f.read(1024 * 1024)
+            count_pos = head.find(placeholder)
+            if count_pos < 0:
+                raise ValueError('Spectrum count placeholder not found in the header of %s' % self.out_file)
+
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            tail_start = max(file_size - 4096, 0)
+            f.seek(tail_start)
+            tag_pos = f.read().rfind(checksum_tag)
+            if tag_pos < 0:
+                raise ValueError('File checksum not found at the end of %s' % self.out_file)
+            checksum_pos = tail_start + tag_pos + len(checksum_tag)
+
+            f.seek(count_pos)
+            f.write(replacement)
+
+            # SHA-1 checksum from the beginning of the file to the end of the fileChecksum open tag
+            sha1 = hashlib.sha1()
+            f.seek(0)
+            remaining = checksum_pos
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                sha1.update(chunk)
+                remaining -= len(chunk)
+            f.seek(checksum_pos)
+            f.write(sha1.hexdigest().encode('utf-8'))
@@ -1,40 +1,83 @@
 import numpy as np
 
-from vimms.Common import uniform_list
+from vimms.Common import uniform_list, get_rng, takes_rng
 
 
-def trunc_normal(mean, sigma, log_space):
+def trunc_normal(mean, sigma, log_space, rng=None):
     """
     Ensures that generators never return negative mz or intensity
     :param mean: mean of gaussian distribution to sample from
     :param sigma: variance of gaussian distribution to sample from
     :param log_space: whether to sample in log space
+    :param rng: the random number generator, see vimms.Common.get_rng
     :return: the sampled value
     """
+    rng = get_rng(rng)
     s = -1
     if not log_space:
         while s < 0:
-            s = np.random.normal(mean, sigma, 1)[0]
+            s = rng.normal(mean, sigma, 1)[0]
         return s
     else:
-        s = np.random.normal(np.log(mean), sigma, 1)[0]
+        s = rng.normal(np.log(mean), sigma, 1)[0]
         return np.exp(s)
 
 
+def trunc_normal_many(means, sigma, log_space, rng=None):
+    """
+    Vectorised version of trunc_normal, sampling one value for each mean
+    :param means: an array of means of the gaussian distributions to sample from
+    :param sigma: variance of the gaussian distributions to sample from
+    :param log_space: whether to sample in log space
+    :param rng: the random number generator, see vimms.Common.get_rng
+    :return: an array of sampled values
+    """
+    rng = get_rng(rng)
+    means = np.asarray(means, dtype=np.float64)
+    if log_space:
+        return np.exp(rng.normal(np.log(means), sigma))
+    samples = rng.normal(means, sigma)
+    negative = samples < 0
+    while np.any(negative):
+        samples[negative] = rng.normal(means[negative], sigma)
+        negative = samples < 0
+    return samples
+
+
 class NoPeakNoise(object):
     """
-    The base peak noise object that doesn't add any noise
+    The base peak noise object that doesn't add any noise.
+
+    Noise can be applied to one value with get, or to all the m/z or intensity values of a scan at once with apply.
+    Subclasses that only override get are still applied one value at a time. Both take the random number generator
+    of the mass spec, if it has one, so that noise is reproducible in runs with their own generator.
     """
 
-    def get(self, original, ms_level):
+    def get(self, original, ms_level, rng=None):
         """
         Get the original value back. No noise if applied.
         :param original: The original value
         :param ms_level: The ms level
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return: the original value
         """
         return original
 
+    def apply(self, values, ms_level, rng=None):
+        """
+        Applies noise to an array of values
+        :param values: an array of original values
+        :param ms_level: The ms level
+        :param rng: the random number generator, see vimms.Common.get_rng. Subclasses that only override get
+        apply it to each value, passing rng on if their get takes it, otherwise drawing from the global random state.
+        :return: an array of values with noise applied
+        """
+        if type(self).get is NoPeakNoise.get:
+            return values
+        if takes_rng(self.get):
+            return np.array([self.get(value, ms_level, rng=rng) for value in values], dtype=np.float64)
+        return np.array([self.get(value, ms_level) for value in values], dtype=np.float64)
+
 
 class GaussianPeakNoise(NoPeakNoise):
     """
@@ -50,14 +93,21 @@ class GaussianPeakNoise(NoPeakNoise):
         self.sigma = sigma
         self.log_space = log_space
 
-    def get(self, original, ms_level):
+    def get(self, original, ms_level, rng=None):
         """
         Gets peak measurement with gaussian noise applied
         :param original:
         :param ms_level:
+        :param rng: the random number generator, see vimms.Common.get_rng
         :return:
         """
-        return trunc_normal(original, self.sigma, self.log_space)
+        return trunc_normal(original, self.sigma, self.log_space, rng=rng)
+
+    def apply(self, values, ms_level, rng=None):
+        # subclasses that only override get are applied one value at a time
+        if type(self).get is not GaussianPeakNoise.get:
+            return super().apply(values, ms_level, rng=rng)
+        return trunc_normal_many(values, self.sigma, self.log_space, rng=rng)
 
 
 class GaussianPeakNoiseLevelSpecific(NoPeakNoise):
@@ -73,12 +123,62 @@ class GaussianPeakNoiseLevelSpecific(NoPeakNoise):
         self.log_space = log_space
         self.sigma_level_dict = sigma_level_dict
 
-    def get(self, original, ms_level):
+    def get(self, original, ms_level, rng=None):
         if ms_level in self.sigma_level_dict:
-            return trunc_normal(original, self.sigma_level_dict[ms_level], self.log_space)
+            return trunc_normal(original, self.sigma_level_dict[ms_level], self.log_space, rng=rng)
         else:
             return original
 
+    def apply(self, values, ms_level, rng=None):
+        # subclasses that only override get are applied one value at a time
+        if type(self).get is not GaussianPeakNoiseLevelSpecific.get:
+            return super().apply(values, ms_level, rng=rng)
+        if ms_level in self.sigma_level_dict:
+            return trunc_normal_many(values, self.sigma_level_dict[ms_level], self.log_space, rng=rng)
+        else:
+            return values
+
+
+class ArrayNoiseAdapter(NoPeakNoise):
+    """
+    Wraps a peak noise object that only implements get, or that doesn't take a random number generator, so that it
+    can be applied to arrays and called with one
+    """
+
+    def __init__(self, noise):
+        """
+        Creates an adapter
+        :param noise: a peak noise object with a get(original, ms_level) method
+        """
+        self.noise = noise
+
+    def get(self, original, ms_level, rng=None):
+        if takes_rng(self.noise.get):
+            return self.noise.get(original, ms_level, rng=rng)
+        return self.noise.get(original, ms_level)
+
+    def apply(self, values, ms_level, rng=None):
+        if hasattr(self.noise, 'apply'):
+            if takes_rng(self.noise.apply):
+                return self.noise.apply(values, ms_level, rng=rng)
+            return self.noise.apply(values, ms_level)
+        return super().apply(values, ms_level, rng=rng)
+
+
+def get_array_noise(noise):
+    """
+    Gets a peak noise object that supports apply and takes a random number generator, wrapping it in an
+    ArrayNoiseAdapter if needed
+    :param noise: a peak noise object, or None for no noise
+    :return: a peak noise object with get and apply methods
+    """
+    if noise is None:
+        return NoPeakNoise()
+    elif hasattr(noise, 'apply') and takes_rng(noise.get) and takes_rng(noise.apply):
+        return noise
+    else:
+        return ArrayNoiseAdapter(noise)
+
 
 class UniformSpikeNoise(object):
     def __init__(self, density, max_val, min_val=0, min_mz=None, max_mz=None):
@@ -88,13 +188,13 @@ class UniformSpikeNoise(object):
         self.min_mz = min_mz
         self.max_mz = max_mz
 
-    def sample(self, min_measurement_mz, max_measurement_mz):
+    def sample(self, min_measurement_mz, max_measurement_mz, rng=None):
         if self.min_mz is not None:
             min_measurement_mz = self.min_mz
         if self.max_mz is not None:
             max_measurement_mz = self.max_mz
         mz_range = max_measurement_mz - min_measurement_mz
         n_points = max(int(mz_range * self.density), 1)
-        mz_vals = uniform_list(n_points, min_measurement_mz, max_measurement_mz)
-        intensity_vals = uniform_list(n_points, self.min_val, self.max_val)
+        mz_vals = uniform_list(n_points, min_measurement_mz, max_measurement_mz, rng=rng)
+        intensity_vals = uniform_list(n_points, self.min_val, self.max_val, rng=rng)
         return mz_vals, intensity_vals
@@ -0,0 +1,343 @@
+"""
+Provides an on-disk cache of simulation results, so that sweeps and notebooks that repeat the same simulation
+(same chemicals, controller, parameters and seed) can skip the work that has already been done.
+
+Results are content-addressed: the key of a result is a stable hash of the inputs that produced it, computed from
+their values rather than their identity, so it is the same across processes and sessions. Each entry stores an
+evaluation summary, and optionally the columnar fragmentation event log and the path of the mzML file of the run.
+The cache can be limited in size, in which case the least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import os
+import pickle
+import random
+import shutil
+import time
+import types
+import uuid
+
+import numpy as np
+from loguru import logger
+
+# changing this invalidates all existing cache entries, e.g. when the simulation changes in a way that alters results
+CACHE_VERSION = 1
+
+SUMMARY_FILE = 'summary.p'
+EVENTS_FILE = 'events.npz'
+META_FILE = 'meta.json'
+
+
+def get_digest(*objs):
+    """
+    Computes a stable hash of the values of some objects. Objects are hashed through their class and state (their
+    __getstate__ or __dict__), recursively, so two objects that are equal field by field have the same digest even
+    if they were created in different processes.
+    :param objs: the objects to hash
+    :return: a hexadecimal string
+    """
+    h = hashlib.sha256()
+    seen = {}
+    for obj in objs:
+        _update_digest(h, obj, seen)
+    return h.hexdigest()
+
+
+def _update_digest(h, obj, seen):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        h.update(('%s:%r;' % (type(obj).__name__, obj)).encode())
+    elif isinstance(obj, bytes):
+        h.update(b'bytes:%d;' % len(obj))
+        h.update(obj)
+    elif isinstance(obj, np.generic):
+        _update_digest(h, obj.item(), seen)
+    elif isinstance(obj, np.ndarray):
+        h.update(('ndarray:%s:%s;' % (obj.dtype.str, obj.shape)).encode())
+        if obj.dtype.hasobject:
+            for item in obj.ravel().tolist():
+                _update_digest(h, item, seen)
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (types.FunctionType, types.BuiltinFunctionType, type)) or \
+            (callable(obj) and hasattr(obj, '__qualname__') and not hasattr(obj, '__dict__')):
+        h.update(('callable:%s.%s;' % (obj.__module__, obj.__qualname__)).encode())
+    elif id(obj) in seen:
+        # shared and cyclic references are hashed by the order in which they were first seen
+        h.update(b'ref:%d;' % seen[id(obj)][0])
+    else:
+        # keep a reference, so the id isn't reused while hashing
+        seen[id(obj)] = (len(seen), obj)
+        if isinstance(obj, (list, tuple)):
+            h.update(('%s:%d;' % (type(obj).__name__, len(obj))).encode())
+            for item in obj:
+                _update_digest(h, item, seen)
+        elif isinstance(obj, (set, frozenset)):
+            h.update(('%s:%d;' % (type(obj).__name__, len(obj))).encode())
+            for item_digest in sorted(get_digest(item) for item in obj):
+                h.update(item_digest.encode())
+        elif isinstance(obj, dict):
+            h.update(('%s:%d;' % (type(obj).__name__, len(obj))).encode())
+            default_factory = getattr(obj, 'default_factory', None)
+            if default_factory is not None:
+                _update_digest(h, default_factory, seen)
+            # sorted by key, so that insertion order doesn't matter
+            items = sorted(((get_digest(key), value) for key, value in obj.items()), key=lambda item: item[0])
+            for key_digest, value in items:
+                h.update(key_digest.encode())
+                _update_digest(h, value, seen)
+        else:
+            cls = type(obj)
+            h.update(('object:%s.%s;' % (cls.__module__, cls.__qualname__)).encode())
+            state = obj.__getstate__() if hasattr(obj, '__getstate__') else getattr(obj, '__dict__', None)
+            if state is None and not hasattr(obj, '__dict__'):
+                # extension types, e.g. numpy random generators, are hashed through how they are pickled
+                state = obj.__reduce_ex__(pickle.HIGHEST_PROTOCOL)[1:]
+            _update_digest(h, state, seen)
+
+
+class CacheEntry(object):
+    """
+    A result stored in the cache
+    """
+
+    def __init__(self, path, meta):
+        """
+        Creates a cache entry
+        :param path: the directory of the entry
+        :param meta: the metadata of the entry, a dictionary
+        """
+        self.path = path
+        self.key = meta['key']
+        self.mzml_path = meta.get('mzml_path')
+        self.meta = meta
+
+    def load_summary(self):
+        """
+        Loads the evaluation summary of the entry
+        :return: the summary, as it was stored
+        """
+        with open(os.path.join(self.path, SUMMARY_FILE), 'rb') as f:
+            return pickle.load(f)
+
+    def load_events(self):
+        """
+        Loads the fragmentation event log of the entry, if it was stored
+        :return: a dictionary of column name to numpy array, or None
+        """
+        events_file = os.path.join(self.path, EVENTS_FILE)
+        if not os.path.isfile(events_file):
+            return None
+        with np.load(events_file) as data:
+            return {name: data[name] for name in data.files}
+
+    def __repr__(self):
+        return 'CacheEntry %s' % self.key
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of simulation results, with least recently used eviction. Each entry is a directory named by
+    its key inside cache_dir, and is written to a temporary directory first and then renamed, so that entries are
+    never seen half written, even when several processes share the cache.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, max_entries=None, verify_fraction=0.0, verify_seed=None):
+        """
+        Creates a result cache
+        :param cache_dir: the directory to store the entries in, created if it doesn't exist
+        :param max_bytes: the maximum total size of the entries, or None for no limit
+        :param max_entries: the maximum number of entries, or None for no limit
+        :param verify_fraction: the fraction of cache hits in get_or_compute that are recomputed and compared to
+        the stored summary, to check that the cache is still valid
+        :param verify_seed: a seed to choose which hits are verified
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.verify_fraction = verify_fraction
+        self.verify_rng = random.Random(verify_seed)
+        self.hits = 0
+        self.misses = 0
+        self.verified = 0
+        self.mismatches = 0
+        self.dataset_digests = {}
+        self.last_access_ns = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, dataset, controller, params=None, seed=None):
+        """
+        Computes the key of the result of a simulation
+        :param dataset: the list of chemicals simulated. Its digest is computed once and remembered, so it
+        shouldn't be modified after the first call.
+        :param controller: a new controller object, not yet run. Its class and all its parameters are hashed.
+        :param params: any other inputs that affect the result, e.g. a dictionary of mass spec parameters, RT range
+        and evaluation settings
+        :param seed: the random seed of the simulation
+        :return: the key, a hexadecimal string
+        """
+        dataset_digest = self.get_dataset_digest(dataset)
+        return get_digest(CACHE_VERSION, dataset_digest, controller, params, seed)
+
+    def get_dataset_digest(self, dataset):
+        """
+        Gets the digest of a dataset, computing it the first time the dataset is seen
+        :param dataset: a list of chemicals
+        :return: the digest
+        """
+        # the dataset is kept in the dictionary, so its id isn't reused by another object
+        cached = self.dataset_digests.get(id(dataset))
+        if cached is None:
+            cached = (dataset, get_digest(dataset))
+            self.dataset_digests[id(dataset)] = cached
+        return cached[1]
+
+    def get(self, key):
+        """
+        Gets an entry from the cache, marking it as recently used
+        :param key: the key of the entry
+        :return: a CacheEntry, or None if the key isn't in the cache
+        """
+        path = self._get_path(key)
+        meta_file = os.path.join(path, META_FILE)
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            self._touch(meta_file)
+        except FileNotFoundError:  # not cached, or evicted by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CacheEntry(path, meta)
+
+    def put(self, key, summary, events=None, mzml_path=None):
+        """
+        Stores a result in the cache, replacing any entry with the same key
+        :param key: the key of the result, see get_key
+        :param summary: the evaluation summary, which must be picklable
+        :param events: the columns of the fragmentation event log, e.g. from ColumnarEventSink.get_columns()
+        :param mzml_path: the path of the mzML file of the run, if any
+        :return: the new CacheEntry
+        """
+        tmp_path = os.path.join(self.cache_dir, '.tmp-%s' % uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        meta = {
+            'key': key,
+            'version': CACHE_VERSION,
+            'created': time.time(),
+            'mzml_path': None if mzml_path is None else os.path.abspath(mzml_path)
+        }
+        with open(os.path.join(tmp_path, SUMMARY_FILE), 'wb') as f:
+            pickle.dump(summary, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if events is not None:
+            np.savez(os.path.join(tmp_path, EVENTS_FILE), **events)
+        with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        self._touch(os.path.join(tmp_path, META_FILE))
+
+        path = self._get_path(key)
+        self._remove(path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:  # written by another process in the meantime, which is just as good
+            self._remove(tmp_path)
+        self.evict()
+        return CacheEntry(path, meta)
+
+    def get_or_compute(self, key, compute):
+        """
+        Gets a summary from the cache, or computes and stores it if it isn't there. A fraction of the hits,
+        given by verify_fraction, are recomputed and compared with the stored summary.
+        :param key: the key of the result, see get_key
+        :param compute: a function with no arguments that runs the simulation and returns the summary
+        :return: the summary
+        """
+        entry = self.get(key)
+        if entry is None:
+            summary = compute()
+            self.put(key, summary)
+            return summary
+
+        summary = entry.load_summary()
+        if self.should_verify():
+            return self.verify(key, summary, compute())
+        return summary
+
+    def should_verify(self):
+        """
+        Chooses whether to verify a cache hit, with probability verify_fraction
+        :return: True if the hit should be recomputed and verified
+        """
+        return self.verify_fraction > 0 and self.verify_rng.random() < self.verify_fraction
+
+    def verify(self, key, summary, computed):
+        """
+        Compares a cached summary with a recomputed one, replacing the cached one if they differ
+        :param key: the key of the result
+        :param summary: the cached summary
+        :param computed: the recomputed summary
+        :return: the recomputed summary
+        """
+        self.verified += 1
+        if get_digest(computed) != get_digest(summary):
+            self.mismatches += 1
+            logger.warning('Cached result {} differs from the recomputed one, replacing it', key)
+            self.put(key, computed)
+        return computed
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its size limits
+        """
+        if self.max_bytes is None and self.max_entries is None:
+            return
+        entries = self._list_entries()
+        entries.sort(key=lambda entry: (entry[0], entry[2]))  # oldest access first, ties by path
+        total_bytes = sum(entry[1] for entry in entries)
+        while len(entries) > 0 and (
+                (self.max_entries is not None and len(entries) > self.max_entries) or
+                (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            _, size, path = entries.pop(0)
+            logger.debug('Evicting cache entry {}', path)
+            self._remove(path)
+            total_bytes -= size
+
+    def clear(self):
+        """
+        Removes all entries from the cache
+        """
+        for _, _, path in self._list_entries():
+            self._remove(path)
+
+    def __len__(self):
+        return len(self._list_entries())
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self._get_path(key), META_FILE))
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _touch(self, meta_file):
+        # marks an entry as used now. The access time is set explicitly in nanoseconds, and increases with every
+        # access from this cache, because the times the file system sets itself are too coarse to order accesses
+        # made one after the other.
+        self.last_access_ns = max(time.time_ns(), self.last_access_ns + 1)
+        os.utime(meta_file, ns=(self.last_access_ns, self.last_access_ns))
+
+    def _list_entries(self):
+        # a list of (last access time in nanoseconds, size in bytes, path) of the entries
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                last_access = os.stat(os.path.join(path, META_FILE)).st_mtime_ns
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+            except FileNotFoundError:  # removed by another process
+                continue
+            entries.append((last_access, size, path))
+        return entries
+
+    def _remove(self, path):
+        shutil.rmtree(path, ignore_errors=True)
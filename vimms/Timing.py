@@ -0,0 +1,169 @@
+"""
+Provides opt-in instrumentation that records how long each stage of a simulated run takes, for every scan.
+Timings are kept as columns of numpy arrays, and can be summarised in a table or exported as a Chrome trace
+(which can also be opened in speedscope) to inspect them as a flame graph.
+"""
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+# the stages of a run that are timed
+STAGE_CHEMICAL_LOOKUP = 'chemical lookup'
+STAGE_PEAK_GENERATION = 'peak generation'
+STAGE_NOISE = 'noise'
+STAGE_CONTROLLER = 'controller'
+STAGE_EXCLUSION_UPDATE = 'exclusion update'
+STAGE_UPDATE_STATE = 'update state'
+STAGE_MZML_WRITING = 'mzml writing'
+
+# the columns recorded for every timed stage, all in nanoseconds apart from the ids
+TIMING_COLUMNS = ['stage', 'scan_id', 'start_ns', 'wall_ns', 'cpu_ns']
+
+
+class StageTimer(object):
+    """
+    Records the wall and CPU time of the stages of a run. Code to be timed is wrapped like this:
+
+        start = timer.start()
+        ...
+        timer.stop(STAGE_NOISE, start)
+
+    Stages can be nested (e.g. noise is applied during peak generation), in which case the time of the inner
+    stage is also included in the time of the outer one.
+    """
+    enabled = True
+
+    def __init__(self, initial_capacity=4096):
+        """
+        Creates a stage timer
+        :param initial_capacity: the initial number of timings that can be stored before growing the arrays
+        """
+        self.stage_names = []
+        self.stage_ids = {}
+        self.scan_id = -1
+        self.origin_ns = time.perf_counter_ns()
+        self.size = 0
+        self.columns = {name: np.zeros(initial_capacity, dtype=np.int64) for name in TIMING_COLUMNS}
+
+    def set_scan(self, scan_id):
+        """
+        Sets the scan that the following timings belong to
+        :param scan_id: the scan id
+        """
+        self.scan_id = scan_id
+
+    def start(self):
+        """
+        Starts timing a stage
+        :return: a start token, to be passed to stop
+        """
+        return time.perf_counter_ns(), time.process_time_ns()
+
+    def stop(self, stage, start):
+        """
+        Stops timing a stage and records its timing
+        :param stage: the name of the stage
+        :param start: the token returned by start
+        """
+        wall_ns = time.perf_counter_ns() - start[0]
+        cpu_ns = time.process_time_ns() - start[1]
+
+        stage_id = self.stage_ids.get(stage)
+        if stage_id is None:
+            stage_id = len(self.stage_names)
+            self.stage_ids[stage] = stage_id
+            self.stage_names.append(stage)
+
+        capacity = len(self.columns['stage'])
+        if self.size == capacity:
+            for name in TIMING_COLUMNS:
+                column = np.zeros(max(2 * capacity, 1), dtype=np.int64)
+                column[:capacity] = self.columns[name]
+                self.columns[name] = column
+        k = self.size
+        self.columns['stage'][k] = stage_id
+        self.columns['scan_id'][k] = self.scan_id
+        self.columns['start_ns'][k] = start[0] - self.origin_ns
+        self.columns['wall_ns'][k] = wall_ns
+        self.columns['cpu_ns'][k] = cpu_ns
+        self.size += 1
+
+    def get_columns(self):
+        """
+        Gets all the recorded timings as columns
+        :return: a dictionary of column name to numpy array, see TIMING_COLUMNS. Stages are indices into
+        stage_names.
+        """
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+    def summary(self):
+        """
+        Summarises the recorded timings per stage
+        :return: a pandas DataFrame with one row per stage, sorted by total wall time
+        """
+        columns = self.get_columns()
+        n_stages = len(self.stage_names)
+        counts = np.bincount(columns['stage'], minlength=n_stages)
+        wall = np.bincount(columns['stage'], weights=columns['wall_ns'], minlength=n_stages) / 1e9
+        cpu = np.bincount(columns['stage'], weights=columns['cpu_ns'], minlength=n_stages) / 1e9
+        df = pd.DataFrame({
+            'stage': self.stage_names,
+            'count': counts,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'mean_wall_ms': 1e3 * wall / np.maximum(counts, 1),
+        })
+        return df.sort_values('wall_s', ascending=False).reset_index(drop=True)
+
+    def to_chrome_trace(self, filename=None):
+        """
+        Exports the recorded timings in the Chrome trace event format, which can be loaded in chrome://tracing,
+        Perfetto or speedscope
+        :param filename: the file to write the trace to, if any
+        :return: the trace, as a dictionary
+        """
+        columns = self.get_columns()
+        events = []
+        for stage, scan_id, start_ns, wall_ns, cpu_ns in zip(*[columns[name].tolist() for name in TIMING_COLUMNS]):
+            events.append({
+                'name': self.stage_names[stage],
+                'ph': 'X',
+                'ts': start_ns / 1e3,
+                'dur': wall_ns / 1e3,
+                'pid': 0,
+                'tid': 0,
+                'args': {'scan_id': scan_id, 'cpu_us': cpu_ns / 1e3}
+            })
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if filename is not None:
+            with open(filename, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+    def __len__(self):
+        return self.size
+
+
+class NullStageTimer(StageTimer):
+    """
+    A timer that records nothing, used when timing is disabled
+    """
+    enabled = False
+
+    def __init__(self):
+        super().__init__(initial_capacity=0)
+
+    def set_scan(self, scan_id):
+        pass
+
+    def start(self):
+        return None
+
+    def stop(self, stage, start):
+        pass
+
+
+# shared by everything that isn't being timed
+NULL_TIMER = NullStageTimer()
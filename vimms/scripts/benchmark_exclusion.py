@@ -0,0 +1,102 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+sys.path.append('../..')  # if running in this folder
+
+from vimms.Common import set_log_level_warning
+from vimms.Exclusion import ExclusionItem, WeightedDEWExclusion, compute_weight
+
+
+def make_exclusion_items(n_items, rt_tol, mz_tol, duration, rng):
+    """
+    Makes the exclusion items of precursors fragmented at random times in a run
+    :param n_items: the number of items
+    :param rt_tol: the RT tolerance of the exclusion windows
+    :param mz_tol: the m/z tolerance of the exclusion windows, in ppm
+    :param duration: the length of the run
+    :param rng: a numpy random Generator
+    :return: a list of ExclusionItem objects, in the order they were fragmented
+    """
+    frag_ats = np.sort(rng.uniform(0, duration, n_items))
+    mzs = rng.uniform(100, 1000, n_items)
+    return [ExclusionItem(mz * (1 - mz_tol / 1e6), mz * (1 + mz_tol / 1e6), frag_at - rt_tol, frag_at + rt_tol,
+                          frag_at) for mz, frag_at in zip(mzs.tolist(), frag_ats.tolist())]
+
+
+def linear_is_excluded(items, mz, rt, rt_tol, exclusion_t_0):
+    # how WeightedDEWExclusion.is_excluded used to work: sort all the items, then take the first that matches
+    items.sort(key=lambda x: x.from_rt, reverse=True)
+    for x in items:
+        if x.from_mz <= mz <= x.to_mz and x.from_rt <= rt <= x.to_rt:
+            return compute_weight(rt, x.frag_at, rt_tol, exclusion_t_0)
+    return False, 1.0
+
+
+def time_exclusion(n_items, n_peaks, n_linear, rt_tol, exclusion_t_0, mz_tol, seed=0):
+    """
+    Times the weighted dynamic exclusion queries of the precursors of one scan, with all n_items exclusion items
+    active at the time of the scan
+    :param n_items: the number of exclusion items
+    :param n_peaks: the number of peaks in the scan
+    :param n_linear: the number of peaks to time the previous linear search on, 0 to skip it
+    :param rt_tol: the RT tolerance of the exclusion windows
+    :param exclusion_t_0: the time after fragmentation during which ions are always excluded
+    :param mz_tol: the m/z tolerance of the exclusion windows, in ppm
+    :param seed: the random seed
+    :return: a dictionary of operation name to the time per peak (per item to build the index), in microseconds
+    """
+    rng = np.random.default_rng(seed)
+    items = make_exclusion_items(n_items, rt_tol, mz_tol, rt_tol, rng)
+    rt = rt_tol
+    # half of the peaks are precursors fragmented before, the others are new
+    mzs = np.concatenate([[(x.from_mz + x.to_mz) / 2 for x in rng.choice(items, n_peaks // 2)],
+                          rng.uniform(100, 1000, n_peaks - n_peaks // 2)])
+    timings = {}
+
+    start = time.perf_counter()
+    exclusion = WeightedDEWExclusion(rt_tol, exclusion_t_0)
+    exclusion.exclusion_list = items
+    timings['build index'] = (time.perf_counter() - start) / n_items
+
+    start = time.perf_counter()
+    expected = [exclusion.is_excluded(mz, rt) for mz in mzs]
+    timings['is_excluded'] = (time.perf_counter() - start) / n_peaks
+
+    start = time.perf_counter()
+    excluded, weights = exclusion.is_excluded_many(mzs, rt)
+    timings['is_excluded_many'] = (time.perf_counter() - start) / n_peaks
+    assert excluded.tolist() == [is_excluded for is_excluded, _ in expected]
+    assert np.allclose(weights, [weight for _, weight in expected])
+
+    if n_linear > 0:
+        start = time.perf_counter()
+        for mz in mzs[:n_linear]:
+            linear_is_excluded(items, mz, rt, rt_tol, exclusion_t_0)
+        timings['linear (previous)'] = (time.perf_counter() - start) / n_linear
+
+    return {name: elapsed * 1e6 for name, elapsed in timings.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of weighted dynamic exclusion queries')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 5 * 10 ** 4, 10 ** 5],
+                        help='numbers of exclusion items to benchmark')
+    parser.add_argument('--peaks', type=int, default=1000, help='number of peaks in the scan')
+    parser.add_argument('--linear', type=int, default=20,
+                        help='number of peaks to time the previous linear search on, 0 to skip it')
+    parser.add_argument('--rt_tol', type=float, default=120, help='RT tolerance of the exclusion windows')
+    parser.add_argument('--exclusion_t_0', type=float, default=15, help='time during which ions are always excluded')
+    parser.add_argument('--mz_tol', type=float, default=10, help='m/z tolerance of the exclusion windows, in ppm')
+    args = parser.parse_args()
+
+    set_log_level_warning()
+    for n_items in args.sizes:
+        timings = time_exclusion(n_items, args.peaks, args.linear, args.rt_tol, args.exclusion_t_0, args.mz_tol)
+        print('%d exclusion items' % n_items)
+        for name, elapsed in timings.items():
+            unit = 'item' if name == 'build index' else 'peak'
+            print('    %-20s %12.2f us per %s' % (name, elapsed, unit))
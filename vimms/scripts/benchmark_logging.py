@@ -0,0 +1,70 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+sys.path.append('../..')  # if running in this folder
+
+from loguru import logger
+
+from vimms.ChemicalSamplers import UniformMZFormulaSampler, UniformRTAndIntensitySampler, \
+    GaussianChromatogramSampler
+from vimms.Chemicals import ChemicalMixtureCreator
+from vimms.Common import POSITIVE
+from vimms.Controller import TopNController
+from vimms.Environment import Environment
+from vimms.MassSpec import IndependentMassSpectrometer
+
+
+def time_run(dataset, min_rt, max_rt, log_level, quiet, progress_bar):
+    """
+    Times a Top-N run with some logging setting
+    :param dataset: a list of chemicals
+    :param min_rt: start time of the run
+    :param max_rt: end time of the run
+    :param log_level: the level of the log handler, which discards all messages it receives
+    :param quiet: the quiet setting of the environment
+    :param progress_bar: the progress bar setting of the environment
+    :return: the number of scans generated per second
+    """
+    logger.remove()
+    handler_id = logger.add(lambda message: None, level=log_level)
+
+    mass_spec = IndependentMassSpectrometer(POSITIVE, dataset)
+    controller = TopNController(POSITIVE, 10, 0.7, 10, 15, 1000)
+    env = Environment(mass_spec, controller, min_rt, max_rt, progress_bar=progress_bar, quiet=quiet)
+    start = time.perf_counter()
+    env.run()
+    elapsed = time.perf_counter() - start
+
+    logger.remove(handler_id)
+    logger.add(sys.stderr)
+    return sum(len(scans) for scans in controller.scans.values()) / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of simulated scans per second with different logging '
+                                                 'settings')
+    parser.add_argument('--n_chems', type=int, default=2000, help='number of chemicals to simulate')
+    parser.add_argument('--min_rt', type=float, default=0, help='start time of the run')
+    parser.add_argument('--max_rt', type=float, default=300, help='end time of the run')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    mz_sampler = UniformMZFormulaSampler(min_mz=100, max_mz=1000)
+    rt_sampler = UniformRTAndIntensitySampler(min_rt=args.min_rt, max_rt=args.max_rt)
+    chromatogram_sampler = GaussianChromatogramSampler(sigma=10)
+    creator = ChemicalMixtureCreator(mz_sampler, rt_and_intensity_sampler=rt_sampler,
+                                     chromatogram_sampler=chromatogram_sampler)
+    dataset = creator.sample(args.n_chems, 2)
+
+    settings = [
+        ('debug messages handled', 'DEBUG', False, True),
+        ('warning level handler', 'WARNING', False, True),
+        ('quiet', 'DEBUG', True, False),
+    ]
+    for name, log_level, quiet, progress_bar in settings:
+        scans_per_second = time_run(dataset, args.min_rt, args.max_rt, log_level, quiet, progress_bar)
+        print('%-25s %10.1f scans/s' % (name, scans_per_second))
@@ -0,0 +1,62 @@
+import argparse
+import sys
+import time
+
+sys.path.append('..')
+sys.path.append('../..')  # if running in this folder
+
+from vimms.Common import ScanParameters
+from vimms.MassSpec import TaskManager
+
+
+def time_task_manager(n_tasks, buffer_size):
+    """
+    Times the main TaskManager operations on n_tasks tasks
+    :param n_tasks: the number of tasks
+    :param buffer_size: the buffer size of the task manager
+    :return: a dictionary of operation name to the number of tasks processed per second
+    """
+    tasks = [ScanParameters() for _ in range(n_tasks)]
+    task_manager = TaskManager(buffer_size=buffer_size)
+    timings = {}
+
+    start = time.perf_counter()
+    task_manager.add_current(tasks)
+    timings['enqueue'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    while task_manager.current_size() > 0:
+        task_manager.pop_current()
+    timings['dequeue'] = time.perf_counter() - start
+
+    # all tasks pending at once, completed in order and then in reverse order
+    for name, order in [('remove (in order)', tasks), ('remove (reversed)', tasks[::-1])]:
+        task_manager.add_pending(tasks)
+        start = time.perf_counter()
+        for task in order:
+            task_manager.remove_pending(task)
+        timings[name] = time.perf_counter() - start
+
+    # how the environment uses it: send up to buffer_size tasks, then complete them one at a time
+    task_manager.add_current(tasks)
+    start = time.perf_counter()
+    while task_manager.current_size() > 0 or task_manager.pending_size() > 0:
+        task_manager.add_pending(task_manager.to_send())
+        task_manager.remove_pending(task_manager.peek_pending())
+    timings['send and complete'] = time.perf_counter() - start
+
+    return {name: n_tasks / max(elapsed, 1e-9) for name, elapsed in timings.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of TaskManager throughput')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+                        help='numbers of tasks to benchmark')
+    parser.add_argument('--buffer_size', type=int, default=5, help='buffer size of the task manager')
+    args = parser.parse_args()
+
+    for n_tasks in args.sizes:
+        throughputs = time_task_manager(n_tasks, args.buffer_size)
+        print('%d tasks' % n_tasks)
+        for name, throughput in throughputs.items():
+            print('    %-20s %12.0f tasks/s' % (name, throughput))
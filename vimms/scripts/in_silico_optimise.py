@@ -8,6 +8,7 @@ sys.path.append('../..')  # if running in this folder
 
 from vimms.Common import IN_SILICO_OPTIMISE_TOPN, load_obj, add_log_file, IN_SILICO_OPTIMISE_SMART_ROI, \
     IN_SILICO_OPTIMISE_WEIGHTED_DEW
+from vimms.Executors import EXECUTOR_PROCESSES
 from vimms.InSilicoSimulation import extract_chemicals, get_timing, extract_timing, run_TopN, run_SmartROI, \
     run_WeightedDEW, extract_boxes, evaluate_boxes_as_dict, evaluate_boxes_as_array, save_counts, string_to_list, \
     plot_counts
@@ -52,6 +53,14 @@ class InSilicoSimulator(object):
         time_dict = get_timing(time_dict_str) if len(time_dict_str) > 0 else extract_timing(self.seed_file)
         return time_dict
 
+    def get_executor_params(self):
+        # the backend used to run the controllers in parallel, processes on all the cores by default
+        return {
+            'executor': self.config_parser.get('simulation', 'executor', fallback=EXECUTOR_PROCESSES),
+            'max_workers': self.config_parser.getint('simulation', 'max_workers', fallback=None),
+            'chunksize': self.config_parser.get('simulation', 'chunksize', fallback=1)
+        }
+
     def simulate(self):
         raise NotImplementedError()
 
@@ -141,7 +150,7 @@ class SmartROISimulator(InSilicoSimulator):
         return params
 
     def simulate(self, chems, scan_duration, params):
-        run_SmartROI(chems, scan_duration, params, self.out_dir)
+        run_SmartROI(chems, scan_duration, params, self.out_dir, **self.get_executor_params())
 
     def evaluate(self, params):
         # extract peak boxes
@@ -199,7 +208,7 @@ class WeightedDEWSimulator(InSilicoSimulator):
         return params
 
     def simulate(self, chems, time_dict, params):
-        run_WeightedDEW(chems, time_dict, params, self.out_dir)
+        run_WeightedDEW(chems, time_dict, params, self.out_dir, **self.get_executor_params())
 
     def evaluate(self, params):
         # extract peak boxes